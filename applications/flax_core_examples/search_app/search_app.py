@@ -49,6 +49,12 @@ DBDIR = '/tmp/flaxdemo'
 
 mlookup = TemplateLookup(directories=['templates'])
 
+# open databases, fieldmaps and query parsers are reused between requests
+searchers = flax.core.SearcherCache()
+
+# facets for browsing (no query text) are reused until the database changes
+facets = flax.core.FacetCache()
+
 urls = (
     '^/$', 'list',
     '^/(.*)/search$', 'search',
@@ -76,14 +82,14 @@ class search:
             i = web.input(query='', authfac=[], startrank=0, 
                           yearfrom='', yearto='')
             
-            # open the xapian Database and get the flax.core fieldmap object
-            # FIXME - could cache these for efficiency
-            db = xapian.Database(os.path.join(DBDIR, dbname))
-            fieldmap = flax.core.Fieldmap(db)
+            # get the xapian Database, flax.core fieldmap object and query
+            # parser from the cache (opening the database if necessary)
+            searcher = searchers.get(os.path.join(DBDIR, dbname))
+            db = searcher.database
+            fieldmap = searcher.fieldmap
             
-            # get a query parser and parse the query
-            queryparser = fieldmap.query_parser(db)
-            query = queryparser.parse_query(i.query)
+            # parse the query
+            query = searcher.query_parser.parse_query(i.query)
             
             # add authors filter, if supplied
             if i.authfac:
@@ -97,7 +103,8 @@ class search:
 
             # do the search, collecting facets for the author field
             results = fieldmap.search(db, query, int(i.startrank), 20, 
-                                      facet_fields=['author'])
+                                      facet_fields=['author'],
+                                      facet_cache=None if i.query else facets)
 
             # render and return the page
             t = mlookup.get_template('search.mako')
@@ -50,7 +50,7 @@
     
         <p>
             <h3>Author facet:</h3>
-            % for author in results.facets['author']:
+            % for author, count in results.facets['author']:
             <%
                 author = author.decode('utf-8', 'ignore')
                 checked = ''
@@ -58,7 +58,7 @@
                     checked = 'checked'
             %>
                 <input type="checkbox" name="authfac" value="${author}" ${checked}/>
-                ${author} <br/>
+                ${author} (${count}) <br/>
             % endfor
             <a href="javascript:clearfac()">clear</a>
         </p>
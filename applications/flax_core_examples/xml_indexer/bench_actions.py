@@ -0,0 +1,96 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Micro-benchmark comparing a compiled ActionPlan with evaluating each
+action's XPath expression for each element (as xml_indexer used to).
+
+    $ python bench_actions.py [<xml file> <actions> <doc tag> [<copies>]]
+
+By default the books example is used, with each book copied 2000 times.
+Documents are built but not added to a database. Timings are given both for
+Flax documents and for a null document, which shows the overhead of the
+actions alone.
+
+"""
+
+import sys
+import time
+from lxml import etree
+
+import flax.core
+from xml_indexer import make_fieldmap, make_plan
+
+
+class NullDocument(object):
+    """Document which ignores everything.
+
+    """
+    def index(self, *args, **kwargs):
+        pass
+
+    def set_data(self, data):
+        pass
+
+
+def run_direct(elements, actions, make_doc):
+    for element in elements:
+        doc = make_doc()
+        for act in actions:
+            for item in element.xpath(act.external_key):
+                act.action(act.fieldname, item, doc)
+
+def run_plan(elements, plan, make_doc):
+    for element in elements:
+        doc = make_doc()
+        plan.apply(element, doc)
+
+def best_time(fn, *args):
+    best = None
+    for i in xrange(3):
+        t = time.time()
+        fn(*args)
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+def main(xml_path, actions_path, root_tag, copies):
+    actions = flax.core.actions.parse_actions(actions_path)
+    fieldmap = make_fieldmap(actions)
+    plan = make_plan(actions)
+
+    elements = []
+    for event, element in etree.iterparse(xml_path, tag=root_tag):
+        elements.extend([element] * copies)
+
+    print '%d elements, %d actions, %s' % (len(elements), len(actions), plan)
+    for name, make_doc in (('null', NullDocument),
+                           ('flax', fieldmap.document)):
+        direct = best_time(run_direct, elements, actions, make_doc)
+        planned = best_time(run_plan, elements, plan, make_doc)
+        print '%s documents: direct %.3fs (%.0f/s), plan %.3fs (%.0f/s), ' \
+              'speedup %.2fx' % (name,
+            direct, len(elements) / direct,
+            planned, len(elements) / planned, direct / planned)
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        main('examples/books.xml', 'examples/books.actions', 'book', 2000)
+    elif len(sys.argv) in (4, 5):
+        copies = int(sys.argv[4]) if len(sys.argv) == 5 else 1
+        main(sys.argv[1], sys.argv[2], sys.argv[3], copies)
+    else:
+        print 'usage: python bench_actions.py [<xml file> <actions> <doc tag> [<copies>]]'
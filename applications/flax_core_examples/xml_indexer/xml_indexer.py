@@ -38,6 +38,10 @@ e.g. using the files provided in examples/ -
 
     $ python xml_indexer.py books.db examples/books.xml examples/book.actions book
 
+Add -r to resume an interrupted run from its last checkpoint (skipping the
+documents already indexed, though the file is parsed again from the start), or
+-j <workers> to rebuild the database using several indexing processes.
+
 """
 
 from __future__ import with_statement
@@ -45,6 +49,14 @@ from __future__ import with_statement
 import os, os.path
 import time
 import logging
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from lxml import etree
 import xapian
@@ -56,6 +68,100 @@ DBDIR = '/tmp/flaxdemo'
 # language for stemming
 LANGUAGE = 'en'
 
+# commit (and save a checkpoint) after this many documents or megabytes
+COMMIT_DOCS = 10000
+COMMIT_MB = 64
+
+# database metadata key for the checkpoint of an interrupted run
+CHECKPOINT_KEY = 'xml_indexer.checkpoint'
+
+def make_fieldmap(actions):
+    """Create a fieldmap from the actions.
+    
+    """
+    fieldmap = flax.core.Fieldmap(language=LANGUAGE)
+    for act in actions:
+        fieldmap.setfield(act.fieldname, act.action.isfilter)
+    return fieldmap
+
+def compile_xpath(extkey):
+    """Compile an external key from the actions file as an XPath expression
+    (for use with flax.core.actions.ActionPlan).
+    
+    """
+    xpath = etree.XPath(extkey)
+    def evaluate(element):
+        items = xpath(element)
+        if isinstance(items, list):
+            for item in items:
+                if not isinstance(item, basestring):
+                    raise Exception, \
+                        'xpath expression "%s" does not evaluate to a string' % extkey
+        return items
+    return evaluate
+
+def make_plan(actions):
+    """Compile the actions for indexing XML elements.
+    
+    """
+    return flax.core.actions.ActionPlan(actions, compile_key=compile_xpath)
+
+def apply_actions(element, doc, plan):
+    """Apply the compiled actions to an XML element, and set it as the 
+    document data.
+    
+    """
+    plan.apply(element, doc)
+    doc.set_data(etree.tostring(element))
+
+def index_xml(record, doc, plan):
+    """Index a serialised XML element (record handler for parallel indexing,
+    with the plan from make_plan() passed as the actions).
+    
+    """
+    apply_actions(etree.fromstring(record), doc, plan)
+
+def index_file_parallel(db_path, path, actions_path, root_tag, nworkers):
+    """Index an XML file into a new database using several processes.
+    
+    """
+    from flax.core.parallel import ParallelIndexer
+    
+    actions = flax.core.actions.parse_actions(actions_path)
+    fieldmap = make_fieldmap(actions)
+    plan = make_plan(actions)
+    
+    def records():
+        with open(path) as f:
+            for event, element in etree.iterparse(f, tag=root_tag):
+                yield etree.tostring(element)
+                free_element(element)
+
+    # the workers are forked, so inherit the plan rather than building one
+    indexer = ParallelIndexer(db_path, fieldmap, plan, index_xml, nworkers)
+    indexer.index(records())
+    indexer.merge()
+    print indexer
+    print 'done'
+
+def free_element(element):
+    """Free a finished element and its preceding siblings, so that memory
+    use does not grow with the size of the file being parsed.
+    
+    """
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+def memory_usage():
+    """Return the peak memory usage of this process in MB, if known.
+    
+    """
+    if resource is None:
+        return 0.0
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
 class Indexer(object):
     """FIXME
     
@@ -63,6 +169,7 @@ class Indexer(object):
     def __init__(self, db_path, actions_path, root_tag):
         self.db_path = db_path
         self.actions = flax.core.actions.parse_actions(actions_path)
+        self.plan = make_plan(self.actions)
         self.root_tag = root_tag
         
         try:
@@ -73,47 +180,113 @@ class Indexer(object):
             self.db = xapian.WritableDatabase(db_path, xapian.DB_CREATE)
             
             # create a fieldmap from the actions and save it
-            self.fieldmap = flax.core.Fieldmap(language=LANGUAGE)
-            for act in self.actions:
-                self.fieldmap.setfield(act.fieldname, act.action.isfilter)
-                
+            self.fieldmap = make_fieldmap(self.actions)
             self.fieldmap.save(self.db)
             self.db.flush()
+
+        self.indexer = self.fieldmap.bulk_indexer(self.db, 
+            batch_docs=COMMIT_DOCS, batch_bytes=COMMIT_MB << 20, 
+            on_commit=self._checkpoint)
+        self._path = None
+        self._file = None
+        self._count = 0
+        self._done = False
             
-    def index_file(self, path):
-        with open(path) as f:
-            for event, element in etree.iterparse(f):
-                if element.tag == self.root_tag:
+    def index_file(self, path, resume=False):
+        """Index each element with the root tag in an XML file.
+        
+        Changes are committed every COMMIT_DOCS documents or COMMIT_MB of
+        text, along with a checkpoint. If `resume` is True and the database
+        has a checkpoint for the same file, the documents indexed before it 
+        are skipped. The file is parsed again from the start, as an element
+        can't be parsed without the document around it, but the skipped
+        elements are not indexed.
+        
+        """
+        self._path = os.path.abspath(path)
+        self._count = 0
+        self._done = False
+        skip = 0
+        if resume:
+            checkpoint = self.db.get_metadata(CHECKPOINT_KEY)
+            if checkpoint:
+                checkpoint = json.loads(checkpoint)
+                if checkpoint['path'] == self._path:
+                    skip = checkpoint['count']
+                    print 'resuming after %d documents' % skip
+                else:
+                    print 'ignoring checkpoint for %s' % checkpoint['path']
+        
+        self._start = time.time()
+        with open(path, 'rb') as f:
+            self._file = f
+            for event, element in etree.iterparse(f, tag=self.root_tag):
+                self._count += 1
+                if self._count > skip:
                     self.index_element(element)
+                free_element(element)
+
+            self._done = True
+            self.indexer.close()
+            self._file = None
 
-        self.db.flush()
         print 'done'
 
+    def _checkpoint(self, indexer):
+        """Record the position reached in the file, or remove the checkpoint
+        if indexing has finished. Called by the bulk indexer before each
+        commit, so the checkpoint is committed along with the documents.
+        
+        """
+        if self._done:
+            self.db.set_metadata(CHECKPOINT_KEY, '')
+            return
+
+        self.db.set_metadata(CHECKPOINT_KEY, json.dumps({
+            'path': self._path, 'count': self._count}))
+        
+        # the offset is approximate, as the parser reads ahead
+        offset = self._file.tell()
+        
+        elapsed = time.time() - self._start
+        print '%d docs, %.1f MB read, %.1f docs/s, %.2f MB/s, ' \
+              'peak memory %.1f MB' % (self._count, offset / 1048576.0, 
+            indexer.rate, offset / 1048576.0 / elapsed if elapsed else 0.0,
+            memory_usage())
+
     def index_element(self, element):
         """Index an XML element as one xapian document.
         
         """
-        doc = self.fieldmap.document()
-        print 'indexing', element.tag
-        for act in self.actions:
-            for item in element.xpath(act.external_key):
-                if not isinstance(item, basestring):
-                    raise Exception, \
-                        'xpath expression "%s" does not evaluate to a string' % field.xpath
-                act.action(act.fieldname, item, doc)
-
-        data = etree.tostring(element)
-        doc.set_data(data)
-        self.fieldmap.add_document(self.db, doc)
+        doc = self.indexer.document()
+        apply_actions(element, doc, self.plan)
+        self.indexer.add(doc)
 
 if __name__ == '__main__':
     import sys
+    nworkers = None
+    resume = False
+    while len(sys.argv) > 1 and sys.argv[1][0] == '-':
+        if sys.argv[1] == '-j' and len(sys.argv) > 2:
+            nworkers = int(sys.argv[2])
+            del sys.argv[1:3]
+        elif sys.argv[1] == '-r':
+            resume = True
+            del sys.argv[1]
+        else:
+            break
+        
     if len(sys.argv) != 5:
-        print "usage: python xml_indexer.py <db name> <xml file> <actions> <doc tag>"
+        print "usage: python xml_indexer.py [-r] [-j <workers>] <db name> <xml file> <actions> <doc tag>"
     else:
         if not os.path.exists(DBDIR):
             os.mkdir(DBDIR)
             
-        indexer = Indexer(os.path.join(DBDIR, sys.argv[1]), sys.argv[3], sys.argv[4])
-        indexer.index_file(sys.argv[2])
+        db_path = os.path.join(DBDIR, sys.argv[1])
+        if nworkers:
+            index_file_parallel(db_path, sys.argv[2], sys.argv[3], sys.argv[4], 
+                                nworkers)
+        else:
+            indexer = Indexer(db_path, sys.argv[3], sys.argv[4])
+            indexer.index_file(sys.argv[2], resume)
     
\ No newline at end of file
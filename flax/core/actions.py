@@ -19,8 +19,6 @@ r"""Flax actions are
 See flaxcode/applications/xml_indexer and simple_search for examples of how
 to use Flax Core.
 
-FIXME - add some tests!
-
 """
 
 from __future__ import with_statement
@@ -43,10 +41,31 @@ class _IndexerAction(object):
         self.next = None 
         
     def __call__(self, fieldname, value, doc):
-        raise NotImplemented
+        """Apply this action and the rest of its chain to a value.
+        
+        """
+        _run_chain([act.apply for act in self.chain()], fieldname, value, doc)
+
+    def apply(self, fieldname, value, doc):
+        """Apply this action to a value, returning a sequence of values to
+        pass to the next action in the chain.
+        
+        """
+        raise NotImplementedError
         
     def add_action(self, action):
         self.next = action
+
+    def chain(self):
+        """Return the list of actions in the chain starting at this action.
+        
+        """
+        actions = []
+        act = self
+        while act is not None:
+            actions.append(act)
+            act = act.next
+        return actions
         
     def __repr__(self):
         if self.next:
@@ -55,6 +74,27 @@ class _IndexerAction(object):
             return str(self)
 
 
+def _run_chain(steps, fieldname, value, doc):
+    """Apply a list of action steps (see _IndexerAction.apply) to a value,
+    passing each value produced to the next step in turn.
+    
+    Values are handled depth first, in the same order as if each action 
+    called the next one directly.
+    
+    """
+    nsteps = len(steps)
+    stack = [(0, value)]
+    while stack:
+        i, value = stack.pop()
+        values = steps[i](fieldname, value, doc)
+        i += 1
+        if i < nsteps and values:
+            if len(values) == 1:
+                stack.append((i, values[0]))
+            else:
+                stack.extend([(i, v) for v in reversed(values)])
+
+
 class DateAction(_IndexerAction):
     """FIXME
     """
@@ -65,10 +105,10 @@ class DateAction(_IndexerAction):
         _IndexerAction.__init__(self)
         self.format = format
 
-    def __call__(self, fieldname, value, doc):        
+    def apply(self, fieldname, value, doc):        
         date = time.strptime(value, self.format)
         doc.index(fieldname, date)
-        if self.next: self.next(fieldname, value, doc)
+        return (value,)
         
     def __str__(self):
         return 'DateAction(%s)' % self.format
@@ -91,9 +131,9 @@ class FilterAction(_IndexerAction):
             else:
                 raise ActionsError, 'unknown filter argument: %s' % arg
     
-    def __call__(self, fieldname, value, doc):
+    def apply(self, fieldname, value, doc):
         doc.index(fieldname, value, store_facet=self.facet, isdocid=self.isdocid)
-        if self.next: self.next(fieldname, value, doc)
+        return (value,)
 
     def __str__(self):
         return 'FilterAction'
@@ -103,12 +143,12 @@ class NumericAction(_IndexerAction):
     action_name = 'numeric'
     isfilter = True
     
-    def __call__(self, fieldname, value, doc):
+    def apply(self, fieldname, value, doc):
         try:
             doc.index(fieldname, int(value))
         except ValueError:
             doc.index(fieldname, float(value))
-        if self.next: self.next(fieldname, value, doc)
+        return (value,)
 
     def __str__(self):
         return 'NumericAction'
@@ -121,9 +161,8 @@ class StripTagsAction(_IndexerAction):
     action_name = 'striptags'
     re_tag = re.compile(r'</\w+>|<\w{1,20}[^>]{0,100}>')
 
-    def __call__(self, fieldname, value, doc):
-        value = self.re_tag.sub('', value)
-        if self.next: self.next(fieldname, value, doc)
+    def apply(self, fieldname, value, doc):
+        return (self.re_tag.sub('', value),)
 
     def __str__(self):
         return 'StripTagsAction'
@@ -138,10 +177,11 @@ class ReSearchAction(_IndexerAction):
         _IndexerAction.__init__(self)
         self.re = re.compile(args[0], re.I)
 
-    def __call__(self, fieldname, value, doc):
+    def apply(self, fieldname, value, doc):
         m = self.re.search(value)
-        if m and self.next:
-            self.next(fieldname, m.group(0), doc) 
+        if m:
+            return (m.group(0),)
+        return ()
 
     def __str__(self):
         return 'ReSearchAction'
@@ -170,12 +210,12 @@ class IndexAction(_IndexerAction):
             else:
                 raise ActionsError, 'unknown index parameter: %s=%s' % (k, v)
 
-    def __call__(self, fieldname, value, doc):        
+    def apply(self, fieldname, value, doc):        
         doc.index(fieldname, value, 
                   search_default=self.default,
                   spelling=self.spelling, 
                   weight=self.weight)
-        if self.next: self.next(fieldname, value, doc)
+        return (value,)
 
     def __str__(self):
         return 'IndexAction[w=%s s=%s d=%s]' % (self.weight, self.spelling, self.default)
@@ -188,10 +228,8 @@ class SplitAction(_IndexerAction):
         _IndexerAction.__init__(self)
         self.re = re.compile(pattern)
         
-    def __call__(self, fieldname, value, doc):
-        if self.next:
-            for v in self.re.split(value):
-                self.next(fieldname, v, doc)
+    def apply(self, fieldname, value, doc):
+        return self.re.split(value)
 
     def __str__(self):
         return 'SplitAction(%s)' % self.re
@@ -205,8 +243,8 @@ class SliceAction(_IndexerAction):
         self.begin = int(begin)
         self.end = int(end)
 
-    def __call__(self, fieldname, value, doc):        
-        if self.next: self.next(fieldname, value[self.begin:self.end], doc)
+    def apply(self, fieldname, value, doc):        
+        return (value[self.begin:self.end],)
 
     def __str__(self):
         return 'SliceAction(%s, %s)' % (self.begin, self.end)
@@ -231,6 +269,78 @@ class FieldAction(object):
         self.external_key = extkey
         self.action = action
         
+
+def _mapping_key(extkey):
+    """Default key compiler for ActionPlan, for records which are dicts.
+    
+    """
+    def evaluate(record):
+        return record.get(extkey)
+    return evaluate
+
+
+class ActionPlan(object):
+    """A list of FieldAction objects compiled for applying to many records.
+    
+    Each distinct external key is compiled once, using `compile_key`, and 
+    evaluated once per record. Its values are then passed to every action
+    chain which uses that key. Chains are run in the order of the actions
+    (so terms get the same positions as when applying each action in turn),
+    by a loop over flattened lists of steps rather than by each action 
+    calling the next.
+    
+    `compile_key(extkey)` must return a callable which takes a record and
+    returns a value or a sequence of values (or None). For example, with 
+    lxml:
+    
+        plan = ActionPlan(parse_actions(path), compile_key=etree.XPath)
+        plan.apply(element, doc)
+    
+    By default, records are dicts keyed by external key.
+    
+    """
+
+    def __init__(self, actions, compile_key=_mapping_key):
+        self.keys = []      # (external key, evaluate)
+        self.chains = []    # (index in keys, fieldname, steps)
+        index = {}
+        for act in actions:
+            if act.external_key not in index:
+                index[act.external_key] = len(self.keys)
+                self.keys.append((act.external_key, 
+                                  compile_key(act.external_key)))
+            
+            steps = [a.apply for a in act.action.chain()]
+            self.chains.append((index[act.external_key], act.fieldname, 
+                                steps))
+
+    def apply(self, record, doc):
+        """Apply all the actions to a record, indexing into `doc`.
+        
+        """
+        keyvalues = []
+        for extkey, evaluate in self.keys:
+            values = evaluate(record)
+            if values is not None:
+                if isinstance(values, basestring) or \
+                   not hasattr(values, '__iter__'):
+                    values = (values,)
+                elif not isinstance(values, (list, tuple)):
+                    # may be used by several chains
+                    values = tuple(values)
+            keyvalues.append(values)
+
+        for i, fieldname, steps in self.chains:
+            values = keyvalues[i]
+            if values is not None:
+                for value in values:
+                    _run_chain(steps, fieldname, value, doc)
+
+    def __str__(self):
+        return 'ActionPlan: %d keys, %d chains' % (
+            len(self.keys), len(self.chains))
+
+        
 def parse_actions(conffile):
     """Parse the config file and return a list of FieldAction objects.
     
@@ -291,9 +401,67 @@ def parse_actions(conffile):
                     
         return actions
 
+def run_tests():
+    """Run some tests, checking that an ActionPlan indexes the same values in
+    the same order as applying each action in turn.
+    
+    """
+    class RecordingDocument(object):
+        def __init__(self):
+            self.calls = []
+        
+        def index(self, fieldname, value, **kwargs):
+            self.calls.append((fieldname, value, sorted(kwargs.items())))
+
+    def chain(*actions):
+        for action, next in zip(actions, actions[1:]):
+            action.add_action(next)
+        return actions[0]
+
+    actions = [
+        FieldAction('title', 'title', IndexAction('default', weight='2')),
+        FieldAction('tag', 'tags', FilterAction('facet')),
+        FieldAction('word', 'title', chain(SplitAction(r'\s+'), 
+                                           FilterAction())),
+        FieldAction('count', 'n', NumericAction()),
+        FieldAction('prefix', 'tags', chain(SliceAction(0, 2), 
+                                            StripTagsAction(),
+                                            FilterAction())),
+        FieldAction('year', 'date', chain(ReSearchAction(r'\d{4}'), 
+                                          FilterAction())),
+        ]
+    records = [
+        {'title': 'cheese fondue', 'tags': ['<b>gruyere', 'emmental'], 
+         'n': '3', 'date': 'in 2010'},
+        {'title': 'toast', 'tags': 'bread', 'n': '1.5', 'date': 'never'},
+        {},
+        ]
+
+    plan = ActionPlan(actions)
+    assert str(plan) == 'ActionPlan: 4 keys, 6 chains'
+    for record in records:
+        direct = RecordingDocument()
+        for act in actions:
+            values = record.get(act.external_key)
+            if values is None:
+                continue
+            if not isinstance(values, (list, tuple)):
+                values = (values,)
+            for value in values:
+                act.action(act.fieldname, value, direct)
+        
+        planned = RecordingDocument()
+        plan.apply(record, planned)
+        assert planned.calls == direct.calls, (planned.calls, direct.calls)
+    
+    print 'all tests passed'
+
 if __name__ == '__main__':
     import sys
-    for field in parse_actions(sys.argv[1]):
-        print field.external_key
-        print '    %s: %r' % (field.fieldname, field.action)
+    if len(sys.argv) > 1:
+        for field in parse_actions(sys.argv[1]):
+            print field.external_key
+            print '    %s: %r' % (field.fieldname, field.action)
+    else:
+        run_tests()
 
@@ -0,0 +1,207 @@
+# Copyright (c) 2010 Lemur Consulting Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+r"""Deterministic synthetic corpus generator.
+
+The same seed and settings always produce the same documents and queries,
+so benchmark runs on different versions of the code can be compared.
+
+"""
+
+import random
+import bisect
+from datetime import datetime, timedelta
+
+_consonants = 'bcdfghjklmnprstvwz'
+_vowels = 'aeiou'
+
+
+class ZipfSampler(object):
+    """Sample integers in [0, n) with probability proportional to
+    1 / (rank + 1) ** skew.
+
+    """
+
+    def __init__(self, n, skew, rng):
+        self._rng = rng
+        self._cumulative = []
+        total = 0.0
+        for rank in xrange(n):
+            total += 1.0 / (rank + 1) ** skew
+            self._cumulative.append(total)
+        self._total = total
+
+    def sample(self):
+        return bisect.bisect_left(self._cumulative,
+                                  self._rng.random() * self._total)
+
+
+class Corpus(object):
+    """A synthetic corpus of documents with text, filter, date and numeric
+    fields.
+
+    Each document is a dict with the keys:
+
+        id        unique string, suitable for a docid filter field
+        title     short text
+        body      longer text
+        category  one filter value per document
+        tag       a list of filter values
+        date      a datetime within `years` years of 2000-01-01
+        price     a float
+
+    Words, categories and tags are drawn from Zipf distributions.
+
+    """
+
+    fields = (
+        # name, isfilter
+        ('id', True),
+        ('title', False),
+        ('body', False),
+        ('category', True),
+        ('tag', True),
+        ('date', True),
+        ('price', True),
+    )
+
+    def __init__(self, seed=42, vocabulary=20000, skew=1.1, body_words=200,
+                 title_words=6, categories=50, tags=500, max_tags=4, years=20):
+        self.seed = seed
+        self.vocabulary = vocabulary
+        self.skew = skew
+        self.body_words = body_words
+        self.title_words = title_words
+        self.categories = categories
+        self.tags = tags
+        self.max_tags = max_tags
+        self.years = years
+
+        # the word list depends only on the seed and vocabulary size
+        rng = random.Random(seed)
+        words = set()
+        self.words = []
+        while len(self.words) < vocabulary:
+            word = ''.join(rng.choice(_consonants) + rng.choice(_vowels)
+                           for i in xrange(rng.randint(1, 4)))
+            if word not in words:
+                words.add(word)
+                self.words.append(word)
+
+    def settings(self):
+        """Return the corpus settings as a dict (e.g. for saving with
+        benchmark results).
+
+        """
+        return dict(seed=self.seed, vocabulary=self.vocabulary,
+                    skew=self.skew, body_words=self.body_words,
+                    title_words=self.title_words, categories=self.categories,
+                    tags=self.tags, max_tags=self.max_tags, years=self.years)
+
+    def fieldmap(self, language='en'):
+        """Return a Fieldmap for the corpus fields.
+
+        """
+        from flax.core import Fieldmap
+        fm = Fieldmap(language=language)
+        for name, isfilter in self.fields:
+            fm.setfield(name, isfilter)
+        return fm
+
+    def documents(self, count):
+        """Yield `count` documents.
+
+        """
+        rng = random.Random(self.seed + 1)
+        words = ZipfSampler(self.vocabulary, self.skew, rng)
+        categories = ZipfSampler(self.categories, self.skew, rng)
+        tags = ZipfSampler(self.tags, self.skew, rng)
+        start = datetime(2000, 1, 1)
+        seconds = self.years * 365 * 86400
+
+        for i in xrange(count):
+            yield {
+                'id': 'doc%d' % i,
+                'title': self._text(words, self.title_words),
+                'body': self._text(words, self.body_words),
+                'category': 'category%d' % categories.sample(),
+                'tag': ['tag%d' % tags.sample()
+                        for j in xrange(rng.randint(0, self.max_tags))],
+                'date': start + timedelta(seconds=rng.randint(0, seconds)),
+                'price': round(rng.uniform(0, 1000), 2),
+            }
+
+    def _text(self, sampler, count):
+        return ' '.join([self.words[sampler.sample()] for i in xrange(count)])
+
+    def index(self, fieldmap, doc, record, search_default=True):
+        """Index a corpus document into a Flax document.
+
+        If `search_default` is False, the text fields are not added to the
+        default field (which are copied from the termlist of a pass over
+        their text without a prefix).
+
+        """
+        from flax.core.fieldmap import _multivalues
+        doc.index('id', record['id'], isdocid=True)
+        doc.index('title', record['title'], search_default=search_default,
+                  weight=2)
+        doc.index('body', record['body'], search_default=search_default)
+        doc.index('category', record['category'])
+        for i, tag in enumerate(record['tag']):
+            # older Xapian versions only support one facet value per field
+            doc.index('tag', tag, store_facet=_multivalues or i == 0)
+        doc.index('date', record['date'])
+        doc.index('price', record['price'])
+        doc.set_data(record['id'])
+
+    def queries(self, count, max_words=3):
+        """Yield `count` free text query strings.
+
+        """
+        rng = random.Random(self.seed + 2)
+        words = ZipfSampler(self.vocabulary, self.skew, rng)
+        for i in xrange(count):
+            yield self._text(words, rng.randint(1, max_words))
+
+    def numeric_ranges(self, count):
+        """Yield `count` (low, high) price ranges.
+
+        """
+        rng = random.Random(self.seed + 3)
+        for i in xrange(count):
+            low = rng.uniform(0, 1000)
+            yield low, low + rng.uniform(0, 1000 - low)
+
+    def date_ranges(self, count):
+        """Yield `count` (start, end) datetime ranges, of lengths from hours
+        to years.
+
+        """
+        rng = random.Random(self.seed + 4)
+        start = datetime(2000, 1, 1)
+        seconds = self.years * 365 * 86400
+        for i in xrange(count):
+            length = rng.choice((3600, 86400, 30 * 86400, 365 * 86400,
+                                 5 * 365 * 86400))
+            offset = rng.randint(0, seconds - length)
+            length = rng.randint(length / 2, length)
+            yield (start + timedelta(seconds=offset),
+                   start + timedelta(seconds=offset + length))
@@ -0,0 +1,264 @@
+# Copyright (c) 2010 Lemur Consulting Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+r"""Run the Flax core benchmarks.
+
+    $ python -m flax.core.bench.run [options]
+
+Builds a database from the synthetic corpus, then times:
+
+    index       documents/s using BulkIndexer, and using Fieldmap.document()
+                and Fieldmap.add_document() for comparison, and the time
+                spent indexing text into the default field
+    qp          Fieldmap.query_parser() construction
+    search      Fieldmap.search() latency, with and without facets
+    range       Fieldmap.range_query() on numeric and date fields (time to
+                build the query, and to search with it)
+
+Latencies are reported in milliseconds as mean/p50/p90/p99. Results are
+printed, and written as JSON with --output so that runs can be compared.
+
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+from datetime import datetime
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import xapian
+
+from flax.core.bench.corpus import Corpus
+
+
+def percentiles(times):
+    """Return summary statistics (in milliseconds) for a list of times in
+    seconds.
+
+    """
+    if not times:
+        return {}
+    times = sorted(times)
+    def pc(p):
+        return 1000.0 * times[min(len(times) - 1, int(p * len(times)))]
+    return {
+        'count': len(times),
+        'mean': 1000.0 * sum(times) / len(times),
+        'p50': pc(0.50),
+        'p90': pc(0.90),
+        'p99': pc(0.99),
+        'max': 1000.0 * times[-1],
+    }
+
+def timed(fn, *args, **kwargs):
+    """Call fn, returning (elapsed seconds, result).
+
+    """
+    t = time.time()
+    result = fn(*args, **kwargs)
+    return time.time() - t, result
+
+
+def bench_index(corpus, path, ndocs, nplain):
+    """Build the benchmark database at `path`, returning indexing results.
+
+    """
+    fieldmap = corpus.fieldmap()
+    db = xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OVERWRITE)
+    fieldmap.save(db)
+
+    indexer = fieldmap.bulk_indexer(db)
+    t = time.time()
+    for record in corpus.documents(ndocs):
+        doc = indexer.document()
+        corpus.index(fieldmap, doc, record)
+        indexer.add(doc)
+    indexer.close()
+    bulk = time.time() - t
+    results = {
+        'docs': ndocs,
+        'bulk_seconds': bulk,
+        'bulk_docs_per_sec': ndocs / bulk if bulk else 0.0,
+        'bulk_mb': indexer.bytes / 1048576.0,
+    }
+
+    # the plain path, and the bulk path without the default field, into
+    # scratch databases
+    if nplain:
+        scratch = tempfile.mkdtemp()
+        try:
+            scratch_db = xapian.WritableDatabase(scratch,
+                                                 xapian.DB_CREATE_OR_OVERWRITE)
+            scratch_indexer = fieldmap.bulk_indexer(scratch_db)
+            docs = list(corpus.documents(nplain))
+            times = []
+            for search_default in (True, False):
+                t = time.time()
+                for record in docs:
+                    doc = scratch_indexer.document()
+                    corpus.index(fieldmap, doc, record, search_default)
+                times.append(time.time() - t)
+            scratch_indexer.close()
+            del scratch_indexer, scratch_db
+        finally:
+            shutil.rmtree(scratch)
+        # documents are built but not added, so this is only the indexing
+        results['default_field_seconds'] = times[0] - times[1]
+        results['default_field_fraction'] = \
+            (times[0] - times[1]) / times[0] if times[0] else 0.0
+
+        scratch = tempfile.mkdtemp()
+        try:
+            plain_db = xapian.WritableDatabase(scratch,
+                                               xapian.DB_CREATE_OR_OVERWRITE)
+            t = time.time()
+            for record in corpus.documents(nplain):
+                doc = fieldmap.document()
+                corpus.index(fieldmap, doc, record)
+                fieldmap.add_document(plain_db, doc)
+            plain_db.flush()
+            plain = time.time() - t
+            del plain_db
+        finally:
+            shutil.rmtree(scratch)
+        results['plain_docs'] = nplain
+        results['plain_seconds'] = plain
+        results['plain_docs_per_sec'] = nplain / plain if plain else 0.0
+
+    return fieldmap, results
+
+def bench_query_parser(fieldmap, db, repeat):
+    times = []
+    for i in xrange(repeat):
+        times.append(timed(fieldmap.query_parser, db)[0])
+    return percentiles(times)
+
+def bench_search(corpus, fieldmap, db, nqueries, **kwargs):
+    qp = fieldmap.query_parser(db)
+    times = []
+    hits = 0
+    for querystring in corpus.queries(nqueries):
+        query = qp.parse_query(querystring)
+        elapsed, mset = timed(fieldmap.search, db, query, **kwargs)
+        times.append(elapsed)
+        hits += mset.get_matches_estimated()
+    results = percentiles(times)
+    results['mean_hits'] = float(hits) / nqueries if nqueries else 0.0
+    return results
+
+def bench_range(fieldmap, db, fieldname, ranges):
+    build = []
+    search = []
+    for low, high in ranges:
+        elapsed, query = timed(fieldmap.range_query, fieldname, low, high)
+        build.append(elapsed)
+        search.append(timed(fieldmap.search, db, query)[0])
+    return {'build': percentiles(build), 'search': percentiles(search)}
+
+
+def run(corpus, path, ndocs, nplain, nqueries, verbose=True):
+    """Run all the benchmarks, returning the results as a dict.
+
+    """
+    def report(name, value):
+        if verbose:
+            print '%-16s %s' % (name, json.dumps(value, sort_keys=True))
+
+    results = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'xapian': xapian.version_string(),
+        'python': sys.version.split()[0],
+        'corpus': corpus.settings(),
+    }
+
+    fieldmap, results['index'] = bench_index(corpus, path, ndocs, nplain)
+    report('index', results['index'])
+
+    db = xapian.Database(path)
+    results['query_parser'] = bench_query_parser(fieldmap, db, nqueries)
+    report('query_parser', results['query_parser'])
+
+    results['search'] = bench_search(corpus, fieldmap, db, nqueries)
+    report('search', results['search'])
+
+    results['search_facets'] = bench_search(corpus, fieldmap, db, nqueries,
+        facet_fields=['category', 'tag'])
+    report('search_facets', results['search_facets'])
+
+    results['range_price'] = bench_range(fieldmap, db, 'price',
+                                         corpus.numeric_ranges(nqueries))
+    report('range_price', results['range_price'])
+
+    results['range_date'] = bench_range(fieldmap, db, 'date',
+                                        corpus.date_ranges(nqueries))
+    report('range_date', results['range_date'])
+
+    return results
+
+
+def main(argv):
+    op = optparse.OptionParser(usage='%prog [options]')
+    op.add_option('-n', '--docs', type='int', default=10000,
+                  help='number of documents to index [%default]')
+    op.add_option('-p', '--plain-docs', type='int', default=1000,
+                  help='number of documents to index without BulkIndexer, '
+                       'for comparison (0 to skip) [%default]')
+    op.add_option('-q', '--queries', type='int', default=1000,
+                  help='number of queries for each benchmark [%default]')
+    op.add_option('-s', '--seed', type='int', default=42,
+                  help='corpus random seed [%default]')
+    op.add_option('-v', '--vocabulary', type='int', default=20000,
+                  help='number of distinct words [%default]')
+    op.add_option('-z', '--skew', type='float', default=1.1,
+                  help='Zipf skew of words, categories and tags [%default]')
+    op.add_option('-d', '--db', default=None,
+                  help='database path (default is a temporary directory, '
+                       'deleted afterwards)')
+    op.add_option('-o', '--output', default=None,
+                  help='file to write JSON results to')
+    options, args = op.parse_args(argv)
+    if args:
+        op.error('unexpected arguments')
+
+    corpus = Corpus(seed=options.seed, vocabulary=options.vocabulary,
+                    skew=options.skew)
+    path = options.db or tempfile.mkdtemp()
+    try:
+        results = run(corpus, path, options.docs, options.plain_docs,
+                      options.queries)
+    finally:
+        if options.db is None:
+            shutil.rmtree(path)
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,376 @@
+# Copyright (c) 2010 Lemur Consulting Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+r"""Caches for Flax core.
+
+Opening a database, decoding its fieldmap and building a query parser costs
+more than many searches, so long-running search applications should keep
+them around between requests:
+
+    cache = flax.core.SearcherCache()
+    ...
+    searcher = cache.get('/path/to/db')
+    query = searcher.query_parser.parse_query(querystring)
+    results = searcher.fieldmap.search(searcher.database, query)
+
+"""
+
+import time
+import threading
+import itertools
+import weakref
+import xapian
+
+from fieldmap import Fieldmap
+
+
+def database_revision(database):
+    """Return a value which changes whenever the database is modified.
+
+    Xapian 1.4 exposes the revision directly. Older versions don't (and 1.4
+    can't for a database made of several shards, such as a stub database,
+    and gives 0 for backends without revisions, such as in-memory
+    databases), so a tuple of database statistics (plus the saved fieldmap)
+    is used instead.
+
+    """
+    try:
+        revision = database.get_revision()
+    except (AttributeError, xapian.InvalidOperationError):
+        revision = 0
+    if revision:
+        return revision
+    return (database.get_doccount(), database.get_lastdocid(),
+            database.get_avlength(),
+            database.get_metadata('flax.fieldmap'),
+            database.get_metadata('flax.language'))
+
+
+class LRUCache(object):
+    """A dict-like container holding at most `maxsize` items, discarding the
+    least recently used item when full.
+
+    This is not synchronised.
+
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._map = {}
+        # circular doubly-linked list of [prev, next, key, value]
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def get(self, key, default=None):
+        """Return the value for `key` (marking it as recently used), or
+        `default` if not present.
+
+        """
+        link = self._map.get(key)
+        if link is None:
+            return default
+
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def put(self, key, value):
+        """Store a value, discarding the least recently used item if the
+        cache is full.
+
+        """
+        link = self._map.get(key)
+        if link is not None:
+            self._unlink(link)
+            link[3] = value
+        else:
+            if len(self._map) >= self.maxsize:
+                self.pop(self._root[1][2])
+            link = [None, None, key, value]
+            self._map[key] = link
+        self._append(link)
+
+    def pop(self, key, default=None):
+        """Remove and return the value for `key`.
+
+        """
+        link = self._map.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[3]
+
+    def oldest(self):
+        """Return the least recently used (key, value) pair, or None.
+
+        """
+        link = self._root[1]
+        if link is self._root:
+            return None
+        return link[2], link[3]
+
+    def clear(self):
+        self._map.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    @staticmethod
+    def _unlink(link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+
+class FacetCache(object):
+    """Cache of facet summaries for Fieldmap.search(), discarded when the
+    database changes.
+
+    This is most useful for browse pages which only apply filters, as the
+    same few queries are repeated with different page offsets.
+
+    """
+
+    def __init__(self, maxsize=1000):
+        self.hits = 0
+        self.misses = 0
+        self._lru = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        # keys for databases without a UUID, which (unlike their id()) are
+        # not reused once the database is garbage collected
+        self._keys = weakref.WeakKeyDictionary()
+        self._next_key = itertools.count()
+
+    def _database_key(self, database):
+        """Return the UUID of the database, or a key unique to the database
+        object if it has none (e.g. in-memory or multiple databases).
+
+        Must be called with the lock held.
+
+        """
+        try:
+            uuid = database.get_uuid()
+        except (AttributeError, xapian.InvalidOperationError):
+            uuid = None
+        if uuid:
+            return uuid
+
+        key = self._keys.get(database)
+        if key is None:
+            key = self._keys[database] = self._next_key.next()
+        return key
+
+    def get(self, database, key):
+        """Return the facets cached for `key` at the current database
+        revision, or None.
+
+        """
+        self._lock.acquire()
+        try:
+            key = (self._database_key(database), key)
+            entry = self._lru.get(key)
+            if entry is not None and entry[0] == database_revision(database):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+        finally:
+            self._lock.release()
+
+    def put(self, database, key, facets):
+        """Cache the facets for `key` at the current database revision.
+
+        """
+        self._lock.acquire()
+        try:
+            key = (self._database_key(database), key)
+            self._lru.put(key, (database_revision(database), facets))
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._lru.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._lru)
+
+    def __str__(self):
+        return 'FacetCache: %d entries, %d hits, %d misses' % (
+            len(self._lru), self.hits, self.misses)
+
+
+class Searcher(object):
+    """An open xapian.Database with its Fieldmap and a QueryParser prepared
+    for that fieldmap.
+
+    Use SearcherCache.get() rather than creating these directly.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.database = xapian.Database(path)
+        self.revision = database_revision(self.database)
+        self.last_used = self.last_checked = time.time()
+        self._load_fieldmap()
+
+    def _load_fieldmap(self):
+        self._saved = (self.database.get_metadata('flax.fieldmap'),
+                       self.database.get_metadata('flax.language'))
+        self.fieldmap = Fieldmap(self.database)
+        self.query_parser = self.fieldmap.query_parser(self.database)
+
+    def refresh(self):
+        """Reopen the database to see the latest revision. If it has changed,
+        the fieldmap and query parser are rebuilt (but only if the saved
+        fieldmap has changed).
+
+        Returns True iff the database revision has changed.
+
+        """
+        self.last_checked = time.time()
+        self.database.reopen()
+        revision = database_revision(self.database)
+        if revision == self.revision:
+            return False
+
+        self.revision = revision
+        saved = (self.database.get_metadata('flax.fieldmap'),
+                 self.database.get_metadata('flax.language'))
+        if saved != self._saved:
+            self._load_fieldmap()
+        return True
+
+
+class SearcherCache(object):
+    """Process-wide cache of Searcher objects, keyed by database path.
+
+    Xapian database objects must not be used by more than one thread at a
+    time, so by default each thread gets its own Searcher for a path.
+
+    """
+
+    def __init__(self, maxsize=32, check_interval=1.0, max_idle=600.0,
+                 per_thread=True):
+        """Init a new cache.
+
+        `maxsize` is the maximum number of open searchers; the least recently
+            used is closed when this is exceeded.
+        `check_interval` is the minimum time in seconds between checks for
+            a new database revision (0 checks on every get).
+        `max_idle` is the time in seconds after which an unused searcher is
+            discarded (None to keep searchers until evicted).
+        `per_thread` should be False only if the caller ensures that
+            searchers are never used concurrently.
+
+        """
+        self.check_interval = check_interval
+        self.max_idle = max_idle
+        self.per_thread = per_thread
+        self.hits = 0
+        self.misses = 0
+        self.reopens = 0
+        self._lru = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return a Searcher for the database at `path`, opening the database
+        if necessary.
+
+        Raises xapian.DatabaseOpeningError if the database can't be opened.
+
+        """
+        if self.per_thread:
+            key = (path, threading.currentThread())
+        else:
+            key = path
+
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._evict_idle(now)
+            searcher = self._lru.get(key)
+            if searcher is None:
+                self.misses += 1
+                searcher = Searcher(path)
+                self._lru.put(key, searcher)
+            else:
+                self.hits += 1
+                if now - searcher.last_checked >= self.check_interval:
+                    if searcher.refresh():
+                        self.reopens += 1
+            searcher.last_used = now
+            return searcher
+        finally:
+            self._lock.release()
+
+    def discard(self, path):
+        """Discard all searchers for the database at `path`.
+
+        """
+        self._lock.acquire()
+        try:
+            for key in list(self._lru._map):
+                if key == path or (isinstance(key, tuple) and key[0] == path):
+                    self._lru.pop(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Discard all searchers.
+
+        """
+        self._lock.acquire()
+        try:
+            self._lru.clear()
+        finally:
+            self._lock.release()
+
+    def _evict_idle(self, now):
+        if self.max_idle is None:
+            return
+
+        while True:
+            oldest = self._lru.oldest()
+            if oldest is None or now - oldest[1].last_used < self.max_idle:
+                break
+            self._lru.pop(oldest[0])
+
+    def __len__(self):
+        return len(self._lru)
+
+    def __str__(self):
+        return 'SearcherCache: %d open, %d hits, %d misses, %d reopens' % (
+            len(self._lru), self.hits, self.misses, self.reopens)
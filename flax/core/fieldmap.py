@@ -27,8 +27,11 @@ to use Flax Core.
 """
 
 import time
-from datetime import datetime
+from datetime import datetime, date, timedelta
 import re
+import base64
+import threading
+import Queue
 import xapian
 try:
     import json
@@ -45,6 +48,11 @@ except AttributeError:
     _FacetMatchSpy = xapian.ValueCountMatchSpy
     _multivalues = False
 
+try:
+    _KeyMaker = xapian.MultiValueKeyMaker
+except AttributeError:
+    _KeyMaker = None
+
 
 class Fieldmap(object):
     """Helper class for adding named field functionality to Xapian.
@@ -214,6 +222,12 @@ class Fieldmap(object):
         latter case, the fieldmap will generate helper terms to try to
         optimise the query.
         
+        A date field indexed with several dates has helper terms for all of
+        them, but only the last date in its value. A document then matches
+        if any of its dates is on a whole day inside the range, but on the
+        partly covered days at either end only the last date is checked.
+        Index one date per field where this matters.
+        
         """
         if type(value1) is not type(value2):
             raise SearchError, 'cannot mix types in a query range'
@@ -229,13 +243,55 @@ class Fieldmap(object):
                 xapian.sortable_serialise(value2))
                 
         elif isinstance(value1, datetime):
-#            term = '%s%04d%02d%02d' % (prefix, v.year, v.month, v.day)
-#            strv = '%04d%02d%02d%02d%02d%02d' % (
-#                v.year, v.month, v.day, v.hour, v.minute, v.second)
-#           FIXME - helper terms?
+            return self._date_range_query(prefix, valnum, value1, value2)
+
+    @staticmethod
+    def _date_range_query(prefix, valnum, value1, value2):
+        """Construct a query for a datetime range using the year, month and
+        day helper terms added at index time. Value range checks are only
+        used for days which are partly inside the range.
+        
+        """
+        def value_range(v1, v2):
             return xapian.Query(xapian.Query.OP_VALUE_RANGE, valnum,
-                xapian.sortable_serialise(time.mktime(value1.timetuple())), 
-                xapian.sortable_serialise(time.mktime(value2.timetuple())))
+                xapian.sortable_serialise(time.mktime(v1.timetuple())), 
+                xapian.sortable_serialise(time.mktime(v2.timetuple())))
+
+        def day_term(d):
+            return '%s%04d%02d%02d' % (prefix, d.year, d.month, d.day)
+
+        def day_end(d):
+            return datetime(d.year, d.month, d.day, 23, 59, 59)
+
+        # whole days in the range
+        first = value1.date()
+        if (value1.hour, value1.minute, value1.second) != (0, 0, 0):
+            first += timedelta(1)
+        last = value2.date()
+        if (value2.hour, value2.minute, value2.second) != (23, 59, 59):
+            last -= timedelta(1)
+
+        if first > last:
+            # no whole days, so restrict the value check to the day(s)
+            terms = set([day_term(value1), day_term(value2)])
+            query = xapian.Query(xapian.Query.OP_FILTER,
+                value_range(value1, value2), 
+                xapian.Query(xapian.Query.OP_OR, list(terms)))
+        else:
+            subqs = [xapian.Query(t) for t in _date_terms(prefix, first, last)]
+            if value1.date() < first:
+                subqs.append(xapian.Query(xapian.Query.OP_FILTER,
+                    value_range(value1, day_end(value1)),
+                    xapian.Query(day_term(value1))))
+            if value2.date() > last:
+                subqs.append(xapian.Query(xapian.Query.OP_FILTER,
+                    value_range(datetime(value2.year, value2.month, 
+                                         value2.day), value2),
+                    xapian.Query(day_term(value2))))
+            query = xapian.Query(xapian.Query.OP_OR, subqs)
+
+        # helper terms should not affect the weights, like a value range
+        return xapian.Query(xapian.Query.OP_SCALE_WEIGHT, query, 0)
 
     @staticmethod
     def _combine(op, query1, query2):
@@ -299,6 +355,16 @@ class Fieldmap(object):
         
         """
         return _FlaxDocument(self._fieldmap, self.language)
+
+    def bulk_indexer(self, database, **kwargs):
+        """Return a BulkIndexer for adding many documents to a database.
+        
+        `database` is a xapian.WritableDatabase
+        
+        Other keyword arguments are passed to BulkIndexer.
+        
+        """
+        return BulkIndexer(self, database, **kwargs)
         
     @staticmethod
     def add_document(database, doc):
@@ -318,7 +384,8 @@ class Fieldmap(object):
             database.add_document(doc.get_xapian_doc())
 
     def search(self, database, query, startrank=0, maxitems=20, 
-               facet_fields=[], maxfacets=100, checkatleast=100):
+               facet_fields=[], maxfacets=100, checkatleast=100,
+               facet_ranges={}, facet_cache=None, sort_by=None, cursor=None):
         """Search a database, returning hits and facets.
         
         `database` is a xapian.Database.
@@ -330,17 +397,211 @@ class Fieldmap(object):
         `maxfacets` is the maximum number of facet values to return for 
             each facet field.
         `checkatleast` is the minimum number of documents to check
+        `facet_ranges` is a dict mapping numeric or date fieldnames to a list
+            of (low, high) ranges to count hits for (inclusive).
+        `facet_cache` is an optional cache.FacetCache. If the facets for
+            this query are cached, the match is run without collecting them.
+        `sort_by` is a fieldname or list of fieldnames to sort the hits by,
+            instead of by relevance. Prefix a fieldname with '-' to sort it
+            in descending order. Ties are returned in docid order.
+        `cursor` is the `cursor` attribute of the previous page of results
+            for the same query and `sort_by`. The next page is returned,
+            and `startrank` is ignored.
         
         Results are returned as a xapian.MSet, with an additional attribute
-        `facets` containing the facets collected as a dict.
+        `facets` containing the facets collected as a dict. For facet fields
+        this is a list of (value, count) pairs, most frequent first, and for
+        range fields a list of ((low, high), count) pairs in the order given.
+        Note that counts are taken from the documents checked by the match,
+        so may be lower than the true values unless `checkatleast` is at 
+        least the database size. With a cursor, facets only count the hits
+        after the cursor.
         
-        FIXME - how to use MatchDeciders, Sorters etc ?
+        If `sort_by` is set, the MSet also has a `cursor` attribute, which
+        is an opaque string for fetching the next page (or None if this is
+        the last page). This restricts the query to hits after the end of 
+        this page, so walking through many pages doesn't get slower and 
+        slower as it does when increasing `startrank`.
+        
+        FIXME - how to use MatchDeciders etc ?
         FIXME - stopwords?
 
         """
-        enq = xapian.Enquire(database)
+        return self._search(xapian.Enquire(database), database, query, 
+                            startrank, maxitems, facet_fields, maxfacets,
+                            checkatleast, facet_ranges, facet_cache, 
+                            sort_by, cursor)
+
+    def search_many(self, databases, queries, nthreads=4, **kwargs):
+        """Run many queries against several databases, yielding results as
+        they complete.
+        
+        `databases` is a list of xapian.Database objects, which must all use
+        this fieldmap.
+        `queries` is a list of xapian.Query objects, each of which is run
+            against each database.
+        `nthreads` is the maximum number of threads to use. Each database
+            is searched by one thread at a time, reusing one xapian.Enquire
+            for all of its queries.
+        
+        Other keyword arguments are passed to search() for each query.
+        
+        Yields (database index, query index, mset, seconds) tuples, where
+        `seconds` is the time taken by that query. If a search fails, the
+        exception is raised here once the results so far have been yielded.
+        
+        Xapian objects are not thread-safe, so the thread which searched an
+        mset's database waits until the next result is requested before
+        running its next query: use each mset before then (or once all the
+        results have been yielded).
+        
+        """
+        tasks = Queue.Queue()
+        for i in xrange(len(databases)):
+            tasks.put(i)
+        # each thread waits with at most one result on the queue
+        results = Queue.Queue()
+        stopped = threading.Event()
+
+        def worker():
+            while not stopped.isSet():
+                try:
+                    i = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                database = databases[i]
+                enq = xapian.Enquire(database)
+                for j, query in enumerate(queries):
+                    if stopped.isSet():
+                        return
+                    start = time.time()
+                    done = threading.Event()
+                    try:
+                        mset = self._search(enq, database, query, **kwargs)
+                    except Exception, e:
+                        results.put((i, j, None, e, done))
+                    else:
+                        results.put((i, j, mset, time.time() - start, done))
+                    done.wait()
+
+        threads = []
+        for n in xrange(min(nthreads, len(databases))):
+            t = threading.Thread(target=worker)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        error = None
+        try:
+            for n in xrange(len(databases) * len(queries)):
+                i, j, mset, elapsed, done = results.get()
+                try:
+                    if mset is None:
+                        error = error or elapsed
+                    else:
+                        yield i, j, mset, elapsed
+                finally:
+                    done.set()
+        finally:
+            # if the caller stopped early, release the waiting threads
+            stopped.set()
+            for t in threads:
+                while t.isAlive():
+                    try:
+                        results.get(timeout=0.1)[-1].set()
+                    except Queue.Empty:
+                        pass
+        if error is not None:
+            raise error
+
+    def _search(self, enq, database, query, startrank=0, maxitems=20,
+                facet_fields=[], maxfacets=100, checkatleast=100,
+                facet_ranges={}, facet_cache=None, sort_by=None, cursor=None):
+        """Implementation of search(), using an existing xapian.Enquire
+        for `database`.
+        
+        """
+        enq.clear_matchspies()
+        sort_slots = self._sort_slots(sort_by)
+        if sort_slots:
+            keymaker = _KeyMaker()
+            for valnum, reverse in sort_slots:
+                keymaker.add_value(valnum, reverse)
+            enq.set_sort_by_key(keymaker, False)
+        else:
+            enq.set_sort_by_relevance()
+        # cursors rely on ties being returned in ascending docid order
+        enq.set_docid_order(xapian.Enquire.ASCENDING)
+
+        decider = None
+        if cursor is not None:
+            if not sort_slots:
+                raise SearchError, 'cursor requires sort_by'
+            cursor_values, cursor_docid = _decode_cursor(cursor, sort_slots)
+            startrank = 0
+            # the value range filter (which includes the cursor's own value)
+            # skips most hits before the cursor, and the decider the rest 
+            # (with the same primary sort value)
+            valnum, reverse = sort_slots[0]
+            query = xapian.Query(xapian.Query.OP_FILTER, query, xapian.Query(
+                xapian.Query.OP_VALUE_LE if reverse else 
+                xapian.Query.OP_VALUE_GE, valnum, cursor_values[0]))
+            decider = _CursorDecider(sort_slots, cursor_values, cursor_docid)
+
         enq.set_query(query)
 
+        facets = None
+        if facet_cache is not None and (facet_fields or facet_ranges):
+            cache_key = (str(query), tuple(facet_fields), maxfacets,
+                         checkatleast, repr(sorted(facet_ranges.items())),
+                         cursor)
+            facets = facet_cache.get(database, cache_key)
+        else:
+            cache_key = None
+
+        if facets is not None:
+            mset = enq.get_mset(startrank, maxitems, 0, None, decider)
+            mset.facets = facets
+        else:
+            mset = self._search_facets(enq, startrank, maxitems, facet_fields,
+                                       maxfacets, checkatleast, facet_ranges,
+                                       decider)
+            if cache_key is not None:
+                facet_cache.put(database, cache_key, mset.facets)
+
+        mset.cursor = None
+        if sort_slots and maxitems and mset.size() == maxitems:
+            mset.cursor = _next_cursor(mset, sort_slots)
+        return mset
+
+    def _sort_slots(self, sort_by):
+        """Return a list of (value_number, reverse) for the sort fields.
+        
+        """
+        if not sort_by:
+            return []
+        if isinstance(sort_by, basestring):
+            sort_by = [sort_by]
+        if _KeyMaker is None:
+            raise SearchError, 'sorting requires xapian.MultiValueKeyMaker'
+
+        slots = []
+        for field in sort_by:
+            reverse = field.startswith('-')
+            if reverse:
+                field = field[1:]
+            try:
+                slots.append((self._fieldmap[field][1], reverse))
+            except KeyError:
+                raise SearchError, 'fieldname %s not in fieldmap' % field
+        return slots
+
+    def _search_facets(self, enq, startrank, maxitems, facet_fields, 
+                       maxfacets, checkatleast, facet_ranges, decider=None):
+        """Run the match, collecting facets into the `facets` attribute of 
+        the MSet.
+        
+        """
         # set up matchspies for facets
         matchspies = []
         for field in facet_fields:        
@@ -348,34 +609,160 @@ class Fieldmap(object):
             enq.add_matchspy(ms)
             matchspies.append((field, ms))
 
-        mset = enq.get_mset(startrank, maxitems, checkatleast)
+        rangespies = []
+        for field, ranges in facet_ranges.iteritems():
+            ms = xapian.ValueCountMatchSpy(self._fieldmap[field][1])
+            enq.add_matchspy(ms)
+            rangespies.append((field, ranges, ms))
+
+        mset = enq.get_mset(startrank, maxitems, checkatleast, None, decider)
     
         # collect facets
         facets = {}
         if _multivalues:
             for field, ms in matchspies:
-                facets[field] = [x[0] for x in ms.get_top_values(maxfacets)]
+                facets[field] = [(x[0], x[1]) for x in 
+                                 ms.get_top_values(maxfacets)]
         else:
             for field, ms in matchspies:
-                facets[field] = [x.term for x in ms.top_values(maxfacets)]
-        
+                facets[field] = [(x.term, x.termfreq) for x in
+                                 ms.top_values(maxfacets)]
+
+        for field, ranges, ms in rangespies:
+            facets[field] = self._count_ranges(ranges, ms)
+
         # this is ok in Python, but what about other languages?
         mset.facets = facets
         return mset
+
+    @staticmethod
+    def _count_ranges(ranges, matchspy):
+        """Count the values collected by a ValueCountMatchSpy into ranges.
         
+        """
+        bounds = []
+        for low, high in ranges:
+            if isinstance(low, datetime):
+                low = time.mktime(low.timetuple())
+            if isinstance(high, datetime):
+                high = time.mktime(high.timetuple())
+            bounds.append((low, high))
+
+        counts = [0] * len(bounds)
+        if hasattr(matchspy, 'values'):
+            values = ((x.term, x.termfreq) for x in matchspy.values())
+        else:
+            values = matchspy.get_top_values(matchspy.get_total())
+
+        for value, freq in values:
+            v = xapian.sortable_unserialise(value)
+            for i, (low, high) in enumerate(bounds):
+                if low <= v <= high:
+                    counts[i] += freq
+
+        return zip(ranges, counts)
+        
+
+def _encode_cursor(values, docid):
+    return base64.urlsafe_b64encode(json.dumps(
+        [[base64.b64encode(value) for value in values], docid]))
+
+def _decode_cursor(cursor, sort_slots):
+    """Return the sort values and the docid of the last hit returned, from
+    a cursor.
+    
+    """
+    try:
+        values, docid = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        values = [base64.b64decode(value) for value in values]
+        docid = int(docid)
+    except (TypeError, ValueError):
+        raise SearchError, 'invalid cursor'
+    if len(values) != len(sort_slots):
+        raise SearchError, 'cursor does not match sort_by'
+    return values, docid
+
+def _next_cursor(mset, sort_slots):
+    """Return a cursor for the page after `mset`.
+    
+    The cursor holds the values of all the sort keys of the last hit, and
+    its docid (as ties are returned in docid order), so the next page can
+    be restricted to the hits after it, however many hits share its values.
+    
+    """
+    last = mset[mset.size() - 1]
+    doc = last.document
+    return _encode_cursor([doc.get_value(valnum) 
+                           for valnum, reverse in sort_slots], last.docid)
+
+class _CursorDecider(xapian.MatchDecider):
+    """Match decider accepting only the documents after a cursor, in the 
+    order of the sort keys and then docid.
+    
+    """
+    
+    def __init__(self, sort_slots, values, docid):
+        xapian.MatchDecider.__init__(self)
+        self._keys = zip(sort_slots, values)
+        self._docid = docid
+    
+    def __call__(self, doc):
+        for (valnum, reverse), cursor_value in self._keys:
+            value = doc.get_value(valnum)
+            if value != cursor_value:
+                return (value < cursor_value) == reverse
+        return doc.get_docid() > self._docid
+
+def _date_terms(prefix, first, last):
+    """Return the fewest year, month and day helper terms which cover the 
+    dates from `first` to `last` (inclusive).
+    
+    """
+    terms = []
+    d = first
+    while d <= last:
+        if d.month == 1 and d.day == 1 and date(d.year, 12, 31) <= last:
+            terms.append('%s%04d' % (prefix, d.year))
+            d = date(d.year + 1, 1, 1)
+            continue
+
+        if d.month == 12:
+            next_month = date(d.year + 1, 1, 1)
+        else:
+            next_month = date(d.year, d.month + 1, 1)
+        if d.day == 1 and next_month - timedelta(1) <= last:
+            terms.append('%s%04d%02d' % (prefix, d.year, d.month))
+            d = next_month
+        else:
+            terms.append('%s%04d%02d%02d' % (prefix, d.year, d.month, d.day))
+            d += timedelta(1)
+
+    return terms
+
 
 class _FlaxDocument(object):
     """A wrapper for Xapian documents with convenience functions for indexing.
     
     """
 
-    def __init__(self, fieldmap, language):
+    def __init__(self, fieldmap, language, termgen=None):
         self._fieldmap = fieldmap
         self._doc = xapian.Document()
-        self._stemmer = xapian.Stem(language) if language else None
+        self._language = language
+        self._termgen = termgen
+        self._scratch = None
         self._facets = {}
         self._docid = None
         self.database = None
+        self.size = 0
+
+    def _get_termgen(self):
+        # one TermGenerator per document, unless shared by a BulkIndexer
+        if self._termgen is None:
+            self._termgen = xapian.TermGenerator()
+            if self._language:
+                self._termgen.set_stemmer(xapian.Stem(self._language))
+        return self._termgen
 
     @property
     def fieldmap(self):
@@ -399,6 +786,10 @@ class _FlaxDocument(object):
         `isdocid` uses this field value as a docid (filter fields only).
             False by default.
         
+        Only one number or date is stored in the value of a filter field, so
+        if several are indexed the last is used for sorting, range facets
+        and range queries (but see range_query for dates).
+        
         """
 
         if not value:
@@ -413,9 +804,7 @@ class _FlaxDocument(object):
         prefix, valnum, isfilter = self._fieldmap[fieldname]
     
         if not isfilter or search_default or spelling:
-            termgen = xapian.TermGenerator()
-            if self._stemmer:
-                termgen.set_stemmer(self._stemmer)
+            termgen = self._get_termgen()
         
         if isfilter:
             if isinstance(value, basestring):
@@ -441,9 +830,9 @@ class _FlaxDocument(object):
                     self._docid = term
                     
             elif isinstance(value, float) or isinstance(value, int):
+                # facets are counted from the value (see facet_ranges)
                 self._doc.add_value(valnum, xapian.sortable_serialise(value))
                 # FIXME - helper terms?
-                # FIXME - numeric facets
 
                 if isdocid:
                     self._docid = '%s%s' % (prefix, value)
@@ -463,35 +852,77 @@ class _FlaxDocument(object):
                 if isdocid:
                     raise IndexingError, 'cannot use date as docid'
         else:                
-            if isinstance(value, str):
-                termgen.set_document(self._doc)
-                termgen.index_text(value, weight, prefix)
-            else:
+            if not isinstance(value, str):
                 raise IndexingError, 'non-filter field requires string value'
 
             if isdocid:
                 raise IndexingError, 'cannot use non-filter field as docid'
 
-        # spelling only works for prefix-less terms
-        if search_default or spelling:
-            if search_default:
+            self.size += len(value)
+            if not (search_default or spelling):
                 termgen.set_document(self._doc)
-            else:
-                termgen.set_document(xapian.Document())  # dummy document
+                termgen.set_flags(0)
+                termgen.index_text(value, weight, prefix)
+                return
 
-            if spelling:
-                if self.database is None:
-                    raise IndexingError, 'spelling requires document.database to be set'
-                termgen.set_database(self.database)
-                termgen.set_flags(termgen.FLAG_SPELLING)
+            # a TermGenerator adds one prefix per pass, and spelling only
+            # works for prefix-less terms, so the value is indexed once
+            # without a prefix and the field terms are derived from that
+            self._index_unprefixed(termgen, value, search_default, spelling)
+            self._add_prefixed(prefix, weight)
+            return
 
-            termgen.index_text(value)
+        if search_default or spelling:
+            self._index_unprefixed(termgen, value, search_default, spelling)
+
+    def _index_unprefixed(self, termgen, value, search_default, spelling):
+        """Index `value` without a prefix, adding spellings if `spelling` is
+        True. The terms are added to the document if `search_default` is 
+        True, and are left in the scratch document (reused for all values)
+        in any case.
+        
+        """
+        if self._scratch is None:
+            self._scratch = xapian.Document()
+        else:
+            self._scratch.clear_terms()
+        termgen.set_document(self._scratch)
+
+        if spelling:
+            if self.database is None:
+                raise IndexingError, 'spelling requires document.database to be set'
+            termgen.set_database(self.database)
+            termgen.set_flags(termgen.FLAG_SPELLING)
+        else:
+            termgen.set_flags(0)
+
+        termgen.index_text(value)
+        if search_default:
+            self._add_prefixed('', 1)
+
+    def _add_prefixed(self, prefix, weight):
+        """Add the terms in the scratch document to the document with 
+        `prefix`, and the WDF multiplied by `weight`. This gives the same
+        terms as indexing the value again with that prefix and weight.
+        
+        """
+        for item in self._scratch.termlist():
+            term = item.term
+            # terms are lower case, so only stemmed terms start with 'Z'
+            if term.startswith('Z'):
+                self._doc.add_term('Z%s%s' % (prefix, term[1:]), 
+                                   item.wdf * weight)
+            else:
+                term = prefix + term
+                for pos in item.positer:
+                    self._doc.add_posting(term, pos, weight)
 
     def set_data(self, data):
         """Set the document data. This does no indexing.
         
         """
         self._doc.set_data(data)
+        self.size += len(data)
     
     def get_xapian_doc(self):
         """Return a xapian.Document for this Flax document.
@@ -507,6 +938,118 @@ class _FlaxDocument(object):
         
         return self._doc
 
+
+class BulkIndexer(object):
+    """Helper for adding many documents to a database efficiently.
+    
+    All documents share a single TermGenerator and stemmer, and changes are
+    committed in batches. Use Fieldmap.bulk_indexer() to create one:
+    
+        indexer = fieldmap.bulk_indexer(database)
+        for record in records:
+            doc = indexer.document()
+            doc.index(...)
+            indexer.add(doc)
+        indexer.close()
+    
+    Documents should be added in the order they are created, as the
+    TermGenerator is not reset between them.
+    
+    """
+    
+    def __init__(self, fieldmap, database, batch_docs=10000,
+                 batch_bytes=64 << 20, on_commit=None, verbose=False):
+        """Init a new bulk indexer.
+        
+        `fieldmap` is the Fieldmap for the database.
+        `database` is a xapian.WritableDatabase
+        `batch_docs` is the number of documents to add between commits.
+        `batch_bytes` is the approximate size of the indexed text and data 
+            to add between commits.
+        `on_commit` is an optional callable, which is passed this object
+            before each commit (e.g. to set database metadata).
+        `verbose` prints indexing statistics on each commit if True.
+        
+        """
+        self.fieldmap = fieldmap
+        self.database = database
+        self.batch_docs = batch_docs
+        self.batch_bytes = batch_bytes
+        self.on_commit = on_commit
+        self.verbose = verbose
+
+        self._termgen = xapian.TermGenerator()
+        if fieldmap.language:
+            self._termgen.set_stemmer(xapian.Stem(fieldmap.language))
+
+        self.doccount = 0
+        self.bytes = 0
+        self.commits = 0
+        self._batch_docs = 0
+        self._batch_bytes = 0
+        self._start = time.time()
+
+    def document(self):
+        """Return a new Flax document which shares this indexer's
+        TermGenerator, and has its database set for spelling.
+        
+        """
+        doc = _FlaxDocument(self.fieldmap._fieldmap, self.fieldmap.language,
+                            self._termgen)
+        doc.database = self.database
+        return doc
+
+    def add(self, doc):
+        """Add a document to the database (see Fieldmap.add_document), 
+        committing if the batch limits have been reached.
+        
+        """
+        Fieldmap.add_document(self.database, doc)
+        self.doccount += 1
+        self.bytes += doc.size
+        self._batch_docs += 1
+        self._batch_bytes += doc.size
+        if (self._batch_docs >= self.batch_docs or 
+            self._batch_bytes >= self.batch_bytes):
+            self.commit()
+
+    def commit(self):
+        """Commit any pending changes to the database.
+        
+        """
+        if self.on_commit:
+            self.on_commit(self)
+        self.database.flush()
+        self.commits += 1
+        self._batch_docs = 0
+        self._batch_bytes = 0
+        if self.verbose:
+            print self
+
+    def close(self):
+        """Commit any pending changes. The database is not closed.
+        
+        """
+        self.commit()
+
+    @property
+    def elapsed(self):
+        return time.time() - self._start
+
+    @property
+    def rate(self):
+        """Documents indexed per second since the indexer was created.
+        
+        """
+        elapsed = self.elapsed
+        return self.doccount / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return 'BulkIndexer: %d docs (%.1f MB) in %.1fs, %.1f docs/s, %d commits' % (
+            self.doccount, self.bytes / 1048576.0, self.elapsed, self.rate,
+            self.commits)
+
+
 def run_tests():    
     """Run some tests. These look at internal values, so are not really
     a good example of how to use fieldmaps.
@@ -522,6 +1065,7 @@ def run_tests():
     fm.setfield('bar', True)        # filter field
     fm.setfield('spam', False)
     fm.setfield('eggs', True)
+    fm.setfield('ham', True)        # numeric filter field
 
     fm.save(db)                     # save fieldmap to database
     
@@ -581,9 +1125,146 @@ def run_tests():
     mset = fm.search(db, q1, facet_fields=['bar'])
     assert mset.get_matches_estimated() == 1
     if _multivalues:
-        assert mset.facets['bar'] == ['chips', 'crisps']
+        assert mset.facets['bar'] == [('chips', 1), ('crisps', 1)]
     else:
-        assert mset.facets['bar'] == ['chips']
+        assert mset.facets['bar'] == [('chips', 1)]
+
+    # TEST - date range facets
+    ranges = [(datetime(2010, 1, 1), datetime(2010, 12, 31)),
+              (datetime(2011, 1, 1), datetime(2011, 12, 31))]
+    mset = fm.search(db, q1, facet_ranges={'eggs': ranges})
+    assert mset.facets['eggs'] == [(ranges[0], 1), (ranges[1], 0)]
+
+    # TEST - date ranges use helper terms
+    assert _date_terms('XD', date(2009, 12, 30), date(2012, 3, 2)) == [
+        'XD20091230', 'XD20091231', 'XD2010', 'XD2011', 'XD201201',
+        'XD201202', 'XD20120301', 'XD20120302']
+    q3 = fm.range_query('eggs', datetime(2009, 12, 31, 13), 
+                        datetime(2010, 3, 1, 12))
+    assert 'XD201002' in str(q3)
+    assert fm.search(db, q3).get_matches_estimated() == 1
+    q3 = fm.range_query('eggs', datetime(2010, 2, 3, 11), 
+                        datetime(2010, 2, 3, 13))
+    assert fm.search(db, q3).get_matches_estimated() == 1
+    q3 = fm.range_query('eggs', datetime(2010, 2, 3, 13), 
+                        datetime(2010, 2, 4, 0))
+    assert fm.search(db, q3).get_matches_estimated() == 0
+
+    # TEST - date ranges with several dates in a field: the helper terms
+    # match any date, but the partly covered days only the last date
+    mdb = xapian.inmemory_open()
+    mdoc = fm.document()
+    mdoc.index('eggs', datetime(2010, 2, 3, 12))
+    mdoc.index('eggs', datetime(2010, 5, 6, 12))
+    fm.add_document(mdb, mdoc)
+    for start, end, count in (
+        ((2010, 2, 3), (2010, 2, 3, 23, 59, 59), 1),
+        ((2010, 2, 3, 11), (2010, 2, 3, 13), 0),
+        ((2010, 5, 6, 11), (2010, 5, 6, 13), 1)):
+        q3 = fm.range_query('eggs', datetime(*start), datetime(*end))
+        assert fm.search(mdb, q3).get_matches_estimated() == count, (start, end)
+
+    # TEST - sorting and cursors
+    sdb = xapian.inmemory_open()
+    for i in xrange(10):
+        sdoc = fm.document()
+        sdoc.index('bar', 'chips')
+        sdoc.index('eggs', datetime(2010, 1, 1 + i / 3))
+        sdoc.index('ham', i + 1)
+        fm.add_document(sdb, sdoc)
+    allq = fm.query('bar', 'chips')
+    mset = fm.search(sdb, allq, maxitems=10, sort_by='-eggs')
+    expected = [x.docid for x in mset]
+    assert expected == [10, 7, 8, 9, 4, 5, 6, 1, 2, 3]
+    docids = []
+    cursor = None
+    while True:
+        mset = fm.search(sdb, allq, maxitems=4, sort_by=['-eggs', 'bar'],
+                         cursor=cursor)
+        docids.extend([x.docid for x in mset])
+        cursor = mset.cursor
+        if cursor is None: 
+            break
+    assert docids == expected, docids
+
+    # TEST - numeric range facets, which only count the hits after a cursor
+    ranges = [(1, 5), (6, 10), (11, 20)]
+    mset = fm.search(sdb, allq, maxitems=4, sort_by='ham',
+                     facet_ranges={'ham': ranges})
+    assert mset.facets['ham'] == [((1, 5), 5), ((6, 10), 5), ((11, 20), 0)]
+    mset = fm.search(sdb, allq, maxitems=4, sort_by='ham',
+                     facet_ranges={'ham': ranges}, cursor=mset.cursor)
+    assert [x.docid for x in mset] == [5, 6, 7, 8]
+    assert mset.facets['ham'] == [((1, 5), 1), ((6, 10), 5), ((11, 20), 0)]
+
+    # TEST - the value range filter used by cursors includes its limit
+    limit = xapian.sortable_serialise(
+        time.mktime(datetime(2010, 1, 2).timetuple()))
+    for op, count in ((xapian.Query.OP_VALUE_GE, 7), 
+                      (xapian.Query.OP_VALUE_LE, 6)):
+        vq = xapian.Query(xapian.Query.OP_FILTER, allq, 
+                          xapian.Query(op, fm['eggs'][1], limit))
+        assert fm.search(sdb, vq, maxitems=10).get_matches_estimated() == count
+
+    # TEST - cursors with ties on the primary and secondary sort keys
+    tdb = xapian.inmemory_open()
+    for i in xrange(9):
+        tdoc = fm.document()
+        tdoc.index('bar', 'ab'[i % 2])
+        tdoc.index('eggs', datetime(2010, 1, 1))
+        fm.add_document(tdb, tdoc)
+    tq = fm.OR(fm.query('bar', 'a'), fm.query('bar', 'b'))
+    expected = [2, 4, 6, 8, 1, 3, 5, 7, 9]
+    for pagesize in (1, 2, 4):
+        docids = []
+        cursor = None
+        while True:
+            mset = fm.search(tdb, tq, maxitems=pagesize,
+                             sort_by=['eggs', '-bar'], cursor=cursor)
+            docids.extend([x.docid for x in mset])
+            cursor = mset.cursor
+            if cursor is None:
+                break
+        assert docids == expected, (pagesize, docids)
+
+    # TEST - facet counts over several documents, and maxfacets
+    mset = fm.search(tdb, tq, maxitems=10, facet_fields=['bar'])
+    assert mset.facets['bar'] == [('a', 5), ('b', 4)]
+    mset = fm.search(tdb, tq, maxitems=10, facet_fields=['bar'], maxfacets=1)
+    assert mset.facets['bar'] == [('a', 5)]
+
+    # TEST - many queries against many databases
+    results = list(fm.search_many([db, sdb], [q1, allq], facet_fields=['bar']))
+    assert len(results) == 4
+    counts = dict(((i, j), mset.get_matches_estimated()) 
+                  for i, j, mset, elapsed in results)
+    assert counts == {(0, 0): 1, (0, 1): 1, (1, 0): 0, (1, 1): 10}
+
+    # TEST - cached facets
+    from cache import FacetCache
+    facet_cache = FacetCache()
+    for i in xrange(2):
+        mset = fm.search(db, q1, facet_fields=['bar'], facet_cache=facet_cache)
+        assert mset.facets['bar'][0] == ('chips', 1)
+    assert facet_cache.hits == 1
+    
+    # TEST - cached facets are kept per query and facet fields, and discarded
+    # when the database changes
+    mset = fm.search(db, q1, facet_ranges={'ham': ranges}, 
+                     facet_cache=facet_cache)
+    assert 'bar' not in mset.facets
+    assert (facet_cache.hits, facet_cache.misses) == (1, 2)
+    for i in xrange(2):
+        mset = fm.search(sdb, allq, facet_fields=['bar'], 
+                         facet_cache=facet_cache)
+        assert mset.facets['bar'] == [('chips', 10)]
+    assert (facet_cache.hits, facet_cache.misses) == (2, 3)
+    sdoc = fm.document()
+    sdoc.index('bar', 'chips')
+    fm.add_document(sdb, sdoc)
+    mset = fm.search(sdb, allq, facet_fields=['bar'], facet_cache=facet_cache)
+    assert mset.facets['bar'] == [('chips', 11)]
+    assert (facet_cache.hits, facet_cache.misses) == (2, 4)
 
     # TEST - another query test with a query branch weight adjustment    
     q2 = fm.AND(fm.query('bar', 'chips'), fm.query('bar', 'chaps', 0.5))
@@ -593,6 +1274,25 @@ def run_tests():
     spellings = [t.term for t in db.spellings()]
     assert spellings == ['cheese', 'fondue', 'gruyere']
     
+    # TEST - bulk indexer gives the same terms as a plain document
+    indexer = fm.bulk_indexer(db, batch_docs=2)
+    for i in xrange(3):
+        bdoc = indexer.document()
+        bdoc.index('foo', 'gruyere cheese fondue', search_default=True, spelling=True)
+        bdoc.index('spam', 'carrot cake', spelling=True)
+        bdoc.index('eggs', mydate)
+        bterms = [t.term for t in bdoc.get_xapian_doc()]
+        for test in ['XAcheese', 'ZXAchees', 'XCcake', 'Zgruyer',
+                     'gruyere', 'XD20100203']:
+            assert test in bterms, 'term %s is missing' % test
+        assert 'carrot' not in bterms
+        indexer.add(bdoc)
+    assert indexer.commits == 1
+    indexer.close()
+    assert db.get_doccount() == 4
+    assert [t.term for t in db.spellings()] == [
+        'cake', 'carrot', 'cheese', 'fondue', 'gruyere']
+    
     print 'all tests passed'
 
 if __name__ == '__main__':
@@ -0,0 +1,334 @@
+# Copyright (c) 2010 Lemur Consulting Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+r"""Parallel indexing for Flax core.
+
+Records are split across a number of worker processes, each of which indexes
+into its own shard database using the same fieldmap and actions. The shards
+are then compacted into a single database, or listed in a Xapian stub
+database file so that they can be searched as one:
+
+    indexer = ParallelIndexer('/path/to/db', fieldmap, 'my.actions',
+                              handler=my_handler, nworkers=4)
+    indexer.index(records)
+    indexer.merge()
+
+`handler(record, doc, actions)` is called in the worker processes to index
+each record into a Flax document, so it (and the records) must be picklable.
+The default handler expects each record to be a dict mapping the external
+keys of the actions to values (or lists of values), with the document data
+stored under the key 'data'.
+
+This is intended for full rebuilds - the target database is replaced.
+
+"""
+
+import itertools
+import os
+import shutil
+import subprocess
+import traceback
+import multiprocessing
+import Queue
+import xapian
+
+import actions as flax_actions
+from errors import IndexingError
+
+# the number of docid terms sent to the parent in each message
+_docids_per_message = 10000
+
+
+def index_mapping(record, doc, actions):
+    """The default record handler.
+
+    `record` is a dict mapping external keys to a value or list of values.
+
+    """
+    for act in actions:
+        values = record.get(act.external_key)
+        if values is None:
+            continue
+        if not isinstance(values, (list, tuple)):
+            values = (values,)
+        for value in values:
+            act.action(act.fieldname, value, doc)
+
+    data = record.get('data')
+    if data is not None:
+        doc.set_data(data)
+
+
+def _worker(shard_path, fieldmap, actions, handler, tasks, results,
+            indexer_kwargs):
+    """Index chunks of records from the `tasks` queue into a new shard,
+    reporting the docid terms used by each record (for resolving docids
+    duplicated between shards) to the `results` queue.
+
+    The docid terms are sent in several messages (so that a large shard's
+    are not pickled as one), followed by (shard_path, None, None), or
+    (shard_path, None, traceback) if indexing failed.
+
+    """
+    try:
+        if isinstance(actions, basestring):
+            actions = flax_actions.parse_actions(actions)
+        db = xapian.WritableDatabase(shard_path,
+                                     xapian.DB_CREATE_OR_OVERWRITE)
+        fieldmap.save(db)
+        indexer = fieldmap.bulk_indexer(db, **indexer_kwargs)
+        docids = {}
+
+        while True:
+            chunk = tasks.get()
+            if chunk is None:
+                break
+
+            seq, records = chunk
+            for record in records:
+                doc = indexer.document()
+                handler(record, doc, actions)
+                if doc._docid is not None:
+                    docids[doc._docid] = seq
+                indexer.add(doc)
+                seq += 1
+
+        indexer.close()
+        items = docids.iteritems()
+        while True:
+            part = dict(itertools.islice(items, _docids_per_message))
+            if not part:
+                break
+            results.put((shard_path, part, None))
+        results.put((shard_path, None, None))
+    except Exception:
+        results.put((shard_path, None, traceback.format_exc()))
+
+
+class ParallelIndexer(object):
+    """Index records into shards using several processes, and merge them.
+
+    """
+
+    def __init__(self, db_path, fieldmap, actions, handler=index_mapping,
+                 nworkers=None, chunk_size=100, **indexer_kwargs):
+        """Init a new parallel indexer.
+
+        `db_path` is the path of the final database.
+        `fieldmap` is the Fieldmap to use for all shards.
+        `actions` is a list of FieldAction objects or the path of an actions
+            file (see actions.parse_actions), or anything else the handler
+            takes (such as an actions.ActionPlan).
+        `handler` indexes a record into a document (see index_mapping).
+        `nworkers` is the number of worker processes (defaults to the number
+            of CPUs).
+        `chunk_size` is the number of records sent to a worker at once.
+
+        Other keyword arguments are passed to the BulkIndexer in each worker.
+
+        """
+        self.db_path = db_path
+        self.fieldmap = fieldmap
+        self.actions = actions
+        self.handler = handler
+        self.nworkers = nworkers or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.indexer_kwargs = indexer_kwargs
+        self.shards = ['%s.shard%d' % (db_path, i)
+                       for i in xrange(self.nworkers)]
+        self.doccount = 0
+        self.duplicates = 0
+
+    def index(self, records):
+        """Index an iterable of records into the shards, returning when all
+        workers have finished.
+
+        Documents with the same docid in different shards are resolved so
+        that the most recent record wins, as it would when indexing into a
+        single database.
+
+        """
+        tasks = multiprocessing.Queue(2 * self.nworkers)
+        results = multiprocessing.Queue()
+        workers = []
+        for path in self.shards:
+            p = multiprocessing.Process(target=_worker, args=(
+                path, self.fieldmap, self.actions, self.handler, tasks,
+                results, self.indexer_kwargs))
+            p.start()
+            workers.append(p)
+
+        try:
+            seq = 0
+            chunk = []
+            for record in records:
+                chunk.append(record)
+                if len(chunk) == self.chunk_size:
+                    if not _put(tasks, (seq, chunk), workers):
+                        break
+                    seq += len(chunk)
+                    chunk = []
+            else:
+                if chunk:
+                    _put(tasks, (seq, chunk), workers)
+        finally:
+            for p in workers:
+                if not _put(tasks, None, workers):
+                    break
+
+        shard_docids = {}
+        errors = []
+        reported = set()
+        while len(reported) < len(workers):
+            try:
+                path, docids, error = results.get(timeout=0.5)
+            except Queue.Empty:
+                # a worker which died without reporting (e.g. killed) would
+                # otherwise be waited for forever
+                dead = [(path, p) for path, p in zip(self.shards, workers)
+                        if path not in reported and not p.is_alive()]
+                if dead and results.empty():
+                    for path, p in dead:
+                        reported.add(path)
+                        errors.append('worker for %s exited with code %s' % (
+                            path, p.exitcode))
+                continue
+            if docids is not None:
+                shard_docids.setdefault(path, {}).update(docids)
+                continue
+            reported.add(path)
+            if error:
+                errors.append(error)
+        # tasks may be left on the queue if workers failed
+        tasks.cancel_join_thread()
+        for p in workers:
+            p.join()
+
+        if errors:
+            raise IndexingError, 'worker failed:\n%s' % '\n'.join(errors)
+
+        self._resolve_docids(shard_docids)
+        # documents replaced within a shard were counted by its indexer
+        self.doccount = 0
+        for path in self.shards:
+            self.doccount += xapian.Database(path).get_doccount()
+
+    def _resolve_docids(self, shard_docids):
+        # find the shard with the most recent record for each docid
+        latest = {}
+        for path, docids in shard_docids.iteritems():
+            for term, seq in docids.iteritems():
+                if term not in latest or latest[term][0] < seq:
+                    latest[term] = (seq, path)
+
+        # delete superseded documents from the other shards
+        for path, docids in shard_docids.iteritems():
+            stale = [term for term in docids if latest[term][1] != path]
+            if stale:
+                db = xapian.WritableDatabase(path, xapian.DB_OPEN)
+                for term in stale:
+                    db.delete_document(term)
+                db.flush()
+                self.duplicates += len(stale)
+
+    def merge(self, compact=True):
+        """Combine the shards into the final database.
+
+        If `compact` is True, the shards are compacted into a single database
+        at db_path and deleted. Otherwise a stub database file is written at
+        db_path listing the shards, which can be opened as a normal database
+        for searching (but not for writing).
+
+        The new database is built beside db_path and renamed over it, so if
+        compaction fails any existing database and the shards are left in
+        place.
+
+        """
+        tmp_path = self.db_path + '.tmp'
+        _remove(tmp_path)
+        try:
+            if compact:
+                _compact(self.shards, tmp_path)
+            else:
+                f = open(tmp_path, 'w')
+                try:
+                    for path in self.shards:
+                        f.write('auto %s\n' % os.path.abspath(path))
+                finally:
+                    f.close()
+        except:
+            _remove(tmp_path)
+            raise
+
+        _remove(self.db_path)
+        os.rename(tmp_path, self.db_path)
+        if compact:
+            for path in self.shards:
+                shutil.rmtree(path)
+
+    def __str__(self):
+        return 'ParallelIndexer: %d docs in %d shards (%d duplicates)' % (
+            self.doccount, len(self.shards), self.duplicates)
+
+
+def _remove(path):
+    """Remove a database directory or stub file, if it exists.
+
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.unlink(path)
+
+
+def _put(tasks, item, workers):
+    """Put an item on the (bounded) tasks queue, returning False without
+    putting it if all the workers have exited.
+
+    """
+    while True:
+        try:
+            tasks.put(item, timeout=0.5)
+            return True
+        except Queue.Full:
+            if not [p for p in workers if p.is_alive()]:
+                return False
+
+
+def _compact(sources, dest):
+    """Compact the source databases into a new database at `dest`.
+
+    Uses the Xapian API if available (1.4 or 1.2), or xapian-compact.
+
+    """
+    if hasattr(xapian.Database, 'compact'):
+        db = xapian.Database()
+        for path in sources:
+            db.add_database(xapian.Database(path))
+        db.compact(dest)
+    elif hasattr(xapian, 'Compactor'):
+        compactor = xapian.Compactor()
+        for path in sources:
+            compactor.add_source(path)
+        compactor.set_destdir(dest)
+        compactor.compact()
+    else:
+        if subprocess.call(['xapian-compact'] + list(sources) + [dest]):
+            raise IndexingError, 'xapian-compact failed'
@@ -0,0 +1,373 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Module including a pool of persistent HTTP connections for urllib2.
+
+    urllib2 opens a new connection for every request. KeepAliveHandler keeps
+    connections open between requests to the same host, in a ConnectionPool
+    which limits the number of idle connections and their age, and caches
+    host name lookups::
+
+        connections = ConnectionPool()
+        opener = build_opener(KeepAliveHandler(connections))
+        response = opener.open("http://test/")
+        ...
+        print connections.stats()
+
+    A connection is returned to the pool when its response has been read to
+    the end (or when a short response is closed early). Only http URLs are
+    handled; https is left to the default urllib2 handler.
+"""
+
+import socket
+from httplib import HTTPConnection, HTTPException
+from urllib2 import HTTPHandler, URLError, addinfourl
+from cStringIO import StringIO
+from threading import Lock
+from time import time
+
+
+class _PooledConnection (HTTPConnection):
+    """ An HTTP connection which looks up its host using the pool's DNS cache,
+        and records when it was created and how many requests it has made.
+    """
+
+    def __init__(self, host, pool, timeout):
+        HTTPConnection.__init__(self, host, timeout=timeout)
+        self.pool = pool
+        self.created = time()
+        self.last_used = self.created
+        self.requests = 0
+
+    def connect(self):
+        t = time()
+        address = self.pool.resolve(self.host, self.port)
+        self.sock = socket.create_connection(address, self.timeout)
+        self.pool._connected(time() - t)
+
+
+class _PooledResponse (object):
+    """ Socket-like wrapper for an HTTP response, returning the connection to
+        the pool when the response has been read.
+    """
+
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+
+    def recv(self, amt):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._conn is None:
+            return
+        response = self._response
+        length = response.length
+        if not response.isclosed() and length is not None and \
+           length <= self._pool.drain_limit:
+            try:
+                response.read()
+            except (socket.error, HTTPException):
+                pass
+        if response.isclosed():
+            self._release()
+        else:
+            self._conn.close()
+            self._conn = None
+
+    def _release(self):
+        if self._conn is None:
+            return
+        if self._response.will_close:
+            self._conn.close()
+        else:
+            self._pool.put(self._key, self._conn)
+        self._conn = None
+
+
+class ConnectionPool (object):
+    """ Pool of idle HTTP connections, keyed by host (and port).
+
+        Also caches host name lookups, and keeps statistics (see stats()).
+        Calls are synchronized, so one pool may be used by many threads.
+    """
+
+    max_dns = 100000 # the DNS cache is cleared when it reaches this size
+
+    def __init__(self, max_idle=2, max_idle_total=1000, idle_timeout=15,
+                 max_age=300, max_requests=100, dns_ttl=300,
+                 drain_limit=65536):
+        """ Create a connection pool.
+
+            max_idle is the maximum number of idle connections kept per host.
+            max_idle_total is the maximum number of idle connections kept.
+            idle_timeout is the time after which an idle connection is closed.
+            max_age is the time after which a connection is not reused.
+            max_requests is the number of requests after which a connection
+                is not reused.
+            dns_ttl is the time for which host name lookups are cached.
+            drain_limit is the largest response which is read to the end when
+                closed early, so that the connection can be reused.
+        """
+        self.max_idle = max_idle
+        self.max_idle_total = max_idle_total
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.max_requests = max_requests
+        self.dns_ttl = dns_ttl
+        self.drain_limit = drain_limit
+        self._idle = dict()
+        self._idle_count = 0
+        self._dns = dict()
+        self._lock = Lock()
+        self.requests = 0
+        self.reused = 0
+        self.connects = 0
+        self.connect_time = 0.0
+        self.dns_hits = 0
+        self.dns_misses = 0
+        self.expired = 0
+
+    def get(self, host, timeout):
+        """ Return (connection, reused) for the host, reusing an idle
+            connection if possible.
+        """
+        now = time()
+        self._lock.acquire()
+        try:
+            self.requests += 1
+            idle = self._idle.get(host)
+            while idle:
+                conn = idle.pop()
+                self._idle_count -= 1
+                if now - conn.last_used < self.idle_timeout and \
+                   now - conn.created < self.max_age:
+                    self.reused += 1
+                    return conn, True
+                self.expired += 1
+                conn.close()
+            if idle is not None:
+                del self._idle[host]
+        finally:
+            self._lock.release()
+        return _PooledConnection(host, self, timeout), False
+
+    def put(self, host, conn):
+        """ Return a connection to the pool after a complete response, or
+            close it if it should not be reused.
+        """
+        now = time()
+        conn.last_used = now
+        conn.requests += 1
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(host, list())
+            if conn.requests < self.max_requests and \
+               now - conn.created < self.max_age and \
+               len(idle) < self.max_idle and \
+               self._idle_count < self.max_idle_total:
+                idle.append(conn)
+                self._idle_count += 1
+                return
+            if len(idle) == 0:
+                del self._idle[host]
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def resolve(self, host, port):
+        """ Return the (address, port) for a host name, from the cache if
+            possible.
+        """
+        now = time()
+        self._lock.acquire()
+        try:
+            entry = self._dns.get(host)
+            if entry is not None and entry[0] > now:
+                self.dns_hits += 1
+                return entry[1], port
+            self.dns_misses += 1
+        finally:
+            self._lock.release()
+        info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        address = info[0][4][0]
+        self._lock.acquire()
+        try:
+            if len(self._dns) >= ConnectionPool.max_dns:
+                self._dns.clear()
+            self._dns[host] = (now + self.dns_ttl, address)
+        finally:
+            self._lock.release()
+        return address, port
+
+    def close(self):
+        """ Close all idle connections and clear the DNS cache.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = dict()
+            self._idle_count = 0
+            self._dns.clear()
+        finally:
+            self._lock.release()
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def _connected(self, elapsed):
+        self._lock.acquire()
+        try:
+            self.connects += 1
+            self.connect_time += elapsed
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """ Return a dict of statistics: requests, reused connections, the
+            reuse ratio, new connections and the mean time taken to connect
+            (including DNS), DNS cache hits and misses, connections expired
+            and currently idle.
+        """
+        self._lock.acquire()
+        try:
+            return dict(
+                requests=self.requests,
+                reused=self.reused,
+                reuse_ratio=float(self.reused) / self.requests \
+                            if self.requests else 0.0,
+                connects=self.connects,
+                connect_time=self.connect_time / self.connects \
+                             if self.connects else 0.0,
+                dns_hits=self.dns_hits,
+                dns_misses=self.dns_misses,
+                expired=self.expired,
+                idle=self._idle_count)
+        finally:
+            self._lock.release()
+
+    def __str__(self):
+        s = self.stats()
+        return "{0} requests, {1} reused ({2:.0%}), {3} connects " \
+               "({4:.3f}s mean), DNS {5} hits/{6} misses, {7} idle".format(
+               s["requests"], s["reused"], s["reuse_ratio"], s["connects"],
+               s["connect_time"], s["dns_hits"], s["dns_misses"], s["idle"])
+
+
+class KeepAliveHandler (HTTPHandler):
+    """ urllib2 handler for http URLs, using persistent connections from a
+        ConnectionPool.
+    """
+
+    def __init__(self, pool):
+        HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise URLError("no host given")
+        timeout = getattr(req, "timeout", socket._GLOBAL_DEFAULT_TIMEOUT)
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers["Connection"] = "keep-alive"
+        headers = dict((name.title(), value)
+                       for name, value in headers.items())
+        # a reused connection may have been closed by the server, so retry
+        # once on a new connection
+        while True:
+            conn, reused = self.pool.get(host, timeout)
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                             headers)
+                response = conn.getresponse()
+            except (socket.error, HTTPException) as e:
+                conn.close()
+                if reused:
+                    continue
+                raise URLError(e)
+            break
+        wrapper = _PooledResponse(self.pool, host, conn, response)
+        if response.length == 0 or (response.status >= 300 and
+           response.length is not None and
+           response.length <= self.pool.drain_limit):
+            # read empty (e.g. HEAD), short error and redirect responses now,
+            # as the caller may not close them
+            fp = StringIO(response.read())
+            wrapper.close()
+        else:
+            fp = socket._fileobject(wrapper, close=True)
+        resp = addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+
+if __name__ == "__main__":
+    from urllib2 import build_opener
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from threading import Thread
+
+    class TestHandler (BaseHTTPRequestHandler):
+        """ Test implementation, serving a short page or a 404.
+        """
+
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            body = "x" * 100
+            self.send_response(200 if self.path != "/missing" else 404)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), TestHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    base = "http://127.0.0.1:{0}".format(server.server_address[1])
+
+    connections = ConnectionPool()
+    opener = build_opener(KeepAliveHandler(connections))
+    for i in xrange(5):
+        response = opener.open(base + "/page")
+        assert response.code == 200
+        assert response.read() == "x" * 100
+        response.close()
+    try:
+        opener.open(base + "/missing")
+    except URLError as e:
+        assert e.code == 404
+    else:
+        assert False
+    assert opener.open(base + "/page").read() == "x" * 100
+    stats = connections.stats()
+    assert stats["requests"] == 7
+    assert stats["connects"] == 1
+    assert stats["reused"] == 6
+    assert stats["dns_misses"] == 1
+    connections.close()
+    server.shutdown()
+    print "TEST PASSED"
@@ -17,25 +17,41 @@
 """ Module for web crawling.
 """
 
-from urllib2 import urlopen, Request, URLError, HTTPError
+from urllib2 import urlopen, build_opener, Request, URLError, HTTPError
 from httplib import IncompleteRead
-from robotparser import RobotFileParser
 from time import time, sleep
 from hashlib import md5
-from random import randint
-from re import compile as re_compile, IGNORECASE
+from re import compile as re_compile
 from new import instancemethod
 from threading import Thread, Lock, current_thread
 from inspect import currentframe
-from sys import exc_info, exc_clear
+from itertools import chain
+from heapq import nlargest
+from tempfile import SpooledTemporaryFile
+from sys import exc_info, exc_clear, modules
 
 from stdurl import StdURL
+from frontier import HostFrontier
+from seenset import SeenSet
+from linkparse import LinkExtractor
+from robotrules import RobotRules
+from connpool import ConnectionPool, KeepAliveHandler
+from metrics import Metrics
 
 
 silent = True # if False, output debug to stdout
 user_agent = "FlaxBot/0.1 (see http://www.flax.co.uk/)"
 default_delay = 4 # default time between requests for a domain
 http_threads = 10 # number of crawler threads
+engine = "threads" # "threads", or "events" for eventcrawler.py
+head_first = False # if True, make a HEAD request before each GET
+keep_alive = True # if True, reuse HTTP connections from the pool below
+chunk_size = 65536 # bytes read from a response at a time
+spool_size = 1048576 # content larger than this is spooled to a temporary file
+max_size = (16777216, "abort") # (bytes, "truncate" or "abort") by default
+max_sizes = {"text/html": (4194304, "truncate"), # ... for these content types
+             "application/xhtml+xml": (4194304, "truncate"),
+             "text/plain": (4194304, "truncate")}
 
 
 class CrawlerError (Exception):
@@ -80,6 +96,20 @@ class NotHandled (CrawlerError):
     pass
 
 
+class ResourceTooLarge (CrawlerError):
+    """ Exception raised when a resource is larger than its maximum size, and
+        is not to be truncated.
+    """
+    pass
+
+
+class RedirectHandedOff (CrawlerError):
+    """ Exception raised when the target of a redirect is to be fetched by
+        another crawler (see hand_off in sharded.py).
+    """
+    pass
+
+
 class DefaultDumper (object):
     """ Default implementation of a dumper, which maintains a count of dumped
         resources and the total number of characters.
@@ -97,22 +127,26 @@ class DefaultDumper (object):
         """ Dump a resource.
         """
         self.count += 1
-        self.chars += len(resource.content)
+        self.chars += resource.size
 
 
 class DefaultURLPool (object):
-    """ Default implementation of a URL pool, maintaining URLs in memory.
-        Also maintains a dictionary of URL to error encountered.
+    """ Default implementation of a URL pool, maintaining URLs in memory in a
+        HostFrontier, so that URLs are handed out for the hosts which may be
+        fetched soonest (and robots.txt first for each host). The URLs seen
+        are kept in a SeenSet (see seenset.py).
         
         If the attribute api_lock is a Lock, calls to the API are synchronized.
     """
     
     api_lock = Lock()
         
-    def __init__(self):
-        self._urls = list()
-        self._seen = set()
-        self._robots = list()
+    def __init__(self, seen=None):
+        """ seen is the SeenSet to use, e.g. one with a Bloom filter and
+            max_memory set for a large crawl.
+        """
+        self._frontier = HostFrontier()
+        self._seen = seen if seen is not None else SeenSet()
         self.repeat_count = 0
         self.link_count = 0
         self.redirect_count = 0
@@ -120,12 +154,12 @@ class DefaultURLPool (object):
     def add_url(self, url):
         """ Add a StdURL to the pool.
         """
-        self._urls.append(url)
         self._seen.add(url)
-        robots_url = StdURL("http://{0}/robots.txt".format(url.netloc))
+        robots_url = "http://{0}/robots.txt".format(url.netloc)
         if robots_url not in self._seen:
-            self._robots.append(robots_url)
+            self._frontier.push(url.netloc, robots_url, first=True)
             self._seen.add(robots_url)
+        self._frontier.push(url.netloc, str(url))
         
     def add_link(self, source, target):
         """ Add a link between the source StdURL and the target StdURL. Note
@@ -154,15 +188,16 @@ class DefaultURLPool (object):
         """ Return a StdURL from the to-do collection. If none are left,
             return None.
         """
-        if len(self._robots) > 0:
-            url = self._robots[0]
-            self._robots.remove(url)
-            return url
-        if len(self._urls) == 0:
+        url = self._frontier.pop(default_delay)
+        if url is None:
             return None
-        url = self._urls[randint(0, len(self._urls) - 1)]
-        self._urls.remove(url)
-        return url
+        return StdURL(url)
+
+    def queue_depths(self, n=20):
+        """ Return a list of (netloc, number of URLs queued) for the n
+            domains with the most URLs queued.
+        """
+        return self._frontier.depths(n)
 
 
 class DefaultErrorHandler (object):
@@ -198,10 +233,10 @@ class DefaultFollowDecider (object):
 
     def follow_resource(self, resource):
         """ If the resource should not be followed, raise URLNotFollowed. This
-            is called twice, once after the HEAD request (when resource.content
-            is None) and again after the GET request.
+            is called twice, once when the headers have been fetched (when
+            resource.body is None) and again with the content.
         """
-        if resource.content is not None:
+        if resource.body is not None:
             return
         if not self._re.match(resource.content_type()):
             raise URLNotFollowed()
@@ -229,10 +264,10 @@ class DefaultDuplicateDetector (object):
         
     def duplicate_resource(self, resource):
         """ Check a web resource for duplication. This will be called twice,
-            once after the HEAD request (when resource.content is None) and
-            again after the GET request.
+            once when the headers have been fetched (when resource.body is
+            None) and again with the content.
         """
-        if resource.content is None:
+        if resource.body is None:
             # check the ETag, if there is one
             etag = resource.headers.get("ETag")
             if etag is not None:
@@ -240,32 +275,22 @@ class DefaultDuplicateDetector (object):
                     raise DuplicateResource()
                 self.etags.add(etag)
             return
-        # now check and update the hash set
-        hasher = md5()
-        hasher.update(resource.content)
-        value = hasher.digest()
+        # now check and update the hash set (of the md5 computed as the
+        # content was read)
+        value = resource.digest
         if value in self.hash_set:
             raise DuplicateResource()
         self.hash_set.add(value)
 
 
 class DefaultHtmlParser (object):
-    """ Default implementation of an HTML link parser, using a (not very
-        sophisticated) regular expression.
+    """ Default implementation of an HTML link parser, using the incremental
+        LinkExtractor (see linkparse.py).
         
         If the attribute api_lock is a Lock, calls to the API are synchronized.
     """
     
     content_types = ("text/html", "application/xhtml+xml")
-    
-    def __init__(self):
-        # note that {0}, {1} are not part of the regular expression
-        re = "<\s*{0}\s+{1}\s*=\s*(\"[^\"]+\"|'[^']+')\s*/?>"
-        self._a = re_compile(re.format("a", "href"), IGNORECASE)
-        self._img = re_compile(re.format("img", "src"), IGNORECASE)
-        meta = "<\s*meta\s+name\s*=\s*(\"robots\"|'robots')\s+" \
-               "content\s*=\s*(\"[^\"]+\"|'[^']+')\s*/?>"
-        self._meta = re_compile(meta, IGNORECASE)
         
     def parse_resource(self, resource):
         """ Yield target URLs from the given HTML content, and set noindex and
@@ -274,16 +299,24 @@ class DefaultHtmlParser (object):
         """
         if resource.content_type() not in DefaultHtmlParser.content_types:
             raise NotHandled()
-        meta = self._meta.findall(resource.content)
-        if len(meta) > 0:
-            content = meta[0][1].lower()
-            if "noindex" in content:
+        extractor = LinkExtractor()
+        head = list() # links found before the end of the head
+        for chunk in chain(resource.chunks(), [None]):
+            if chunk is not None:
+                urls = extractor.feed(chunk)
+            else:
+                urls = extractor.close()
+            if not extractor.head_done and chunk is not None:
+                # a meta robots tag may follow in the head
+                head.extend(urls)
+                continue
+            if extractor.noindex:
                 resource.noindex = True
-            if "nofollow" in content:
+            if extractor.nofollow:
                 resource.nofollow = True
-        for url in self._a.findall(resource.content) + \
-                   self._img.findall(resource.content):
-            yield url.strip("\"'")
+            for url in chain(head, urls):
+                yield url
+            del head[:]
         
             
 class DefaultThrottle (object):
@@ -308,10 +341,150 @@ class DefaultThrottle (object):
         return t or 0
 
 
+class _HostRate (object):
+    """ The token bucket and response statistics of a domain, for
+        AdaptiveThrottle.
+    """
+
+    __slots__ = ("delay", "tokens", "updated", "latency", "error_rate")
+
+    def __init__(self, delay, tokens):
+        self.delay = delay
+        self.tokens = tokens
+        self.updated = time()
+        self.latency = None
+        self.error_rate = 0.0
+
+
+class AdaptiveThrottle (object):
+    """ Implementation of a throttle keeping a token bucket for each domain,
+        whose rate adapts to how the domain responds.
+
+        The delay between requests to a domain starts at default_delay, and
+        moves towards latency_factor times the (smoothed) response latency
+        after each response, so fast hosts are crawled faster and slow ones
+        slower. Responses of 429 or 5xx and failed connections multiply the
+        delay by backoff, and the delay does not decrease while the error
+        rate is above max_error_rate. The delay is kept between min_delay
+        and max_delay, and is never less than the Crawl-delay of robots.txt.
+        A delay of 0 does not limit the rate.
+
+        Up to burst requests may be made without waiting after a domain has
+        been idle. The first call to last_time() for a domain (made when its
+        robots.txt is fetched) takes a token. If another throttle is given,
+        last_time() is also passed to it, e.g. for sql_crawler.py, whose URL
+        pool orders domains by the time of their last request.
+
+        If the attribute api_lock is a Lock, calls to the API are synchronized.
+    """
+
+    api_lock = Lock()
+
+    def __init__(self, throttle=None, min_delay=0.25, max_delay=60,
+                 latency_factor=10, backoff=2, max_error_rate=0.1, burst=1,
+                 smoothing=0.3):
+        """ throttle is another throttle to pass last_time() calls to.
+            min_delay and max_delay are the bounds of the delay in seconds.
+            latency_factor is the multiple of the response latency to which
+                the delay moves (so a host serves the crawler for about
+                1/latency_factor of the time).
+            backoff is the factor by which the delay grows on an error.
+            max_error_rate is the fraction of errors above which the delay
+                is not decreased.
+            burst is the number of tokens in each bucket.
+            smoothing is the weight of each response in the moving averages
+                of the latency and error rate.
+        """
+        self.throttle = throttle
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.latency_factor = latency_factor
+        self.backoff = backoff
+        self.max_error_rate = max_error_rate
+        self.burst = burst
+        self.smoothing = smoothing
+        self.hosts = dict()
+        self.backoffs = 0
+
+    def _host(self, netloc):
+        host = self.hosts.get(netloc)
+        if host is None:
+            delay = min(max(default_delay, self.min_delay), self.max_delay)
+            host = self.hosts[netloc] = _HostRate(delay, self.burst)
+        return host
+
+    def last_time(self, netloc):
+        """ Return the last time a request was made to the specified domain
+            according to the other throttle (or 0), taking a token if this is
+            the first call for the domain.
+        """
+        if netloc not in self.hosts:
+            self._host(netloc).tokens -= 1
+        if self.throttle is not None:
+            return _sync(self.throttle.last_time, netloc) or 0
+        return 0
+
+    def wait_time(self, netloc, delay):
+        """ Take a token for a request to the specified domain, returning the
+            time to wait before making it. delay is the Crawl-delay from
+            robots.txt, or None.
+        """
+        host = self._host(netloc)
+        if delay is not None:
+            delay = max(host.delay, delay)
+        else:
+            delay = host.delay
+        now = time()
+        if delay <= 0:
+            host.tokens = self.burst - 1
+            host.updated = now
+            return 0
+        host.tokens = min(self.burst,
+                          host.tokens + (now - host.updated) / delay) - 1
+        host.updated = now
+        if host.tokens >= 0:
+            return 0
+        return -host.tokens * delay
+
+    def record(self, netloc, elapsed, status):
+        """ Adapt the delay for a domain to a response, which took elapsed
+            seconds to arrive and had the given HTTP status (or None if the
+            request failed).
+        """
+        host = self._host(netloc)
+        a = self.smoothing
+        error = status is None or status == 429 or status >= 500
+        host.error_rate = a * error + (1 - a) * host.error_rate
+        if error:
+            self.backoffs += 1
+            delay = host.delay * self.backoff
+            if not delay:
+                # back off from an unlimited rate to the latency target
+                delay = (host.latency or elapsed) * self.latency_factor
+        else:
+            if host.latency is None:
+                host.latency = elapsed
+            else:
+                host.latency = a * elapsed + (1 - a) * host.latency
+            target = host.latency * self.latency_factor
+            delay = (host.delay + target) / 2
+            if delay < host.delay and host.error_rate > self.max_error_rate:
+                delay = host.delay
+        host.delay = min(max(delay, self.min_delay), self.max_delay)
+
+    def delays(self, n=20):
+        """ Return a list of (netloc, delay) for the n domains with the
+            longest delays.
+        """
+        return nlargest(n, ((netloc, host.delay)
+                            for netloc, host in self.hosts.iteritems()),
+                        key=lambda (netloc, delay): delay)
+
+
 class DefaultRobotManager (object):
     """ Default implementation of a manager for robots.txt information.
-        Maintains an in-memory map from netloc to an instance of
-        RobotExclusionRulesParser.
+        Maintains an in-memory map from netloc to the RobotRules for the
+        crawler's user agent (see robotrules.py).
         
         If the attribute api_lock is a Lock, calls to the API are synchronized.
     """
@@ -325,10 +498,7 @@ class DefaultRobotManager (object):
         """ Parse the given robots.txt content and store against the given
             domain. If content is None, any URL will be allowed.
         """
-        robot = RobotFileParser()
-        if content is not None:
-            robot.parse(content.split("\n"))
-        self._robots[netloc] = robot
+        self._robots[netloc] = RobotRules.parse(content, user_agent)
         
     def check_robots(self, url):
         """ If no attempt has yet been made to fetch robots.txt for the domain
@@ -337,12 +507,12 @@ class DefaultRobotManager (object):
             URLNotAllowed. Otherwise, return the crawl delay required by
             robots.txt, or None if not specified.
         """
-        robot = self._robots.get(url.netloc)
-        if robot is None:
+        rules = self._robots.get(url.netloc)
+        if rules is None:
             raise NoRobots()
-        if not robot.can_fetch(user_agent, url.path):
+        if not rules.allowed(url.path):
             raise URLNotAllowed()
-        return default_delay
+        return rules.delay
 
 
 dump = DefaultDumper()
@@ -353,6 +523,8 @@ parsers = (DefaultHtmlParser(), )
 throttle = DefaultThrottle()
 robots = DefaultRobotManager()
 error = DefaultErrorHandler()
+connections = ConnectionPool() # see connpool.py, and stats()
+metrics = Metrics() # see metrics.py
 
 
 def _sync(arg, *args):
@@ -378,15 +550,25 @@ def _sync(arg, *args):
 
 class HTTPResource (object):
     """ Class for storing the results of a successful HTTP GET.
+
+        The content is written to body, a file which is kept in memory unless
+        it grows larger than spool_size, and hashed as it is written (see
+        digest and hash). The content property reads the whole body, so for
+        large content it is better to read body (from the start) or chunks().
     """
     
     def __init__(self, origin_url, url, headers):
         self.origin_url = origin_url
         self.url = url
         self.headers = headers
-        self.content = None
+        self.body = None
+        self.size = 0
+        self.digest = None # binary md5 of the content
+        self.hash = None # hex md5 of the content
+        self.truncated = False
         self.noindex = False
         self.nofollow = False
+        self._hasher = None
 
     def content_type(self):
         """ Return the primary content type from the Content-Type header.
@@ -396,6 +578,100 @@ class HTTPResource (object):
             return None
         return content_type.split(";")[0]
 
+    def max_size(self):
+        """ Return (maximum size, "truncate" or "abort") for the content type.
+        """
+        return max_sizes.get(self.content_type(), max_size)
+
+    def check_size(self):
+        """ Raise ResourceTooLarge if the Content-Length header is larger than
+            the maximum size, and the content is not to be truncated.
+        """
+        length = self.headers.get("Content-Length")
+        limit, action = self.max_size()
+        if action != "truncate" and length is not None and \
+           length.isdigit() and int(length) > limit:
+            raise ResourceTooLarge(length)
+
+    def write(self, data):
+        """ Add data to the content, returning False if no more should be
+            added (as the content has been truncated). Raises
+            ResourceTooLarge if the maximum size is exceeded and the content
+            is not to be truncated.
+        """
+        if self.body is None:
+            self.body = SpooledTemporaryFile(spool_size)
+            self._hasher = md5()
+        limit, action = self.max_size()
+        if self.size + len(data) > limit:
+            if action != "truncate":
+                raise ResourceTooLarge(self.size + len(data))
+            data = data[:limit - self.size]
+            self.truncated = True
+        self._hasher.update(data)
+        self.body.write(data)
+        self.size += len(data)
+        return not self.truncated
+
+    def finish(self):
+        """ Finish writing the content, setting digest and hash.
+        """
+        if self.body is None:
+            self.body = SpooledTemporaryFile(spool_size)
+            self._hasher = md5()
+        self.digest = self._hasher.digest()
+        self.hash = self._hasher.hexdigest()
+        self._hasher = None
+        self.body.seek(0)
+
+    def read(self, response):
+        """ Read the content from a response, in chunks.
+        """
+        while True:
+            data = response.read(chunk_size)
+            if not data or not self.write(data):
+                break
+        self.finish()
+
+    def chunks(self):
+        """ Yield the content in chunks.
+        """
+        self.body.seek(0)
+        while True:
+            data = self.body.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def _get_content(self):
+        if self.body is None:
+            return None
+        self.body.seek(0)
+        return self.body.read()
+
+    def _set_content(self, content):
+        self.close()
+        self.size = 0
+        self.truncated = False
+        if content is not None:
+            self.body = SpooledTemporaryFile(spool_size)
+            self._hasher = md5()
+            self._hasher.update(content)
+            self.body.write(content)
+            self.size = len(content)
+            self.finish()
+
+    content = property(_get_content, _set_content, doc=""" The content as a
+        string, or None if it has not been fetched yet.""")
+
+    def close(self):
+        """ Discard the content (removing any temporary file).
+        """
+        if self.body is not None:
+            self.body.close()
+        self.body = None
+        self.digest = self.hash = self._hasher = None
+
     def check(self):
         """ Check for duplicate (redirected) URL and content, and whether to
             follow (raises exceptions if not).
@@ -429,6 +705,8 @@ class _Courier (Request):
             Can raise URLError, HTTPError or IncompleteRead.
         """
         self._method = method
+        if _opener is not None:
+            return _opener.open(self)
         return urlopen(self)
 
 
@@ -459,6 +737,7 @@ def _crawl():
     """
     for url in _iter_urls():
         _debug("Crawling", url)
+        metrics.incr("urls")
         try:
             if url.path == '/robots.txt':
                 _get_robots(url)
@@ -466,6 +745,7 @@ def _crawl():
                 _get_url(url)
         except (CrawlerError, URLError, IncompleteRead) as e:
             _debug(url)
+            metrics.incr("errors." + e.__class__.__name__)
             _sync(error.error, url, e)
         except:
             # error is not lost - see _debug()
@@ -479,8 +759,9 @@ def _get_robots(url):
     # make a GET request for robots.txt
     _debug("HTTP GET", url)
     courier = _Courier(url)
+    t = time()
     try:
-        response = courier.fetch("GET")
+        response = _fetch(courier, "GET", url)
     except HTTPError as e:
         if e.code == 404:
             content = None
@@ -489,6 +770,8 @@ def _get_robots(url):
     else:
         content = response.read()
         response.close()
+        metrics.incr("bytes", len(content))
+    metrics.incr("time.network", time() - t)
     # send content to robots for parsing
     _sync(robots.parse_robots, url.netloc, content)
         
@@ -496,32 +779,141 @@ def _get_url(url):
     """ Fetch a URL. Note that this is synchronized by the engine such that
         it will only be called for each domain (url.netloc) once at a time.
     """
-    # check robots.txt
-    delay = _sync(robots.check_robots, url) or default_delay
-    # hit the throttle and wait if necessary
-    t = _sync(throttle.last_time, url.netloc)
-    wait = t + delay - time()
+    # check robots.txt, then hit the throttle and wait if necessary
+    wait = _wait_time(url)
     if wait > 0:
         _debug("Sleep for", wait)
         sleep(wait)
+        metrics.incr("time.politeness", wait)
     _sync(throttle.last_time, url.netloc)
-    # make a HEAD request to check the headers
     courier = _Courier(url)
-    _debug("HTTP HEAD", url)
-    response = courier.fetch("HEAD")
-    resource = HTTPResource(url, StdURL(response.url), response.headers)
+    for name, value in _validators(url).iteritems():
+        courier.add_header(name, value)
+    t = time()
+    try:
+        if head_first:
+            # make a HEAD request to check the headers
+            _debug("HTTP HEAD", url)
+            response = _fetch(courier, "HEAD", url)
+            response.close()
+            resource = _check_headers(url, StdURL(response.url),
+                                      response.headers)
+        _debug("HTTP GET", url)
+        response = _fetch(courier, "GET", url)
+    except HTTPError as e:
+        metrics.incr("time.network", time() - t)
+        if e.code != 304:
+            raise
+        exc_clear()
+        _not_modified(url)
+        return
+    if head_first:
+        # replace details just in case
+        resource.url = StdURL(response.url)
+        resource.headers = response.headers
+    else:
+        # check the headers before reading the content, abandoning the
+        # response if rejected
+        try:
+            resource = _check_headers(url, StdURL(response.url),
+                                      response.headers)
+        except:
+            response.close()
+            raise
+    try:
+        resource.read(response)
+    finally:
+        response.close()
+        metrics.incr("time.network", time() - t)
+    metrics.incr("bytes", resource.size)
+    try:
+        _process_resource(url, resource)
+    finally:
+        resource.close()
+
+def _fetch(courier, method, url):
+    """ Make a request, counting it and recording the time taken for the
+        response headers to arrive against the URL's domain.
+    """
+    metrics.incr("fetches")
+    t = time()
+    status = None
+    try:
+        response = courier.fetch(method)
+        status = response.code
+        return response
+    except HTTPError as e:
+        status = e.code
+        raise
+    finally:
+        _response_time(url, time() - t, status)
+
+def _response_time(url, elapsed, status):
+    """ Record the time taken for a response for a URL to arrive, and its
+        HTTP status (or None if the request failed), telling the throttle if
+        it implements record(netloc, elapsed, status).
+    """
+    metrics.observe("latency", elapsed, url.netloc)
+    record = getattr(throttle, "record", None)
+    if record is not None:
+        _sync(record, url.netloc, elapsed, status)
+
+def _validators(url):
+    """ Return a dict of headers for making a conditional request for a URL,
+        if the URL pool implements validators(url).
+    """
+    validators = getattr(pool, "validators", None)
+    if validators is None:
+        return dict()
+    return _sync(validators, url) or dict()
+
+def _not_modified(url):
+    """ Handle a 304 response to a conditional request, telling the URL pool
+        if it implements not_modified(url).
+    """
+    _debug("Not modified", url)
+    not_modified = getattr(pool, "not_modified", None)
+    if not_modified is not None:
+        _sync(not_modified, url)
+
+def _wait_time(url):
+    """ Check robots.txt for a URL, and return the time to wait before
+        fetching it. If the throttle implements wait_time(netloc, delay), it
+        is passed the Crawl-delay (or None) and returns the wait. Otherwise
+        the wait is from the last time of the domain and the Crawl-delay (or
+        default_delay).
+    """
+    delay = _sync(robots.check_robots, url)
+    wait_time = getattr(throttle, "wait_time", None)
+    if wait_time is not None:
+        return _sync(wait_time, url.netloc, delay)
+    t = _sync(throttle.last_time, url.netloc)
+    return t + (delay or default_delay) - time()
+
+def _check_headers(url, final_url, headers):
+    """ Create an HTTPResource for a URL from the (redirected) URL and headers
+        of the response, and check whether to reject it before fetching the
+        content.
+    """
+    resource = HTTPResource(url, final_url, headers)
     # check for a redirect
     if resource.url != resource.origin_url:
         _sync(pool.add_redirect, resource.origin_url, resource.url)
-    # check whether to reject on (redirected) URL, headers or content type
+        # the pool may pass the target on to the crawler for its domain
+        hand_off = getattr(pool, "hand_off", None)
+        if hand_off is not None and _sync(hand_off, resource.url):
+            raise RedirectHandedOff()
+    # check whether to reject on (redirected) URL, headers, content type or
+    # length
+    resource.check_size()
     resource.check()
-    # make a GET request for the resource, and replace details just in case
-    _debug("HTTP GET", url)
-    response = courier.fetch("GET")
-    resource.url = StdURL(response.url)
-    resource.headers = response.headers
-    resource.content = response.read()
-    response.close()
+    return resource
+
+def _process_resource(url, resource):
+    """ Check a resource once its content has been fetched, add the links it
+        contains to the URL pool and dump it.
+    """
+    t = time()
     # check whether to reject on (redirected) URL, headers or content
     resource.check()
     # attempt to parse the content
@@ -553,10 +945,14 @@ def _get_url(url):
             exc_clear()
         else:
             break
+    t1 = time()
+    metrics.incr("time.parse", t1 - t)
     # dump the resource (if allowed)
     if not resource.noindex:
         _debug("Dump", url, resource.content_type())
         _sync(dump.dump_resource, resource)
+        metrics.incr("dumped")
+        metrics.incr("time.dump", time() - t1)
 
 _debug_lock = Lock()
 def _debug(*args):
@@ -593,14 +989,29 @@ _waiters = set() # locks for blocking workers on the next URL
 _lock = Lock() # for locking waiter and domain map code
 _domain_map = dict() # for looking up threads working on a domain
 _halt = False # if a thread sets this to True, stop everything gracefully
+_opener = None # urllib2 opener using the connection pool, if keep_alive
 
 t0 = 0
 
 def start():
     """ Start the crawler, returning when all crawler threads have terminated.
+        If engine is "events", URLs are crawled by an event loop in this thread
+        instead (see eventcrawler.py).
     """
-    global t0
+    global t0, _opener
     t0 = time()
+    _waiters.clear() # in case the crawler has been run before
+    if hasattr(pool, "queue_depths"):
+        metrics.gauge("queue_depths", lambda: _sync(pool.queue_depths))
+    if hasattr(throttle, "delays"):
+        metrics.gauge("delays", lambda: _sync(throttle.delays))
+    if engine == "events":
+        from eventcrawler import EventEngine
+        EventEngine(modules[__name__]).run()
+        return
+    _opener = build_opener(KeepAliveHandler(connections)) \
+              if keep_alive else None
+    metrics.gauge("connections", connections.stats)
     for _ in xrange(http_threads):
         _threads.append(CrawlerThread())
     for thread in _threads:
@@ -609,6 +1020,8 @@ def start():
         thread = _threads[0]
         thread.join()
         _threads.remove(thread)
+    connections.close()
+    _debug("Connections:", connections)
 
 def stop():
     """ Gracefully stop the crawler prematurely. Crawler threads will still
@@ -676,13 +1089,87 @@ def _iter_urls():
             del _domain_map[url.netloc]
     _lock.release()
 
+def _test_adaptive_throttle():
+    """ Test AdaptiveThrottle without making any requests.
+    """
+    def close(a, b):
+        return abs(a - b) < 0.05
+
+    # a zero delay does not limit the rate
+    throttle = AdaptiveThrottle(min_delay=0, max_delay=0)
+    throttle.last_time("a")
+    assert [throttle.wait_time("a", None) for i in xrange(3)] == [0, 0, 0]
+
+    # token bucket: burst requests without waiting, then one per delay
+    throttle = AdaptiveThrottle(min_delay=1, max_delay=1, burst=2)
+    throttle.last_time("a") # robots.txt
+    waits = [throttle.wait_time("a", None) for i in xrange(3)]
+    assert close(waits[0], 0) and close(waits[1], 1) and close(waits[2], 2)
+    throttle.hosts["a"].updated -= 10 # idle for 10s refills the bucket
+    assert throttle.wait_time("a", None) == 0
+    assert close(throttle.wait_time("a", None), 0)
+    assert close(throttle.wait_time("a", None), 1)
+
+    # Crawl-delay is a floor on the delay
+    throttle = AdaptiveThrottle(min_delay=0.25)
+    assert throttle.wait_time("c", 5) == 0
+    assert close(throttle.wait_time("c", 5), 5)
+
+    # backoff on 429, 5xx and failed requests, but not other statuses
+    throttle = AdaptiveThrottle(min_delay=1, max_delay=60, backoff=2)
+    throttle.hosts["b"] = _HostRate(1, 1)
+    for status, delay in ((503, 2), (429, 4), (None, 8)):
+        throttle.record("b", 0.01, status)
+        assert throttle.hosts["b"].delay == delay
+    assert throttle.backoffs == 3
+    # the delay is held while the error rate is above max_error_rate
+    # (0.657 after three errors, decaying by 0.7 with each success)
+    for i in xrange(5):
+        throttle.record("b", 0.01, 404)
+        assert throttle.hosts["b"].delay == 8
+    throttle.record("b", 0.01, 200)
+    assert throttle.hosts["b"].delay == 4.05
+    assert throttle.backoffs == 3
+
+    # backoff from a zero delay moves to the latency target
+    throttle = AdaptiveThrottle(min_delay=0)
+    throttle.hosts["z"] = _HostRate(0, 1)
+    throttle.record("z", 0.5, 503)
+    assert throttle.hosts["z"].delay == 5
+
+def _test_html_parser():
+    """ Test that DefaultHtmlParser applies a meta robots nofollow to the
+        links before it in the head, whatever the chunk size.
+    """
+    global chunk_size
+    html = "<html><head><link href='style.css'>" + " " * 100 + \
+           "<meta name=robots content=nofollow></head>" \
+           "<body><a href='one.html'>one</a></body></html>"
+    saved = chunk_size
+    try:
+        for chunk_size in (16, 64, len(html)):
+            resource = HTTPResource(None, None, {"Content-Type": "text/html"})
+            resource.content = html
+            urls = list()
+            for url in DefaultHtmlParser().parse_resource(resource):
+                assert resource.nofollow, (chunk_size, url)
+                urls.append(url)
+            assert urls == ["style.css", "one.html"], urls
+    finally:
+        chunk_size = saved
+
+
 if __name__ == "__main__":
     from sys import argv
     
+    _test_adaptive_throttle()
+    _test_html_parser()
     if "-v" in argv[1:]:
         silent = False
     if "-q" in argv[1:]:
         default_delay = 0
+    if "-e" in argv[1:]:
+        engine = "events"
 
     class DomainFollowDecider (DefaultFollowDecider):
         """ Test implementation.
@@ -0,0 +1,543 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Event loop engine for the web crawler.
+
+    An alternative to the crawler threads of crawler.py for crawling many
+    hosts at once. All requests are made from a single thread using asyncore,
+    so thousands may be in flight, and the delay between requests to a domain
+    is a timer rather than a sleeping thread. The crawler API objects are
+    used in the same way as by the threaded engine. To use this engine::
+
+        crawler.engine = "events"
+        crawler.start()
+
+    Differences from the threaded engine:
+
+    * crawler.head_first is ignored - each URL is fetched with a single GET
+      request, and the content is only read if the headers pass the checks.
+    * Only http URLs are supported (others raise URLError).
+    * Host names are resolved by a small pool of threads, and cached.
+"""
+
+import asyncore
+import socket
+import select
+from collections import deque
+from heapq import heappush, heappop, nlargest
+from threading import Thread
+from Queue import Queue, Empty
+from cStringIO import StringIO
+from httplib import HTTPMessage, IncompleteRead
+from urllib2 import URLError, HTTPError
+from time import time, sleep
+from sys import exc_info
+
+from stdurl import StdURL
+
+
+max_fetches = 1000 # maximum number of requests in progress
+max_pending = 10000 # maximum number of URLs taken from the pool at once
+timeout = 60 # time after which a request is abandoned
+dns_threads = 10 # number of threads for resolving host names
+max_redirects = 5 # maximum number of redirects followed for a URL
+chunk_size = 16384 # size of socket reads
+
+
+class _HTTPFetch (asyncore.dispatcher):
+    """ An HTTP/1.0 GET request on a non-blocking socket.
+
+        on_headers(fetch) is called when the response headers have arrived,
+        and should return True for the content to be read. Then
+        on_data(fetch, data) is called with each chunk of content, and should
+        return True for more to be read, and then either on_done(fetch) or
+        on_error(fetch, e) is called.
+    """
+
+    def __init__(self, url, address, headers, on_headers, on_data, on_done,
+                 on_error, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.url = url
+        self.status = None
+        self.reason = None
+        self.headers = None
+        self.deadline = time() + timeout
+        self._on_headers = on_headers
+        self._on_data = on_data
+        self._on_done = on_done
+        self._on_error = on_error
+        self._finished = False
+        self._head = ""
+        self.received = 0
+        lines = ["GET {0} HTTP/1.0".format(
+                     url.selector.replace(" ", "%20") or "/"),
+                 "Host: {0}".format(url.netloc),
+                 "Connection: close"]
+        for name, value in headers.iteritems():
+            lines.append("{0}: {1}".format(name, value))
+        self._out = "\r\n".join(lines) + "\r\n\r\n"
+        family, sockaddr = address
+        self.create_socket(family, socket.SOCK_STREAM)
+        self.connect(sockaddr)
+
+    def writable(self):
+        return not self.connected or len(self._out) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(chunk_size)
+        if not data or self._finished:
+            return
+        if self.headers is not None:
+            self._data(data)
+            return
+        # wait for the end of the headers
+        self._head += data
+        end = self._head.find("\r\n\r\n")
+        if end == -1:
+            return
+        status_line, _, header_text = self._head[:end + 2].partition("\r\n")
+        body = self._head[end + 4:]
+        self._head = ""
+        parts = status_line.split(None, 2)
+        try:
+            self.status = int(parts[1])
+        except (IndexError, ValueError):
+            raise URLError("bad status line: {0}".format(status_line))
+        self.reason = parts[2] if len(parts) > 2 else ""
+        self.headers = HTTPMessage(StringIO(header_text))
+        if not self._on_headers(self):
+            self.close()
+        elif body:
+            self._data(body)
+
+    def _data(self, data):
+        self.received += len(data)
+        more = self._on_data(self, data)
+        if self._finished:
+            return
+        if not more:
+            # the rest of the content is not wanted
+            self.close()
+            self._on_done(self)
+
+    def handle_close(self):
+        if self._finished:
+            return
+        self.close()
+        if self.headers is None:
+            self._on_error(self, URLError("connection closed"))
+            return
+        length = self.headers.get("Content-Length")
+        if length is not None and length.isdigit() and \
+           self.received < int(length):
+            self._on_error(self, IncompleteRead(""))
+        else:
+            self._on_done(self)
+
+    def handle_expt(self):
+        self.handle_close()
+
+    def handle_error(self):
+        e = exc_info()[1]
+        if self._finished:
+            return
+        self.close()
+        if not isinstance(e, (URLError, IncompleteRead)):
+            e = URLError(e)
+        self._on_error(self, e)
+
+    def expire(self, now):
+        """ Abandon the request if it has taken too long.
+        """
+        if now > self.deadline and not self._finished:
+            self.close()
+            self._on_error(self, URLError("timed out"))
+
+    def close(self):
+        self._finished = True
+        asyncore.dispatcher.close(self)
+
+
+class _Resolver (object):
+    """ Resolve host names using a pool of threads, caching the results.
+    """
+
+    max_cache = 100000
+
+    def __init__(self, nthreads):
+        self._cache = dict()
+        self._waiting = dict()
+        self._requests = Queue()
+        self._results = Queue()
+        self._threads = list()
+        for _ in xrange(nthreads):
+            thread = Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def resolve(self, host, port, callback, *args):
+        """ Call callback(address, *args) with the (family, sockaddr) of the
+            host when resolved, or a URLError if it can not be.
+        """
+        key = (host, port)
+        address = self._cache.get(key)
+        if address is not None:
+            callback(address, *args)
+        elif key in self._waiting:
+            self._waiting[key].append((callback, args))
+        else:
+            self._waiting[key] = [(callback, args)]
+            self._requests.put(key)
+
+    def busy(self):
+        return len(self._waiting) > 0
+
+    def dispatch(self):
+        """ Call the callbacks for resolved host names.
+        """
+        while True:
+            try:
+                key, address = self._results.get_nowait()
+            except Empty:
+                break
+            if not isinstance(address, URLError):
+                if len(self._cache) >= _Resolver.max_cache:
+                    self._cache.clear()
+                self._cache[key] = address
+            for callback, args in self._waiting.pop(key):
+                callback(address, *args)
+
+    def close(self):
+        for _ in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            key = self._requests.get()
+            if key is None:
+                break
+            try:
+                info = socket.getaddrinfo(key[0], key[1], 0,
+                                          socket.SOCK_STREAM)[0]
+                address = (info[0], info[4])
+            except socket.error as e:
+                address = URLError(e)
+            self._results.put((key, address))
+
+
+class _Task (object):
+    """ The state of a URL being crawled.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.fetch_url = url
+        self.robots = url.path == "/robots.txt"
+        self.redirects = 0
+        self.headers = None
+        self.resource = None
+        self.body = list() # robots.txt content
+        self.fetch = None
+        self.started = None # time the first request was started
+        self.fetched = None # time the last response was read
+        self.sent = None # time the last request was sent
+        self.active = False
+        self.finished = False
+
+
+class EventEngine (object):
+    """ Crawl URLs from the URL pool of the crawler module using an event loop.
+
+        As with the threaded engine, only one URL is crawled for a domain at a
+        time, and the crawler stops when the URL pool is empty and all URLs
+        have been crawled.
+    """
+
+    def __init__(self, api):
+        """ api is the crawler module holding the crawler API objects.
+        """
+        self.api = api
+        self._map = dict()
+        self._timers = list()
+        self._seq = 0
+        self._domains = dict() # netloc -> deque of URLs waiting for the domain
+        self._waiting = deque() # tasks waiting for a free request slot
+        self._pending = 0
+        self._active = 0
+        self._resolver = None
+
+    def run(self):
+        """ Crawl until there are no more URLs, or the crawler is stopped.
+        """
+        use_poll = hasattr(select, "poll")
+        self._resolver = _Resolver(dns_threads)
+        self.api.metrics.gauge("engine", self.stats)
+        last_expired = time()
+        try:
+            while True:
+                self._fill()
+                self._run_timers()
+                self._resolver.dispatch()
+                if self._pending == 0:
+                    break
+                # wait for socket events, or until the next timer is due
+                wait = 1.0
+                if self._timers:
+                    wait = max(0, min(wait, self._timers[0][0] - time()))
+                if self._resolver.busy():
+                    wait = min(wait, 0.05)
+                if self._map:
+                    asyncore.loop(wait, use_poll, self._map, 1)
+                else:
+                    sleep(wait)
+                now = time()
+                if now - last_expired >= 1:
+                    last_expired = now
+                    for fetch in self._map.values():
+                        fetch.expire(now)
+        finally:
+            self._resolver.close()
+            for fetch in self._map.values():
+                fetch.close()
+
+    def stats(self, n=20):
+        """ Return a dict of the number of requests in progress, the number
+            of URLs taken from the pool but not finished, and a list of
+            (netloc, URLs waiting) for the n domains with the most URLs
+            waiting (which may be called from another thread).
+        """
+        return dict(active=self._active,
+                    pending=self._pending,
+                    queue_depths=nlargest(n, ((netloc, len(waiting))
+                        for netloc, waiting in self._domains.items()),
+                        key=lambda (netloc, depth): depth))
+
+    def _fill(self):
+        """ Take URLs from the pool, starting them if no other URL on the same
+            domain is being crawled.
+        """
+        api = self.api
+        while self._pending < max_pending and not api._halt:
+            url = api._sync(api.pool.next_url)
+            if url is None:
+                break
+            self._pending += 1
+            waiting = self._domains.get(url.netloc)
+            if waiting is not None:
+                waiting.append(url)
+            else:
+                self._domains[url.netloc] = deque()
+                self._start(url)
+
+    def _call_later(self, delay, fn, *args):
+        self._seq += 1
+        heappush(self._timers, (time() + delay, self._seq, fn, args))
+
+    def _run_timers(self):
+        now = time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, fn, args = heappop(self._timers)
+            fn(*args)
+
+    def _guard(self, task, fn, *args):
+        """ Call fn, handling any exception as _crawl() does for the threaded
+            engine, and finishing the task.
+        """
+        api = self.api
+        try:
+            return fn(*args)
+        except (api.CrawlerError, URLError, IncompleteRead) as e:
+            self._failed(task, e)
+        except:
+            # error is not lost - see _debug()
+            api.stop()
+            self._finish(task)
+
+    def _failed(self, task, e):
+        api = self.api
+        api._debug(task.url)
+        api.metrics.incr("errors." + e.__class__.__name__)
+        api._sync(api.error.error, task.url, e)
+        self._finish(task)
+
+    def _start(self, url):
+        self.api._debug("Crawling", url)
+        self.api.metrics.incr("urls")
+        task = _Task(url)
+        self._guard(task, self._schedule, task)
+
+    def _schedule(self, task):
+        """ Check robots.txt for the URL, and schedule the request for when the
+            throttle allows.
+        """
+        api = self.api
+        if task.robots:
+            # initialise the throttle for this domain
+            api._sync(api.throttle.last_time, task.url.netloc)
+            self._ready(task)
+            return
+        wait = api._wait_time(task.url)
+        if wait > 0:
+            api._debug("Wait for", wait)
+            api.metrics.incr("time.politeness", wait)
+            self._call_later(wait, self._guard, task, self._ready, task)
+        else:
+            self._ready(task)
+
+    def _ready(self, task):
+        """ Start the request for the task if there is a free slot.
+        """
+        if self._active >= max_fetches:
+            self._waiting.append(task)
+            return
+        self._active += 1
+        task.active = True
+        task.started = time()
+        api = self.api
+        task.headers = {"User-Agent": api.user_agent}
+        if not task.robots:
+            api._sync(api.throttle.last_time, task.url.netloc)
+            task.headers.update(api._validators(task.url))
+        self._connect(task)
+
+    def _connect(self, task):
+        url = task.fetch_url
+        if url.scheme != "http":
+            raise URLError("unsupported scheme: {0}".format(url.scheme))
+        self._resolver.resolve(url.hostname, url.port or 80, self._resolved,
+                               task)
+
+    def _resolved(self, address, task):
+        self._guard(task, self._send, address, task)
+
+    def _send(self, address, task):
+        if isinstance(address, URLError):
+            raise address
+        self.api._debug("HTTP GET", task.fetch_url)
+        self.api.metrics.incr("fetches")
+        task.sent = time()
+        try:
+            task.fetch = _HTTPFetch(task.fetch_url, address, task.headers,
+                                    self._on_headers, self._on_data,
+                                    self._on_done, self._on_error, self._map)
+        except socket.error as e:
+            raise URLError(e)
+        task.fetch.task = task
+
+    def _on_headers(self, fetch):
+        task = fetch.task
+        return self._guard(task, self._headers, task, fetch)
+
+    def _on_data(self, fetch, data):
+        task = fetch.task
+        if task.robots:
+            task.body.append(data)
+            return True
+        return self._guard(task, task.resource.write, data)
+
+    def _on_done(self, fetch):
+        task = fetch.task
+        task.fetched = time()
+        self.api.metrics.incr("bytes", fetch.received)
+        self._guard(task, self._content, task)
+
+    def _on_error(self, fetch, e):
+        task = fetch.task
+        task.fetched = time()
+        if fetch.headers is None:
+            self.api._response_time(task.url, task.fetched - task.sent, None)
+        self._failed(task, e)
+
+    def _headers(self, task, fetch):
+        """ Handle the response headers, returning True if the content
+            should be read.
+        """
+        api = self.api
+        api._response_time(task.url, time() - task.sent, fetch.status)
+        if fetch.status in (301, 302, 303, 307):
+            location = fetch.headers.get("Location")
+            if location is not None:
+                if task.redirects >= max_redirects:
+                    raise HTTPError(str(task.fetch_url), fetch.status,
+                                    "too many redirects", fetch.headers, None)
+                task.redirects += 1
+                task.fetch_url = StdURL(location, task.fetch_url)
+                task.fetch = None
+                self._connect(task)
+                return False
+        if fetch.status == 304 and not task.robots:
+            api._not_modified(task.url)
+            self._finish(task)
+            return False
+        if task.robots and fetch.status == 404:
+            api._sync(api.robots.parse_robots, task.url.netloc, None)
+            self._finish(task)
+            return False
+        if fetch.status >= 400:
+            raise HTTPError(str(task.fetch_url), fetch.status, fetch.reason,
+                            fetch.headers, None)
+        if not task.robots:
+            task.resource = api._check_headers(task.url, task.fetch_url,
+                                               fetch.headers)
+        return True
+
+    def _content(self, task):
+        api = self.api
+        if task.robots:
+            api._sync(api.robots.parse_robots, task.url.netloc,
+                      "".join(task.body))
+        else:
+            task.resource.finish()
+            api._process_resource(task.url, task.resource)
+        self._finish(task)
+
+    def _finish(self, task):
+        """ Finish with a task, and start the next URL waiting for its domain
+            or a request slot.
+        """
+        if task.finished:
+            return
+        task.finished = True
+        if task.started is not None:
+            self.api.metrics.incr("time.network",
+                                  (task.fetched or time()) - task.started)
+        if task.fetch is not None:
+            task.fetch.close()
+            task.fetch = None
+        if task.resource is not None:
+            task.resource.close()
+        if task.active:
+            self._active -= 1
+            if self._waiting:
+                waiting = self._waiting.popleft()
+                self._call_later(0, self._guard, waiting, self._ready, waiting)
+        self._pending -= 1
+        waiting = self._domains[task.url.netloc]
+        if waiting:
+            self._call_later(0, self._start, waiting.popleft())
+        else:
+            del self._domains[task.url.netloc]
+
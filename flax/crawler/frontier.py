@@ -0,0 +1,132 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Module including a per-host URL frontier.
+"""
+
+from collections import deque
+from heapq import heappush, heappop, nlargest
+from itertools import count
+from time import time
+
+
+class HostFrontier (object):
+    """ A collection of URLs to crawl, held in a FIFO queue for each host,
+        with the hosts ordered by the time at which each may next be fetched.
+
+        URLs are stored as strings, and a host is only in the heap while it
+        has URLs queued, so pop() is O(log hosts) however many URLs there are.
+    """
+
+    def __init__(self):
+        self._queues = dict() # host -> deque of URLs
+        self._next = dict() # host -> earliest time of the next fetch
+        self._heap = list() # (time, sequence, host) for hosts with URLs
+        self._seq = count()
+        self._count = 0
+
+    def __len__(self):
+        """ Return the number of URLs queued.
+        """
+        return self._count
+
+    def hosts(self):
+        """ Return the number of hosts with URLs queued.
+        """
+        return len(self._queues)
+
+    def depths(self, n):
+        """ Return a list of (host, number of URLs queued) for the n hosts
+            with the most URLs queued.
+        """
+        return nlargest(n, ((host, len(queue))
+                            for host, queue in self._queues.iteritems()),
+                        key=lambda (host, depth): depth)
+
+    def push(self, host, url, first=False):
+        """ Queue a URL for a host. If first is True, the URL is put at the
+            front of the host's queue (e.g. for robots.txt).
+
+            A host not fetched before is ready immediately.
+        """
+        queue = self._queues.get(host)
+        if queue is None:
+            queue = self._queues[host] = deque()
+            heappush(self._heap,
+                     (self._next.get(host, 0), self._seq.next(), host))
+        if first:
+            queue.appendleft(url)
+        else:
+            queue.append(url)
+        self._count += 1
+
+    def pop(self, delay, now=None):
+        """ Return the next URL of the host which may be fetched soonest, or
+            None if no URLs are queued. The host may not be fetched again
+            until delay seconds after the later of now and its ready time.
+
+            Note that the URL is returned even if its host is not yet ready,
+            as the caller is expected to wait.
+        """
+        if not self._heap:
+            return None
+        t, _, host = heappop(self._heap)
+        queue = self._queues[host]
+        url = queue.popleft()
+        self._count -= 1
+        if now is None:
+            now = time()
+        next_time = max(now, t) + delay
+        self._next[host] = next_time
+        if queue:
+            heappush(self._heap, (next_time, self._seq.next(), host))
+        else:
+            del self._queues[host]
+        return url
+
+    def ready_time(self):
+        """ Return the time at which the next URL may be fetched, or None if
+            no URLs are queued.
+        """
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+
+if __name__ == "__main__":
+    frontier = HostFrontier()
+    assert frontier.pop(1) is None
+    for i in xrange(3):
+        frontier.push("a", "http://a/{0}".format(i))
+    frontier.push("b", "http://b/0")
+    frontier.push("a", "http://a/robots.txt", first=True)
+    frontier.push("b", "http://b/robots.txt", first=True)
+    assert len(frontier) == 6
+    assert frontier.hosts() == 2
+    assert frontier.depths(1) == [("a", 4)]
+    # robots.txt first, then hosts alternate as each becomes ready
+    order = [frontier.pop(10, now=t) for t in (0, 0, 10, 10, 20, 30)]
+    assert order == ["http://a/robots.txt", "http://b/robots.txt",
+                     "http://a/0", "http://b/0", "http://a/1", "http://a/2"]
+    assert len(frontier) == 0
+    assert frontier.hosts() == 0
+    # a host keeps its ready time when its queue empties and refills
+    frontier.push("c", "http://c/0")
+    frontier.push("a", "http://a/3")
+    assert frontier.pop(10, now=35) == "http://c/0"
+    assert frontier.ready_time() == 40
+    assert frontier.pop(10, now=35) == "http://a/3"
+    print "TEST PASSED"
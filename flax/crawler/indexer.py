@@ -0,0 +1,432 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Module including a content dumper which indexes resources into a Xapian
+    database (using flax.core) as they are crawled, so that they are
+    searchable without a second pass over a crawl store.
+
+    Resources are put on a bounded queue, and indexed by a worker thread
+    with a flax.core BulkIndexer, which commits in batches (and at least
+    every commit_interval seconds). When the queue is full, dump_resource()
+    blocks, slowing the crawler to the rate of indexing::
+
+        crawler.dump = IndexingDumper("crawl.xapian", dumper=sql)
+        crawler.start()
+        crawler.dump.close()
+
+    Text is extracted with htmltotext (part of Flax Basic) if it is
+    installed, or with regular expressions otherwise. The flax package must
+    be importable (e.g. the directory above flax on sys.path).
+"""
+
+import crawler
+from crawler import _sync
+from HTMLParser import HTMLParser
+from Queue import Queue, Empty, Full
+from threading import Thread, Lock
+from hashlib import md5
+from json import dumps
+from re import compile as re_compile, IGNORECASE, DOTALL
+from time import time
+try:
+    import htmltotext
+except ImportError:
+    htmltotext = None
+try:
+    import xapian
+    from flax.core import Fieldmap
+    from flax.core.errors import IndexingError
+    # errors indexing one resource, which is then skipped
+    _index_errors = (IndexingError, xapian.Error, ValueError, UnicodeError)
+except ImportError:
+    xapian = None
+    _index_errors = (ValueError, UnicodeError)
+
+
+_strip = re_compile("<(script|style)[^>]*>.*?</\\1\s*>|<!--.*?-->|<[^>]*>",
+                    IGNORECASE | DOTALL)
+_title = re_compile("<title[^>]*>(.*?)</title\s*>", IGNORECASE | DOTALL)
+_meta = re_compile("<meta\\b[^>]*>", IGNORECASE)
+_meta_attr = re_compile("(name|content)\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|" \
+                        "([^\s\"'>]+))", IGNORECASE)
+_space = re_compile("\s+")
+_unescape = HTMLParser().unescape
+_charset = re_compile("charset=[\"']?([\w.:-]+)", IGNORECASE)
+
+
+def _text(html):
+    """ Return the text of an HTML fragment, with entities replaced and
+        white space collapsed.
+    """
+    return _space.sub(" ", _unescape(html)).strip()
+
+
+def extract_html(content):
+    """ Return (title, description, keywords, text) from HTML content (as
+        unicode), using regular expressions.
+    """
+    match = _title.search(content)
+    title = _text(_strip.sub(" ", match.group(1))) if match else u""
+    meta = dict()
+    for tag in _meta.findall(content):
+        attrs = dict((name.lower(), v1 or v2 or v3)
+                     for name, v1, v2, v3 in _meta_attr.findall(tag))
+        name = attrs.get("name", "").lower()
+        if name in ("description", "keywords") and name not in meta:
+            meta[name] = _text(attrs.get("content", u""))
+    body = _title.sub(" ", content)
+    return (title, meta.get("description", u""), meta.get("keywords", u""),
+            _text(_strip.sub(" ", body)))
+
+
+def extract_text(content, content_type, charset=None):
+    """ Return (title, description, keywords, text) from (HTML or plain text)
+        content, using htmltotext for HTML if it is installed. The content is
+        decoded with charset (by default, or if unknown, UTF-8) first.
+    """
+    try:
+        content = content.decode(charset or "utf-8", "replace")
+    except LookupError:
+        content = content.decode("utf-8", "replace")
+    if content_type != "text/plain" and htmltotext is not None:
+        page = htmltotext.extract(content)
+        return page.title, page.description, page.keywords, page.content
+    if content_type == "text/plain":
+        return u"", u"", u"", _space.sub(" ", content).strip()
+    return extract_html(content)
+
+
+def crawl_fieldmap(language=None):
+    """ Return a Fieldmap for crawled resources: id (an md5 of the URL, used
+        as the docid), host and type filter fields, and title, description,
+        keywords and content free text fields.
+    """
+    fieldmap = Fieldmap(language=language)
+    fieldmap.setfield("id", True)
+    fieldmap.setfield("host", True)
+    fieldmap.setfield("type", True)
+    fieldmap.setfield("title", False)
+    fieldmap.setfield("description", False)
+    fieldmap.setfield("keywords", False)
+    fieldmap.setfield("content", False)
+    return fieldmap
+
+
+class IndexingDumper (object):
+    """ Implementation of a dumper which indexes resources (of the types in
+        content_types) into a Xapian database, after calling another dumper
+        (if given).
+
+        Calls need not be synchronized (there is no api_lock), as the queue
+        is, so other crawler threads are not held up while one is blocked on
+        a full queue.
+    """
+
+    content_types = ("text/html", "application/xhtml+xml", "text/plain")
+
+    def __init__(self, path, dumper=None, fieldmap=None, queue_size=64,
+                 commit_interval=60, **indexer_kwargs):
+        """ path is the Xapian database, which is created if it does not
+                exist.
+            dumper is the dumper to call first (e.g. an SQLImplementation).
+            fieldmap is the Fieldmap for a new database (by default,
+                crawl_fieldmap()). The fieldmap saved in an existing database
+                is used instead, and should have the same fields.
+            queue_size is the number of resources queued for indexing before
+                dump_resource() blocks.
+            commit_interval is the longest time in seconds between a document
+                being indexed and committed.
+
+            Other keyword arguments (e.g. batch_docs) are passed to the
+            BulkIndexer.
+        """
+        self.dumper = dumper
+        self.commit_interval = commit_interval
+        self.indexer = self._open(path, fieldmap, indexer_kwargs)
+        self.queued = 0
+        self.skipped = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.error = None # the exception which stopped the worker, if any
+        self._queue = Queue(queue_size)
+        self._lock = Lock() # for the counts
+        self._thread = Thread(target=self._work, name="indexer")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _open(self, path, fieldmap, indexer_kwargs):
+        """ Open (or create) the database, returning a BulkIndexer for it.
+        """
+        if xapian is None:
+            raise ImportError("indexing requires xapian and flax.core")
+        self.database = xapian.WritableDatabase(path,
+                                                xapian.DB_CREATE_OR_OPEN)
+        if self.database.get_metadata("flax.fieldmap"):
+            fieldmap = Fieldmap(self.database)
+        else:
+            if fieldmap is None:
+                fieldmap = crawl_fieldmap()
+            fieldmap.save(self.database)
+        return fieldmap.bulk_indexer(self.database, **indexer_kwargs)
+
+    def dump_resource(self, resource):
+        """ Dump a resource with the other dumper, and queue it for indexing,
+            waiting for space on the queue if it is full.
+        """
+        if self.dumper is not None:
+            _sync(self.dumper.dump_resource, resource)
+        content_type = resource.content_type()
+        if content_type not in self.content_types or resource.body is None:
+            self._count("skipped", 0.0)
+            return
+        # the body is closed once dumped, so the content is read now
+        match = _charset.search(resource.headers.get("Content-Type", ""))
+        item = (str(resource.url), resource.url.netloc, content_type,
+                match.group(1) if match else None, resource.content)
+        t = time()
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self._queue.put(item, timeout=1)
+                break
+            except Full:
+                pass
+        wait = time() - t
+        crawler.metrics.incr("time.index_wait", wait)
+        self._count("queued", wait)
+
+    def _count(self, name, wait):
+        self._lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+            self.wait_time += wait
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        """ Index resources from the queue until None is received, committing
+            documents at most commit_interval seconds after indexing them.
+        """
+        indexer = self.indexer
+        pending = None # the time of the first document not committed
+        try:
+            while True:
+                timeout = None
+                if pending is not None:
+                    timeout = pending + self.commit_interval - time()
+                    if timeout <= 0:
+                        indexer.commit()
+                        pending = None
+                        continue
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except Empty:
+                    continue
+                if item is None:
+                    break
+                commits = indexer.commits
+                t = time()
+                try:
+                    self._index(*item)
+                except _index_errors:
+                    self.failed += 1
+                    crawler.metrics.incr("index_failed")
+                else:
+                    crawler.metrics.incr("indexed")
+                    if pending is None:
+                        pending = time()
+                crawler.metrics.incr("time.index", time() - t)
+                if indexer.commits != commits:
+                    # the BulkIndexer committed a batch
+                    pending = None
+            indexer.close()
+        except Exception as e:
+            self.error = e
+            # unblock dump_resource() and close()
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except Empty:
+                    break
+
+    def _index(self, url, host, content_type, charset, content):
+        """ Index a resource's content as a document with the URL's md5 as
+            its docid, replacing any document indexed for the URL before.
+        """
+        title, description, keywords, text = \
+            extract_text(content, content_type, charset)
+        doc = self.indexer.document()
+        doc.index("id", md5(url).hexdigest(), isdocid=True)
+        doc.index("host", host)
+        doc.index("type", content_type)
+        doc.index("title", title, search_default=True, weight=2)
+        doc.index("description", description, search_default=True)
+        doc.index("keywords", keywords)
+        doc.index("content", text, search_default=True)
+        doc.set_data(dumps(dict(url=url, title=title)))
+        self.indexer.add(doc)
+
+    def close(self):
+        """ Index the resources left on the queue, and commit. Raises the
+            exception which stopped the worker, if any.
+        """
+        if self._thread.isAlive() and self.error is None:
+            self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        """ Return a dict of statistics: resources queued, skipped (not a text
+            type), indexed and failed, commits, resources on the queue, and
+            the time dump_resource() spent waiting for the queue.
+        """
+        return dict(queued=self.queued,
+                    skipped=self.skipped,
+                    indexed=self.indexer.doccount,
+                    failed=self.failed,
+                    commits=self.indexer.commits,
+                    waiting=self._queue.qsize(),
+                    wait_time=self.wait_time)
+
+    def __str__(self):
+        s = self.stats()
+        return "{0} resources indexed ({1} failed, {2} skipped) in {3} " \
+               "commits, {4:.1f}s waiting for the indexer".format(
+               s["indexed"], s["failed"], s["skipped"], s["commits"],
+               s["wait_time"])
+
+
+if __name__ == "__main__":
+    from crawler import HTTPResource
+    from stdurl import StdURL
+    from threading import Event
+
+    html = """<html><head><title>Cheese &amp; fondue</title>
+<meta name="Description" content="All about  cheese">
+<meta content='gruyere, emmental' name=keywords>
+<style>p { color: red }</style></head><body>
+<p>Melt the <b>cheese</b>.</p><script>var x = "<p>not text</p>";</script>
+<!-- not text either --></body></html>"""
+    assert extract_html(html.decode("ascii")) == (u"Cheese & fondue",
+        u"All about cheese", u"gruyere, emmental", u"Melt the cheese .")
+    assert extract_text("caf\xe9  au lait\n", "text/plain", "iso-8859-1") == \
+           (u"", u"", u"", u"caf\xe9 au lait")
+    assert extract_text("caf\xc3\xa9", "text/plain", "no-such-charset")[3] \
+           == u"caf\xe9"
+    if htmltotext is None:
+        assert extract_text(html, "text/html")[0] == u"Cheese & fondue"
+    assert extract_text("<title>caf\xe9</title>", "text/html",
+                        "iso-8859-1")[0] == u"caf\xe9"
+
+    class TestIndexer (object):
+        """ Stand-in for a BulkIndexer, without a database, which blocks in
+            add() until released.
+        """
+
+        class Document (object):
+            def __init__(self):
+                self.fields = dict()
+
+            def index(self, fieldname, value, **kwargs):
+                self.fields[fieldname] = value
+
+            def set_data(self, data):
+                pass
+
+        def __init__(self):
+            self.docs = list()
+            self.commits = 0
+            self.doccount = 0
+            self.release = Event()
+            self.error = None
+
+        def document(self):
+            return TestIndexer.Document()
+
+        def add(self, doc):
+            self.release.wait()
+            if self.error is not None:
+                raise self.error
+            self.docs.append(doc.fields)
+            self.doccount += 1
+
+        def commit(self):
+            self.commits += 1
+
+        def close(self):
+            self.commit()
+
+    class TestDumper (IndexingDumper):
+        def _open(self, path, fieldmap, indexer_kwargs):
+            return TestIndexer()
+
+    def resource(n, content_type="text/html"):
+        url = StdURL("http://test/{0}".format(n))
+        r = HTTPResource(url, url, {"Content-Type": content_type})
+        r.content = "<title>page {0}</title>".format(n)
+        return r
+
+    # dump_resource() blocks when the queue is full, until the indexer
+    # catches up
+    dumper = TestDumper(None, queue_size=2, commit_interval=0.2)
+    dumper.dump_resource(resource(0, "image/png"))
+    done = Event()
+    def dump():
+        for n in xrange(5):
+            dumper.dump_resource(resource(n))
+        done.set()
+    thread = Thread(target=dump)
+    thread.start()
+    done.wait(0.5)
+    assert not done.isSet() and dumper.queued == 3 # 1 indexing, 2 queued
+    dumper.indexer.release.set()
+    thread.join()
+    assert dumper.wait_time > 0.4
+    # documents are committed within commit_interval, without close()
+    t = time()
+    while dumper.indexer.commits == 0 and time() - t < 2:
+        dumper._thread.join(0.05)
+    assert dumper.indexer.commits == 1
+    dumper.close()
+    s = dumper.stats()
+    assert (s["queued"], s["skipped"], s["indexed"], s["commits"]) == \
+           (5, 1, 5, 2), s
+    assert [doc["title"] for doc in dumper.indexer.docs] == \
+           [u"page {0}".format(n) for n in xrange(5)]
+    print dumper
+
+    # an error in the worker is raised by dump_resource() and close()
+    dumper = TestDumper(None, queue_size=1)
+    dumper.indexer.error = RuntimeError("disk full")
+    dumper.indexer.release.set()
+    try:
+        for n in xrange(10):
+            dumper.dump_resource(resource(n))
+        dumper._thread.join()
+        dumper.dump_resource(resource(n))
+    except RuntimeError:
+        pass
+    else:
+        assert False
+    try:
+        dumper.close()
+    except RuntimeError:
+        pass
+    else:
+        assert False
+    print "TEST PASSED"
@@ -0,0 +1,238 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Module including an incremental HTML link extractor.
+
+    LinkExtractor is fed HTML in chunks (e.g. as they are read), and finds
+    the link targets of each chunk in a single regular expression scan,
+    whatever the order of the attributes, skipping comments, scripts and
+    styles and resolving targets against any <base href>. The robots meta
+    tag is parsed in the same scan, and head_done is set at the end of the
+    head (or the start of the body), after which it should have been seen::
+
+        extractor = LinkExtractor()
+        for chunk in chunks:
+            for url in extractor.feed(chunk):
+                ...
+        for url in extractor.close():
+            ...
+        if extractor.nofollow:
+            ...
+"""
+
+from HTMLParser import HTMLParser
+from urlparse import urljoin
+from re import compile as re_compile, IGNORECASE, DOTALL
+
+
+# a single scan finds comments, scripts and styles (to skip) and the tags of
+# interest; each alternative also matches an incomplete construct at the end
+# of the data (without its closing group), which is kept for the next chunk
+_scan = re_compile(r"<!--.*?(?:(?P<c1>-->)|\Z)"
+                   r"|<(?P<raw>script|style)\b.*?(?:(?P<c2></(?P=raw)\s*>)|\Z)"
+                   r"|<(?P<tag>a|area|link|frame|iframe|img|base|meta"
+                   r"|body|/head)\b"
+                   r"(?P<attrs>(?:\"[^\"]*(?:\"|\Z)|'[^']*(?:'|\Z)|[^'\">])*)"
+                   r"(?:(?P<c3>>)|\Z)", IGNORECASE | DOTALL)
+# the ends of comments, scripts and styles left open at the end of a chunk
+_ends = {"<!--": re_compile("-->"),
+         "script": re_compile(r"</script\s*>", IGNORECASE),
+         "style": re_compile(r"</style\s*>", IGNORECASE)}
+_attr = re_compile(r"([\w:-]+)\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s\"'>]+))")
+_unescape = HTMLParser().unescape
+
+
+class LinkExtractor (object):
+    """ Incremental extractor of link targets (and meta robots) from HTML.
+    """
+
+    # attribute holding the link target, by tag
+    link_attrs = {"a": "href", "area": "href", "link": "href",
+                  "frame": "src", "iframe": "src", "img": "src"}
+    max_tag = 4096 # length of an unclosed tag after which it is skipped
+
+    def __init__(self):
+        self.base = None
+        self.noindex = False
+        self.nofollow = False
+        self.head_done = False
+        self._buffer = ""
+        self._end = None # the end of an open comment, script or style
+
+    def feed(self, data):
+        """ Parse a chunk of HTML, returning the link targets found in it.
+        """
+        return self._parse(self._buffer + data, False)
+
+    def close(self):
+        """ Parse any HTML left, returning the link targets found in it.
+        """
+        return self._parse(self._buffer, True)
+
+    def _parse(self, data, final):
+        """ Scan data for links, keeping any incomplete construct at the end
+            for the next chunk (unless final).
+        """
+        links = list()
+        self._buffer = ""
+        pos = 0
+        if self._end is not None:
+            # only the new data is searched for the end of an open comment,
+            # script or style, so a long one is not rescanned every chunk
+            match = self._end.search(data)
+            if match is None:
+                if not final:
+                    self._keep_end(data)
+                return links
+            self._end = None
+            pos = match.end()
+        while True:
+            match = _scan.search(data, pos)
+            if match is None:
+                break
+            tag = match.group("tag")
+            if match.end() == len(data) and not (match.group("c1") or
+               match.group("c2") or match.group("c3")):
+                if tag is not None and (final or
+                   len(data) - match.start() > LinkExtractor.max_tag):
+                    # probably an unclosed quote, so skip the tag
+                    pos = match.start() + 1
+                    continue
+                if not final:
+                    if tag is None:
+                        raw = match.group("raw")
+                        start = match.start() + (len(raw) + 1 if raw else 4)
+                        self._end = _ends[raw.lower() if raw else "<!--"]
+                        self._keep_end(data[start:])
+                    else:
+                        self._buffer = data[match.start():]
+                return links
+            pos = match.end()
+            if tag is not None:
+                self._tag(tag.lower(), match.group("attrs"), links)
+        # keep the start of any tag cut off at the end
+        i = data.rfind("<", pos)
+        if not final and i >= 0 and ">" not in data[i:]:
+            self._buffer = data[i:]
+        return links
+
+    def _keep_end(self, data):
+        """ Keep the end of data (in an open comment, script or style) which
+            may be the start of its end, cut off.
+        """
+        if self._end is _ends["<!--"]:
+            self._buffer = data[-2:]
+        else:
+            i = data.rfind("<")
+            if i >= 0 and len(data) - i <= LinkExtractor.max_tag:
+                self._buffer = data[i:]
+
+    def _tag(self, tag, attrs, links):
+        """ Handle a tag of interest, with the given attribute string.
+        """
+        values = dict()
+        for name, v1, v2, v3 in _attr.findall(attrs):
+            name = name.lower()
+            if name not in values:
+                value = v1 or v2 or v3
+                if "&" in value:
+                    value = _unescape(value)
+                    if isinstance(value, unicode):
+                        value = value.encode("utf-8")
+                values[name] = value
+        name = LinkExtractor.link_attrs.get(tag)
+        if name is not None:
+            value = values.get(name, "").strip()
+            if value:
+                if self.base is not None:
+                    value = urljoin(self.base, value)
+                links.append(value)
+        elif tag == "base":
+            value = values.get("href", "").strip()
+            if value and self.base is None:
+                self.base = value
+        elif tag == "meta" and values.get("name", "").lower() == "robots":
+            content = values.get("content", "").lower()
+            if "noindex" in content or "none" in content:
+                self.noindex = True
+            if "nofollow" in content or "none" in content:
+                self.nofollow = True
+        elif tag in ("body", "/head"):
+            self.head_done = True
+
+
+if __name__ == "__main__":
+    from time import time
+
+    html = """<html><head>
+<base target="_top" href="http://example.com/dir/">
+<META content="NOINDEX, follow" name="Robots">
+<link rel="stylesheet" href="style.css">
+</head><body>
+<a class="x" href='one.html'>one</a>
+<a name="anchor">no link</a>
+<A HREF="/two.html?a=1&amp;b=2">two</A>
+<img alt="pic" src="pic.png"/>
+<map><area shape="rect" href="three.html"></map>
+<iframe src="http://other.com/frame.html"></iframe>
+<script>document.write("<a href='not.html'>");</script>
+<!-- <a href="commented.html"> -->
+<a title="a > b" href=last.html>last</a>
+<a href="unclosed.html>broken</a> <img src="after.png">
+</body></html>"""
+    expected = ["http://example.com/dir/style.css",
+                "http://example.com/dir/one.html",
+                "http://example.com/two.html?a=1&b=2",
+                "http://example.com/dir/pic.png",
+                "http://example.com/dir/three.html",
+                "http://other.com/frame.html",
+                "http://example.com/dir/last.html",
+                "http://example.com/dir/after.png"]
+    # the same links whatever the chunk size
+    for size in (1, 7, 64, len(html)):
+        extractor = LinkExtractor()
+        links = list()
+        for i in xrange(0, len(html), size):
+            links.extend(extractor.feed(html[i:i + size]))
+        links.extend(extractor.close())
+        assert links == expected, (size, links)
+        assert extractor.noindex and not extractor.nofollow
+        assert extractor.head_done
+
+    # a long comment or script is scanned once, not once per chunk
+    for start, end, close in (("<!--", "-- >\n", ("-", "-", ">")),
+                              ("<script>", "</scrip>\n", ("</scr", "ipt  >"))):
+        extractor = LinkExtractor()
+        links = extractor.feed('<a href="before.html">' + start)
+        chunk = end * 1000
+        t = time()
+        for i in xrange(1000):
+            links.extend(extractor.feed(chunk))
+        assert time() - t < 2, time() - t
+        for chunk in close:
+            links.extend(extractor.feed(chunk))
+        links.extend(extractor.feed('<a href="after.html">'))
+        links.extend(extractor.close())
+        assert links == ["before.html", "after.html"], links
+    # the end of the head is seen, however it is spelt
+    for html in ("<head></HEAD >", "<title>x</title><BODY class=x>"):
+        extractor = LinkExtractor()
+        extractor.feed(html)
+        assert extractor.head_done, html
+    extractor = LinkExtractor()
+    extractor.feed("<head><bodyguard><a href='x'>")
+    assert not extractor.head_done
+    print "TEST PASSED"
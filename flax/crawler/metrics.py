@@ -0,0 +1,398 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Module including crawler metrics, and an HTTP status endpoint for them.
+
+    The crawler records counters (URLs, fetches, bytes, errors by exception
+    class), the time spent waiting for the throttle, on the network and
+    parsing, and histograms of response latency (overall and per host) in
+    crawler.metrics, a Metrics object. Recording is a dict update under a
+    lock, so it is cheap enough to leave on.
+
+    A snapshot of the metrics (a dict, see Metrics.snapshot()) may be sent to
+    sinks periodically by a Reporter, or read over HTTP from a StatusServer::
+
+        server = StatusServer(crawler.metrics, 8089)
+        server.start()
+        Reporter(crawler.metrics, 60, LogSink(open("metrics.log", "a"))).start()
+        crawler.start()
+        server.close()
+
+    The time spent on the threaded engine is the sum for all the threads, so
+    comparing the totals shows whether a crawl is bound by politeness delays,
+    the network or parsing, and the CPU time in the snapshot shows whether
+    the process is CPU bound.
+"""
+
+from bisect import bisect_left
+from json import dumps
+from threading import Lock, Thread, Event
+from time import time
+from os import times
+from sys import stdout
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class Histogram (object):
+    """ Histogram of values (e.g. times in seconds) in fixed buckets, giving
+        approximate percentiles in constant space. This is not synchronized.
+    """
+
+    # upper bounds of the buckets (the last bucket has no bound)
+    bounds = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+              1, 2, 5, 10, 20, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(Histogram.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """ Add a value to the histogram.
+        """
+        self.counts[bisect_left(Histogram.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """ Return the upper bound of the bucket holding the pth percentile
+            (or the maximum value if that is lower), or None if empty.
+        """
+        if self.count == 0:
+            return None
+        rank = p / 100.0 * self.count
+        n = 0
+        for i, count in enumerate(self.counts):
+            n += count
+            if n >= rank and count > 0:
+                if i < len(Histogram.bounds):
+                    return min(Histogram.bounds[i], self.max)
+                break
+        return self.max
+
+    def summary(self):
+        """ Return a dict of the count, mean, minimum, maximum, and 50th, 90th
+            and 99th percentiles.
+        """
+        return dict(count=self.count,
+                    mean=self.total / self.count if self.count else None,
+                    min=self.min,
+                    max=self.max,
+                    p50=self.percentile(50),
+                    p90=self.percentile(90),
+                    p99=self.percentile(99))
+
+
+class Metrics (object):
+    """ A collection of named counters and histograms (optionally per key,
+        e.g. per host), and gauges read when a snapshot is taken.
+
+        Calls are synchronized, so one object may be used by many threads.
+    """
+
+    max_keys = 1000 # number of keys (e.g. hosts) with their own histograms
+    top_keys = 20 # number of keys reported in a snapshot, by their mean
+
+    def __init__(self, sinks=()):
+        """ sinks are objects with a method record(snapshot), called by
+            report().
+        """
+        self.sinks = list(sinks)
+        self.t0 = time()
+        self._counters = dict()
+        self._histograms = dict()
+        self._keyed = dict() # name -> key -> Histogram
+        self._gauges = dict()
+        self._lock = Lock()
+
+    def incr(self, name, n=1):
+        """ Add n (which may be a float, e.g. seconds) to a counter.
+        """
+        self._lock.acquire()
+        try:
+            self._counters[name] = self._counters.get(name, 0) + n
+        finally:
+            self._lock.release()
+
+    def observe(self, name, value, key=None):
+        """ Add a value to a histogram, and to the histogram for a key (e.g.
+            a host) unless max_keys other keys have histograms already.
+        """
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(value)
+            if key is not None:
+                keyed = self._keyed.setdefault(name, dict())
+                histogram = keyed.get(key)
+                if histogram is None and len(keyed) < Metrics.max_keys:
+                    histogram = keyed[key] = Histogram()
+                if histogram is not None:
+                    histogram.add(value)
+        finally:
+            self._lock.release()
+
+    def gauge(self, name, fn):
+        """ Set a function returning a value for a snapshot, replacing any
+            gauge of the same name. fn is called without the lock held, from
+            the thread taking the snapshot.
+        """
+        self._lock.acquire()
+        try:
+            self._gauges[name] = fn
+        finally:
+            self._lock.release()
+
+    def count(self, name):
+        """ Return the value of a counter.
+        """
+        return self._counters.get(name, 0)
+
+    def snapshot(self):
+        """ Return a dict of the metrics:
+
+            time: the time of the snapshot.
+            elapsed: the time since the object was created.
+            cpu: the CPU time used by the process (user and system).
+            counters: the value of each counter.
+            rates: the value of each counter per second elapsed.
+            histograms: a summary of each histogram (see Histogram.summary).
+            hosts: for each histogram with keys, the summaries for the keys
+                with the highest means (top_keys of them).
+            gauges: the value of each gauge, or a description of the
+                exception it raised.
+        """
+        now = time()
+        user, system = times()[:2]
+        self._lock.acquire()
+        try:
+            counters = dict(self._counters)
+            histograms = dict((name, histogram.summary())
+                              for name, histogram in self._histograms.items())
+            hosts = dict()
+            for name, keyed in self._keyed.items():
+                top = sorted(keyed.items(),
+                             key=lambda (key, h): -h.total / h.count)
+                hosts[name] = dict((key, histogram.summary())
+                                   for key, histogram
+                                   in top[:Metrics.top_keys])
+            gauges = self._gauges.items()
+        finally:
+            self._lock.release()
+        elapsed = now - self.t0
+        return dict(time=now,
+                    elapsed=elapsed,
+                    cpu=user + system,
+                    counters=counters,
+                    rates=dict((name, value / elapsed if elapsed else 0.0)
+                               for name, value in counters.items()),
+                    histograms=histograms,
+                    hosts=hosts,
+                    gauges=dict((name, _gauge_value(fn))
+                                for name, fn in gauges))
+
+    def report(self):
+        """ Send a snapshot to each sink.
+        """
+        if self.sinks:
+            snapshot = self.snapshot()
+            for sink in self.sinks:
+                sink.record(snapshot)
+
+    def __str__(self):
+        return format_snapshot(self.snapshot())
+
+
+def _gauge_value(fn):
+    """ Return the value of a gauge, or a description of the exception it
+        raised, so that one failing gauge does not stop the snapshot.
+    """
+    try:
+        return fn()
+    except Exception as e:
+        return "{0}: {1}".format(e.__class__.__name__, e)
+
+
+def format_snapshot(s):
+    """ Return a snapshot as lines of text.
+    """
+    counters = s["counters"]
+    lines = ["{0:.0f}s elapsed, {1:.1f}s CPU".format(s["elapsed"], s["cpu"])]
+    for name in ("urls", "fetches", "bytes", "dumped"):
+        lines.append("{0}: {1} ({2:.1f}/s)".format(
+                     name, counters.get(name, 0), s["rates"].get(name, 0.0)))
+    for name in sorted(counters):
+        if name.startswith("time."):
+            lines.append("{0}: {1:.1f}s".format(name, counters[name]))
+    for name in sorted(counters):
+        if name.startswith("errors."):
+            lines.append("{0}: {1}".format(name, counters[name]))
+    for name, h in sorted(s["histograms"].items()):
+        if h["count"]:
+            lines.append("{0}: mean {1:.3f}s, p50 {2:.3f}s, p90 {3:.3f}s, "
+                         "p99 {4:.3f}s, max {5:.3f}s".format(name, h["mean"],
+                         h["p50"], h["p90"], h["p99"], h["max"]))
+    for name, value in sorted(s["gauges"].items()):
+        lines.append("{0}: {1}".format(name, value))
+    return "\n".join(lines)
+
+
+class LogSink (object):
+    """ Sink writing each snapshot to a file as a line of JSON.
+    """
+
+    def __init__(self, f=stdout):
+        self.f = f
+
+    def record(self, snapshot):
+        self.f.write(dumps(snapshot, sort_keys=True) + "\n")
+        self.f.flush()
+
+
+class Reporter (Thread):
+    """ Daemon thread calling report() on a Metrics object every interval
+        seconds, with the given sinks added to it, until closed.
+    """
+
+    def __init__(self, metrics, interval, *sinks):
+        Thread.__init__(self, name="metrics reporter")
+        self.setDaemon(True)
+        self.metrics = metrics
+        self.interval = interval
+        self.metrics.sinks.extend(sinks)
+        self._closed = Event()
+
+    def run(self):
+        while True:
+            self._closed.wait(self.interval)
+            if self._closed.isSet():
+                break
+            self.metrics.report()
+
+    def close(self):
+        """ Stop reporting, after a last report.
+        """
+        self._closed.set()
+        self.join()
+        self.metrics.report()
+
+
+class _StatusHandler (BaseHTTPRequestHandler):
+    """ Serve a snapshot as text at /, or as JSON at /json.
+    """
+
+    def do_GET(self):
+        snapshot = self.server.metrics.snapshot()
+        if self.path == "/json":
+            body = dumps(snapshot, sort_keys=True)
+            content_type = "application/json"
+        elif self.path == "/":
+            body = format_snapshot(snapshot) + "\n"
+            content_type = "text/plain"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StatusServer (object):
+    """ HTTP server for the metrics, run by a daemon thread. By default only
+        local connections are accepted.
+    """
+
+    def __init__(self, metrics, port=8089, address="127.0.0.1"):
+        """ port may be 0 for any free port (see port once created).
+        """
+        self._server = HTTPServer((address, port), _StatusHandler)
+        self._server.metrics = metrics
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever,
+                              name="metrics server")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+
+if __name__ == "__main__":
+    from urllib2 import urlopen
+    from json import loads
+    from cStringIO import StringIO
+
+    histogram = Histogram()
+    for i in xrange(100):
+        histogram.add(i / 1000.0)
+    summary = histogram.summary()
+    assert summary["count"] == 100 and summary["max"] == 0.099
+    assert summary["p50"] == 0.05 and summary["p99"] == 0.099
+    assert Histogram().percentile(50) is None
+
+    metrics = Metrics()
+    for i in xrange(1500):
+        metrics.incr("fetches")
+        metrics.incr("bytes", 1000)
+        metrics.observe("latency", 0.5 if i % 2 else 0.002,
+                        "host{0}".format(i))
+    metrics.incr("time.network", 2.5)
+    metrics.incr("errors.HTTPError")
+    metrics.gauge("queued", lambda: 42)
+    metrics.gauge("broken", lambda: 1 / 0)
+    s = metrics.snapshot()
+    assert s["counters"]["bytes"] == 1500000
+    assert s["histograms"]["latency"]["count"] == 1500
+    assert len(s["hosts"]["latency"]) == Metrics.top_keys
+    assert [h for h in s["hosts"]["latency"].values() if h["mean"] != 0.5] \
+           == []
+    assert s["gauges"]["queued"] == 42
+    assert s["gauges"]["broken"].startswith("ZeroDivisionError")
+    assert "errors.HTTPError: 1" in str(metrics)
+
+    log = StringIO()
+    reporter = Reporter(metrics, 60, LogSink(log))
+    reporter.start()
+    reporter.close()
+    assert loads(log.getvalue())["counters"]["fetches"] == 1500
+
+    server = StatusServer(metrics, 0)
+    server.start()
+    base = "http://127.0.0.1:{0}".format(server.port)
+    assert loads(urlopen(base + "/json").read())["gauges"]["queued"] == 42
+    assert "fetches: 1500" in urlopen(base + "/").read()
+    server.close()
+    print "TEST PASSED"
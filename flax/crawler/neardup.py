@@ -0,0 +1,357 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Module including a near-duplicate detector, for pages which differ only
+    slightly (e.g. by a timestamp or session ID in the content).
+
+    A 64 bit SimHash signature is computed from the shingles (runs of words)
+    of the text of each page, and pages whose signatures differ in at most
+    max_distance bits are near-duplicates. Signatures are split into
+    max_distance + 1 bands, so a near-duplicate must match at least one band
+    exactly, and are indexed by band (in memory, or in sqlite)::
+
+        crawler.duplicate = NearDuplicateDetector(DefaultDuplicateDetector())
+
+    The existing duplicate detector is called first, so exact duplicates are
+    still rejected by it.
+
+    Each lookup compares the signature with all those sharing one of its
+    bands. With the default 4 bands of 16 bits, and N pages indexed, that is
+    about N / 65536 signatures per band, or 4N / 65536 in all (e.g. 60 for a
+    million pages, 600 for ten million), so the cost of a lookup grows
+    linearly with the crawl, if slowly.
+"""
+
+from crawler import DuplicateResource, _sync
+from binascii import hexlify
+from hashlib import md5
+from operator import methodcaller
+from re import compile as re_compile, IGNORECASE, DOTALL
+from threading import Lock
+from time import time
+
+
+_strip = re_compile("<(script|style)[^>]*>.*?</\\1\s*>|<!--.*?-->|<[^>]*>|" \
+                    "&[#\w]+;", IGNORECASE | DOTALL)
+_word = re_compile("\w+")
+_digest = methodcaller("digest")
+# md5 digests of words, shared by all pages (and replaced when full)
+_digests = dict()
+digest_cache_size = 50000
+# translation of hex digits to "\x01" if bit b of the digit is set, else "\x00"
+_hex_bits = ["".join("\x01" if chr(c) in "0123456789abcdef" and
+                     int(chr(c), 16) >> b & 1 else "\x00"
+                     for c in xrange(256)) for b in xrange(4)]
+
+
+def text_words(content):
+    """ Return the words of (HTML or plain text) content, lower-cased, with
+        tags, scripts and entities removed.
+    """
+    return _word.findall(_strip.sub(" ", content).lower())
+
+
+def simhash(words, shingle=3):
+    """ Return the 64 bit SimHash signature of a list of words, from a hash
+        of each run of shingle words (at most 9).
+
+        Each distinct word is hashed once (with md5), and the hash of a run
+        is the XOR of those of its words, the hash of the kth word being
+        taken from byte k of its digest. The hashes of all the runs are
+        combined at once, as long integers.
+    """
+    if shingle > 9:
+        raise ValueError("shingle must be at most 9 words")
+    shingle = min(shingle, len(words))
+    if not shingle:
+        return 0
+    global _digests
+    digests = _digests
+    if len(digests) > digest_cache_size:
+        digests = _digests = dict()
+    missing = [word for word in set(words) if word not in digests]
+    digests.update(zip(missing, map(_digest, map(md5, missing))))
+    records = "".join(map(digests.__getitem__, words))
+    n = len(words) - shingle + 1
+    # the digests as one long integer, whose last 16 * n bytes are those of
+    # the first word of each run
+    records = long(hexlify(records), 16) << 64
+    mask = (1 << 128 * n) - 1
+    hashes = 0
+    for k in xrange(shingle):
+        # bytes k to k + 7 of the digest of the kth word of each run
+        hashes ^= records >> 8 * (16 * (shingle - 1 - k) + 8 - k) & mask
+    digits = "%0*x" % (32 * n, hashes)
+    signature = 0
+    for d in xrange(16):
+        # count the set bits of the dth hex digit of all the hashes at once,
+        # rather than testing all 64 bits of each hash
+        column = digits[d::32]
+        shift = d // 2 * 8 + (4 if d % 2 == 0 else 0)
+        for b in xrange(4):
+            if column.translate(_hex_bits[b]).count("\x01") * 2 > n:
+                signature |= 1 << (shift + b)
+    return signature
+
+
+def distance(a, b):
+    """ Return the number of bits which differ between two signatures.
+    """
+    return bin(a ^ b).count("1")
+
+
+def _buckets(signature, bands):
+    """ Yield a bucket key for each band of a signature.
+    """
+    bits = 64 // bands
+    mask = (1 << bits) - 1
+    for band in xrange(bands):
+        yield (band << bits) | (signature >> (band * bits) & mask)
+
+
+class SimHashIndex (object):
+    """ In-memory index of signatures by band. This is not synchronized, as
+        calls are made with the NearDuplicateDetector's api_lock held.
+    """
+
+    api_lock = None
+
+    def __init__(self, bands=4):
+        self.bands = bands
+        self._buckets = dict() # bucket key -> list of (signature, URL)
+        self._signatures = dict() # URL -> signature
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def query(self, signature, max_distance, exclude=None):
+        """ Return the URL (other than exclude) of an indexed signature within
+            max_distance bits of the signature, or None.
+        """
+        for key in _buckets(signature, self.bands):
+            for other, url in self._buckets.get(key, ()):
+                if distance(signature, other) <= max_distance and \
+                   url != exclude:
+                    return url
+        return None
+
+    def add(self, signature, url):
+        """ Index the signature of a URL, replacing any indexed for it before.
+        """
+        url = str(url)
+        old = self._signatures.get(url)
+        if old is not None:
+            for key in _buckets(old, self.bands):
+                self._buckets[key].remove((old, url))
+        self._signatures[url] = signature
+        for key in _buckets(signature, self.bands):
+            self._buckets.setdefault(key, list()).append((signature, url))
+
+
+class SQLSimHashIndex (object):
+    """ Index of signatures by band, stored in the simhash table of a
+        sql_crawler.SQLImplementation database.
+
+        Calls are synchronized using the SQLImplementation's api_lock.
+    """
+
+    def __init__(self, sql, bands=4):
+        self.sql = sql
+        self.bands = bands
+        self.api_lock = sql.api_lock
+        self.sql.cursor.executescript("""
+CREATE TABLE IF NOT EXISTS simhash (bucket INTEGER NOT NULL,
+                                    signature INTEGER NOT NULL,
+                                    url VARCHAR(4096) NOT NULL);
+CREATE INDEX IF NOT EXISTS simhash_bucket_idx ON simhash (bucket);
+CREATE INDEX IF NOT EXISTS simhash_url_idx ON simhash (url);
+""")
+
+    def __len__(self):
+        return self.sql.select("SELECT COUNT(*) FROM simhash") // self.bands
+
+    def query(self, signature, max_distance, exclude=None):
+        """ Return the URL (other than exclude) of an indexed signature within
+            max_distance bits of the signature, or None.
+        """
+        keys = list(_buckets(signature, self.bands))
+        for other, url in self.sql.select_iter("SELECT signature, url " \
+                "FROM simhash WHERE bucket IN ({0}) AND url != ?".format(
+                ",".join("?" * len(keys))), *(keys + [str(exclude)])):
+            # signatures are stored as signed 64 bit integers
+            if distance(signature, other & 0xffffffffffffffff) <= max_distance:
+                return str(url)
+        return None
+
+    def add(self, signature, url):
+        """ Index the signature of a URL, replacing any indexed for it before.
+        """
+        self.sql.execute("DELETE FROM simhash WHERE url=?", str(url))
+        if signature >= 1 << 63:
+            signature -= 1 << 64
+        for key in _buckets(signature & 0xffffffffffffffff, self.bands):
+            self.sql.execute("INSERT INTO simhash(bucket, signature, url) " \
+                             "VALUES (?, ?, ?)", key, signature, str(url))
+
+
+class NearDuplicateDetector (object):
+    """ Duplicate detector rejecting text resources whose content is a
+        near-duplicate of one seen before, after checking with another
+        duplicate detector (if given).
+
+        Keeps counts of resources checked and rejected, the bytes of content
+        rejected (so not parsed, stored or indexed), and the time taken (see
+        stats()).
+
+        If the attribute api_lock is a Lock, calls to the API are synchronized.
+    """
+
+    api_lock = Lock()
+
+    content_types = ("text/html", "application/xhtml+xml", "text/plain")
+
+    def __init__(self, detector=None, index=None, max_distance=3, shingle=3,
+                 min_words=10):
+        """ detector is the duplicate detector to call first.
+            index is a SimHashIndex (the default) or SQLSimHashIndex, which
+                should have max_distance + 1 bands.
+            max_distance is the number of bits by which the signatures of
+                near-duplicates may differ.
+            shingle is the number of words in each shingle (at most 9).
+            min_words is the number of words below which content is not
+                checked (as short pages are often similar).
+        """
+        self.detector = detector
+        self.index = index if index is not None else \
+                     SimHashIndex(max_distance + 1)
+        self.max_distance = max_distance
+        self.shingle = shingle
+        self.min_words = min_words
+        self.checked = 0
+        self.duplicates = 0
+        self.bytes = 0
+        self.bytes_rejected = 0
+        self.time = 0.0
+
+    def duplicate_resource(self, resource):
+        """ Check a web resource for duplication, raising DuplicateResource
+            if the detector does, or if its content is a near-duplicate.
+        """
+        if self.detector is not None:
+            _sync(self.detector.duplicate_resource, resource)
+        if resource.body is None or \
+           resource.content_type() not in self.content_types:
+            return
+        t = time()
+        try:
+            words = text_words(resource.content)
+            if len(words) < self.min_words:
+                return
+            self.checked += 1
+            self.bytes += resource.size
+            signature = simhash(words, self.shingle)
+            resource.simhash = signature
+            # a recrawled page is not a duplicate of its own earlier content
+            url = _sync(self.index.query, signature, self.max_distance,
+                        str(resource.url))
+            if url is not None:
+                self.duplicates += 1
+                self.bytes_rejected += resource.size
+                raise DuplicateResource()
+            _sync(self.index.add, signature, resource.url)
+        finally:
+            self.time += time() - t
+
+    def stats(self):
+        """ Return a dict of statistics: resources checked and rejected as
+            near-duplicates, the bytes of content checked and rejected, and
+            the mean time taken per check.
+        """
+        return dict(checked=self.checked,
+                    duplicates=self.duplicates,
+                    bytes=self.bytes,
+                    bytes_rejected=self.bytes_rejected,
+                    mean_time=self.time / self.checked \
+                              if self.checked else 0.0)
+
+    def __str__(self):
+        s = self.stats()
+        return "{0} checked, {1} near-duplicates ({2} of {3} bytes not " \
+               "stored), {4:.3f}ms mean".format(s["checked"],
+               s["duplicates"], s["bytes_rejected"], s["bytes"],
+               s["mean_time"] * 1000)
+
+
+if __name__ == "__main__":
+    from crawler import DefaultDuplicateDetector, HTTPResource
+    from random import Random
+
+    rng = Random(1)
+    vocabulary = ["word{0}".format(i) for i in xrange(1000)]
+    text = " ".join(rng.choice(vocabulary) for _ in xrange(500))
+
+    def resource(url, content):
+        r = HTTPResource(url, url, {"Content-Type": "text/html"})
+        r.content = "<html><body><p>{0}</p></body></html>".format(content)
+        return r
+
+    # the signature of a single run is its hash, bytes k to k + 7 of the
+    # digest of the kth word
+    from struct import unpack
+    run = [md5(word).digest() for word in ("a", "b", "c")]
+    run = "".join(chr(ord(run[0][j]) ^ ord(run[1][j + 1]) ^ ord(run[2][j + 2]))
+                  for j in xrange(8))
+    assert simhash(["a", "b", "c"]) == unpack("<Q", run)[0]
+    assert simhash(["a", "b", "c"]) != simhash(["c", "b", "a"])
+    assert simhash([]) == 0
+    t = time()
+    for i in xrange(100):
+        simhash(text.split())
+    print "{0:.3f}ms per signature of 500 words".format((time() - t) * 10)
+
+    a = simhash(text_words(resource("a", text).content))
+    b = simhash(text_words(resource("b", text + " at 12:00").content))
+    c = simhash(text.split()[::-1])
+    assert distance(a, b) <= 3
+    assert distance(a, c) > 3
+
+    for index in (SimHashIndex(), None):
+        if index is None:
+            from sql_crawler import SQLImplementation
+            index = SQLSimHashIndex(SQLImplementation(":memory:"))
+        detector = NearDuplicateDetector(DefaultDuplicateDetector(), index)
+        detector.duplicate_resource(resource("http://test/a", text))
+        for url, content in (("http://test/a", text),
+                             ("http://test/b", text + " session 1234")):
+            try:
+                detector.duplicate_resource(resource(url, content))
+            except DuplicateResource:
+                pass
+            else:
+                assert False, url
+        other = " ".join(rng.choice(vocabulary) for _ in xrange(500))
+        detector.duplicate_resource(resource("http://test/c", other))
+        assert detector.checked == 3 # exact duplicate not checked
+        assert detector.duplicates == 1
+        assert len(detector.index) == 2
+        # a recrawled page is checked against other pages only, and its
+        # signature replaced
+        recrawled = resource("http://test/c", other + " updated 12:00")
+        detector.duplicate_resource(recrawled)
+        assert detector.duplicates == 1
+        assert len(detector.index) == 2
+        print detector
+    print "TEST PASSED"
@@ -0,0 +1,270 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Module including compact robots.txt rules, and a cache for them.
+
+    RobotRules holds only the rules which apply to one user agent, as a tuple
+    of (path prefix, allowed) pairs checked in the original order (as by
+    robotparser.RobotFileParser), plus the Crawl-delay. Rules are stored as
+    JSON rather than pickled parser objects.
+"""
+
+from urllib import quote, unquote
+from urlparse import urlparse, urlunparse
+from pickle import loads as pickle_loads
+from json import dumps, loads
+
+
+class RobotRules (object):
+    """ The robots.txt rules for a user agent.
+    """
+
+    __slots__ = ("rules", "delay")
+
+    def __init__(self, rules=(), delay=None):
+        """ rules is a sequence of (path prefix, allowed) pairs, and delay is
+            the Crawl-delay in seconds (or None).
+        """
+        self.rules = tuple(rules)
+        self.delay = delay
+
+    @classmethod
+    def parse(cls, content, user_agent):
+        """ Parse robots.txt content, returning the rules for the user agent.
+            If content is None, everything is allowed.
+        """
+        if content is None:
+            return cls()
+        # states as for RobotFileParser.parse: 0 start, 1 saw user-agent,
+        # 2 saw a rule
+        entries = list()
+        agents, rules, delay = list(), list(), None
+        state = 0
+        for line in content.split("\n"):
+            if not line:
+                if state == 2:
+                    entries.append((agents, rules, delay))
+                if state != 0:
+                    agents, rules, delay = list(), list(), None
+                    state = 0
+            i = line.find("#")
+            if i >= 0:
+                line = line[:i]
+            key, sep, value = line.strip().partition(":")
+            if not sep:
+                continue
+            key = key.strip().lower()
+            value = unquote(value.strip())
+            if key == "user-agent":
+                if state == 2:
+                    entries.append((agents, rules, delay))
+                    agents, rules, delay = list(), list(), None
+                agents.append(value)
+                state = 1
+            elif key in ("allow", "disallow") and state != 0:
+                rules.append(_rule(value, key == "allow"))
+                state = 2
+            elif key == "crawl-delay" and state != 0:
+                try:
+                    delay = float(value)
+                except ValueError:
+                    pass
+                state = 2
+        if state == 2:
+            entries.append((agents, rules, delay))
+        # the first entry naming the agent applies, or else the first default
+        name = user_agent.split("/")[0].lower()
+        default = None
+        for agents, rules, delay in entries:
+            if "*" in agents:
+                if default is None:
+                    default = cls(rules, delay)
+            elif [a for a in agents if a.lower() in name]:
+                return cls(rules, delay)
+        return default or cls()
+
+    @classmethod
+    def from_parser(cls, parser, user_agent):
+        """ Return the rules for the user agent from a
+            robotparser.RobotFileParser (e.g. as pickled by older versions).
+        """
+        if parser.disallow_all:
+            return cls((("", False), ))
+        entry = None
+        for e in parser.entries:
+            if e.applies_to(user_agent):
+                entry = e
+                break
+        else:
+            entry = parser.default_entry
+        if parser.allow_all or entry is None:
+            return cls()
+        return cls([(r.path, r.allowance) for r in entry.rulelines])
+
+    def allowed(self, path):
+        """ Return True if the rules allow the path (and query) to be fetched.
+        """
+        parts = urlparse(unquote(path))
+        path = quote(urlunparse(("", "", parts.path, parts.params,
+                                 parts.query, parts.fragment))) or "/"
+        for prefix, allowed in self.rules:
+            if path.startswith(prefix):
+                return allowed
+        return True
+
+    def dumps(self):
+        """ Return the rules as a JSON string.
+        """
+        return dumps({"rules": self.rules, "delay": self.delay})
+
+    @classmethod
+    def loads(cls, data, user_agent):
+        """ Load rules stored by dumps(), or a pickled RobotFileParser.
+        """
+        if data.startswith("{"):
+            d = loads(data)
+            return cls([(str(p), a) for p, a in d["rules"]], d["delay"])
+        return cls.from_parser(pickle_loads(data), user_agent)
+
+
+def _rule(path, allowed):
+    """ Return a (prefix, allowed) pair, normalised as by robotparser.
+    """
+    if path == "" and not allowed:
+        # an empty Disallow allows everything
+        allowed = True
+    if path == "*":
+        return "", allowed
+    return quote(urlunparse(urlparse(path))), allowed
+
+
+class RobotCache (object):
+    """ Least-recently-used cache of RobotRules keyed by netloc, with hit
+        statistics. This is not synchronized.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._map = dict()
+        # circular doubly-linked list of [prev, next, key, value]
+        self._root = root = list()
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def get(self, netloc):
+        """ Return the rules for netloc, or None if not cached.
+        """
+        link = self._map.get(netloc)
+        if link is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def put(self, netloc, rules):
+        """ Cache the rules for netloc, replacing any cached already.
+        """
+        self.discard(netloc)
+        if len(self._map) >= self.maxsize:
+            self.discard(self._root[1][2])
+        link = [None, None, netloc, rules]
+        self._map[netloc] = link
+        self._append(link)
+
+    def discard(self, netloc):
+        """ Remove the rules for netloc, if cached.
+        """
+        link = self._map.pop(netloc, None)
+        if link is not None:
+            self._unlink(link)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        """ Return a dict of cache statistics.
+        """
+        return dict(size=len(self._map), hits=self.hits, misses=self.misses,
+                    hit_rate=self.hit_rate())
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    @staticmethod
+    def _unlink(link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+
+if __name__ == "__main__":
+    from robotparser import RobotFileParser
+    from pickle import dumps as pickle_dumps
+
+    agent = "FlaxBot/0.1 (see http://www.flax.co.uk/)"
+    content = """# test
+User-agent: OtherBot
+Disallow: /
+
+User-agent: *
+Disallow: /private
+Allow: /tmp/public
+Disallow: /tmp
+Crawl-delay: 2.5
+
+User-agent: flaxbot
+Allow: /private/flax
+Disallow: /private
+Disallow: /a%20b
+"""
+    paths = ("/", "/private", "/private/flax/x", "/tmp/public/x", "/tmp/x",
+             "/a b", "/a%20b", "/index.html?q=1")
+    parser = RobotFileParser()
+    parser.parse(content.split("\n"))
+    for ua in (agent, "OtherBot/1.0", "Mozilla/5.0"):
+        rules = RobotRules.parse(content, ua)
+        legacy = RobotRules.loads(pickle_dumps(parser), ua)
+        stored = RobotRules.loads(rules.dumps(), ua)
+        assert legacy.rules == rules.rules
+        assert stored.rules == rules.rules and stored.delay == rules.delay
+        for path in paths:
+            expected = parser.can_fetch(ua, path)
+            assert rules.allowed(path) == expected, (ua, path)
+    assert RobotRules.parse(content, agent).delay is None
+    assert RobotRules.parse(content, "Mozilla/5.0").delay == 2.5
+    assert RobotRules.parse(None, agent).allowed("/anything")
+
+    cache = RobotCache(2)
+    cache.put("a", RobotRules())
+    cache.put("b", RobotRules())
+    assert cache.get("a") is not None
+    cache.put("c", RobotRules())
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert len(cache) == 2
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+    print "TEST PASSED"
@@ -0,0 +1,237 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Module including a compact set of the URLs seen by a crawl.
+
+    A SeenSet stores a 64 bit hash of each URL (of its string form, which is
+    canonical for StdURL) in an open-addressing hash table, using 8 bytes per
+    slot rather than a StdURL object per URL. The chance of two URLs having
+    the same hash is negligible (about 1 in 10^7 for a crawl of a million
+    URLs).
+
+    The table may be moved to a memory-mapped temporary file when it grows
+    beyond max_memory bytes, so that it is paged by the operating system
+    rather than limiting the size of the crawl. A Bloom filter may then be
+    kept in memory in front of the table, so that most URLs not seen do not
+    touch the file.
+"""
+
+from hashlib import md5
+from struct import Struct
+from mmap import mmap
+from tempfile import TemporaryFile
+from math import log, ceil
+
+
+_slot = Struct("<Q")
+
+
+def url_hash(url):
+    """ Return a non-zero 64 bit hash of a URL (StdURL or string).
+    """
+    h = _slot.unpack(md5(str(url)).digest()[:8])[0]
+    return h or 1
+
+
+class BloomFilter (object):
+    """ Bloom filter of 64 bit hashes, sized for a number of entries and a
+        false positive rate.
+    """
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        bits = int(ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+        self.size = max(bits, 8)
+        self.hashes = max(int(round(self.size / float(capacity) * log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, h):
+        # double hashing from the two halves of the hash
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        size = self.size
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % size
+
+    def add(self, h):
+        bits = self._bits
+        for p in self._positions(h):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, h):
+        bits = self._bits
+        for p in self._positions(h):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+class SeenSet (object):
+    """ Set of URLs, stored as 64 bit hashes in a hash table with linear
+        probing. This is not synchronized.
+    """
+
+    def __init__(self, capacity=65536, max_load=0.6, max_memory=None,
+                 spill_dir=None, error_rate=None):
+        """ Create an empty set.
+
+            capacity is the initial number of slots (rounded up to a power of
+                two). The table doubles when it is more than max_load full.
+            max_memory is the size in bytes above which the table is kept in
+                a memory-mapped temporary file (in spill_dir, or the default
+                temporary directory), or None to keep it in memory.
+            error_rate is the false positive rate of a Bloom filter checked
+                before the table, or None for no filter.
+        """
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.max_load = max_load
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.error_rate = error_rate
+        self.probes = 0
+        self.filtered = 0
+        self._count = 0
+        self._file = None
+        self._initial_size = size
+        self._allocate(size)
+
+    def __len__(self):
+        return self._count
+
+    def _allocate(self, size):
+        """ Create an empty table of size slots, and a Bloom filter for it.
+        """
+        self._size = size
+        self._mask = size - 1
+        self._limit = int(size * self.max_load)
+        nbytes = size * _slot.size
+        if self.max_memory is not None and nbytes > self.max_memory:
+            f = TemporaryFile(dir=self.spill_dir)
+            f.truncate(nbytes)
+            self._table = mmap(f.fileno(), nbytes)
+            self._file = f
+        else:
+            self._table = bytearray(nbytes)
+            self._file = None
+        self._bloom = BloomFilter(self._limit, self.error_rate) \
+                      if self.error_rate is not None else None
+
+    def _find(self, h):
+        """ Return (slot, found) for a hash: the slot holding it, or the empty
+            slot where it belongs.
+        """
+        table = self._table
+        unpack = _slot.unpack_from
+        mask = self._mask
+        i = h & mask
+        while True:
+            self.probes += 1
+            value = unpack(table, i << 3)[0]
+            if value == h:
+                return i, True
+            if value == 0:
+                return i, False
+            i = (i + 1) & mask
+
+    def __contains__(self, url):
+        h = url_hash(url)
+        if self._bloom is not None and h not in self._bloom:
+            self.filtered += 1
+            return False
+        return self._find(h)[1]
+
+    def add(self, url):
+        """ Add a URL (StdURL or string) to the set.
+        """
+        h = url_hash(url)
+        i, found = self._find(h)
+        if found:
+            return
+        _slot.pack_into(self._table, i << 3, h)
+        if self._bloom is not None:
+            self._bloom.add(h)
+        self._count += 1
+        if self._count > self._limit:
+            self._grow()
+
+    def _grow(self):
+        """ Double the size of the table, rehashing the entries.
+        """
+        old, old_file = self._table, self._file
+        old_size = self._size
+        self._allocate(old_size * 2)
+        unpack = _slot.unpack_from
+        pack = _slot.pack_into
+        table = self._table
+        mask = self._mask
+        bloom = self._bloom
+        for offset in xrange(0, old_size << 3, 8):
+            h = unpack(old, offset)[0]
+            if h == 0:
+                continue
+            i = h & mask
+            while unpack(table, i << 3)[0] != 0:
+                i = (i + 1) & mask
+            pack(table, i << 3, h)
+            if bloom is not None:
+                bloom.add(h)
+        if old_file is not None:
+            old.close()
+            old_file.close()
+
+    def close(self):
+        """ Release the table (and any temporary file). The set is then empty.
+        """
+        if self._file is not None:
+            self._table.close()
+            self._file.close()
+        self._count = 0
+        self._allocate(self._initial_size)
+
+    def stats(self):
+        """ Return a dict of statistics: the number of URLs, the table size in
+            slots and bytes, whether it is memory-mapped, the number of table
+            slots probed and the lookups answered by the Bloom filter alone.
+        """
+        return dict(urls=self._count,
+                    slots=self._size,
+                    bytes=self._size * _slot.size,
+                    mapped=self._file is not None,
+                    probes=self.probes,
+                    filtered=self.filtered)
+
+
+if __name__ == "__main__":
+    from stdurl import StdURL
+
+    for kwargs in (dict(), dict(capacity=8, max_memory=64, error_rate=0.01)):
+        seen = SeenSet(**kwargs)
+        urls = ["http://host{0}/page{1}".format(i % 7, i) for i in xrange(5000)]
+        for url in urls[::2]:
+            seen.add(StdURL(url))
+        seen.add(urls[0])
+        assert len(seen) == 2500
+        for i, url in enumerate(urls):
+            assert (StdURL(url) in seen) == (i % 2 == 0), url
+        assert "http://host0/page0" in seen
+        stats = seen.stats()
+        assert stats["mapped"] == ("max_memory" in kwargs)
+        if "error_rate" in kwargs:
+            assert stats["filtered"] > 2400
+        seen.close()
+        assert len(seen) == 0 and urls[0] not in seen
+    print "TEST PASSED"
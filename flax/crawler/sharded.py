@@ -0,0 +1,421 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Module for crawling with several processes, each crawling a shard of the
+    domains (by a hash of the netloc) into its own sql_crawler database.
+
+    As each domain is crawled by only one process, the throttle, robots.txt
+    and URL pool of each process only hold its own domains. Links to URLs in
+    other shards are sent to their process through a queue, as are redirects
+    to them (whose content is then fetched by that process). A coordinator
+    process (the one calling crawl()) reports the progress of all the
+    shards, and stops them when none has any URLs left to crawl::
+
+        crawler.follow = DefaultFollowDecider("^text/html$")
+        crawl("crawl.db", ["http://test/"], shards=4)
+
+    The crawler module should be configured before calling crawl(), as the
+    worker processes are forked from the coordinator. Each worker sets the
+    dump, pool, duplicate, throttle, robots and error objects of the crawler
+    module to its own SQLImplementation (in the database path followed by
+    the shard number, e.g. crawl.db.0), so content duplicates are only
+    detected within a shard.
+"""
+
+import crawler
+from crawler import DuplicateURL, RedirectHandedOff
+from sql_crawler import SQLImplementation
+from seenset import SeenSet
+from stdurl import StdURL
+from multiprocessing import Process, Queue, Value
+from Queue import Empty
+from hashlib import md5
+from os import unlink
+from os.path import isfile
+from time import time
+
+
+report_interval = 5 # time between progress reports
+
+
+def shard_of(netloc, shards):
+    """ Return the shard for a domain.
+    """
+    return int(md5(netloc).hexdigest()[:8], 16) % shards
+
+
+def shard_path(path, shard):
+    """ Return the database path for a shard.
+    """
+    return "{0}.{1}".format(path, shard)
+
+
+class _Work (object):
+    """ Count of the work left in all the shards: the number of workers with
+        URLs to crawl, plus the number of URLs sent but not yet received.
+
+        A worker only sends URLs while it is counted as busy, so when the
+        count reaches zero there is no work left anywhere.
+    """
+
+    def __init__(self, n):
+        self._value = Value("i", n)
+
+    def add(self, n):
+        lock = self._value.get_lock()
+        lock.acquire()
+        try:
+            self._value.value += n
+        finally:
+            lock.release()
+
+    def done(self):
+        return self._value.value == 0
+
+
+class ShardedURLPool (object):
+    """ URL pool for one shard, adding URLs in the shard to another URL pool,
+        and sending those in other shards to their queues.
+
+        Calls are synchronized using the api_lock of the other URL pool.
+    """
+
+    def __init__(self, pool, shard, queues, work, progress):
+        """ pool is the URL pool for this shard, queues are the queues for
+            URLs for each shard, work is the shared _Work count and progress
+            the queue for progress reports.
+        """
+        self.pool = pool
+        self.shard = shard
+        self.api_lock = getattr(pool, "api_lock", None)
+        self.handed_out = 0
+        self.sent = 0
+        self.received = 0
+        self._queues = queues
+        self._work = work
+        self._progress = progress
+        self._sent = SeenSet()
+        self._last_report = time()
+
+    def _local(self, url):
+        return shard_of(url.netloc, len(self._queues)) == self.shard
+
+    def add_url(self, url):
+        if self._local(url):
+            self.pool.add_url(url)
+        elif url not in self._sent:
+            # count the URL as work before sending it, while this shard is
+            # busy, so the count can not reach zero while it is queued
+            self._work.add(1)
+            self._queues[shard_of(url.netloc, len(self._queues))].put(
+                str(url))
+            self._sent.add(url)
+            self.sent += 1
+
+    def add_link(self, source, target):
+        self.pool.add_link(source, target)
+
+    def add_redirect(self, source, target):
+        self.pool.add_redirect(source, target)
+
+    def check_url(self, url):
+        if self._local(url):
+            self.pool.check_url(url)
+        elif url in self._sent:
+            raise DuplicateURL()
+
+    def hand_off(self, url):
+        """ Send the target of a redirect to its shard, returning True, or
+            return False if it is in this shard.
+        """
+        if self._local(url):
+            return False
+        self.add_url(url)
+        return True
+
+    def receive(self, url):
+        """ Add a URL received from another shard.
+        """
+        self.received += 1
+        url = StdURL(url)
+        try:
+            self.pool.check_url(url)
+            self.pool.add_url(url)
+        except DuplicateURL:
+            pass
+
+    def next_url(self):
+        """ Add any URLs received from other shards, and return the next URL
+            from the pool.
+        """
+        queue = self._queues[self.shard]
+        while True:
+            try:
+                url = queue.get_nowait()
+            except Empty:
+                break
+            # this shard is already counted as busy
+            self._work.add(-1)
+            self.receive(url)
+        if time() - self._last_report >= report_interval:
+            self.report()
+        url = self.pool.next_url()
+        if url is not None:
+            self.handed_out += 1
+        return url
+
+    def report(self, idle=False):
+        """ Send the progress of this shard to the coordinator.
+        """
+        self._last_report = time()
+        self._progress.put((self.shard, idle, self.handed_out, self.sent,
+                            self.received))
+
+    def __getattr__(self, name):
+        # e.g. validators and not_modified
+        return getattr(self.pool, name)
+
+
+def _worker(path, shard, queues, work, progress):
+    """ Crawl a shard, until told to stop.
+    """
+    new = not isfile(shard_path(path, shard))
+    sql = SQLImplementation(shard_path(path, shard))
+    if new:
+        sql.initialise()
+    pool = ShardedURLPool(sql, shard, queues, work, progress)
+    crawler.dump = sql
+    crawler.duplicate = sql
+    crawler.throttle = sql
+    crawler.robots = sql
+    crawler.error = sql
+    crawler.pool = pool
+    try:
+        while True:
+            crawler.start()
+            sql.commit()
+            pool.report(idle=True)
+            work.add(-1)
+            url = queues[shard].get()
+            if url is None:
+                break
+            # the URL's count is now this shard's (busy) count
+            pool.receive(url)
+    finally:
+        sql.close()
+
+
+def crawl(path, urls, shards=4, initialise=False):
+    """ Crawl from the given URLs with a number of worker processes, until
+        there are no URLs left, reporting progress to stdout. Databases left
+        by a previous crawl are continued unless initialise is True.
+    """
+    if initialise:
+        for shard in xrange(shards):
+            if isfile(shard_path(path, shard)):
+                unlink(shard_path(path, shard))
+    queues = [Queue() for _ in xrange(shards)]
+    progress = Queue()
+    # every worker starts busy, as its database may have URLs left to crawl
+    work = _Work(shards + len(urls))
+    for url in urls:
+        url = StdURL(url)
+        queues[shard_of(url.netloc, shards)].put(str(url))
+    workers = [Process(target=_worker, args=(path, shard, queues, work,
+                                              progress))
+               for shard in xrange(shards)]
+    for worker in workers:
+        worker.start()
+    state = dict()
+    t0 = time()
+    last = t0
+    try:
+        while not work.done():
+            try:
+                shard, idle, handed_out, sent, received = \
+                    progress.get(timeout=0.5)
+                state[shard] = (idle, handed_out, sent, received)
+            except Empty:
+                pass
+            if [w for w in workers if w.exitcode not in (None, 0)]:
+                raise RuntimeError("a crawler process failed")
+            if time() - last >= report_interval:
+                last = time()
+                _report(state, shards, last - t0)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+    while True:
+        try:
+            shard, idle, handed_out, sent, received = progress.get_nowait()
+            state[shard] = (idle, handed_out, sent, received)
+        except Empty:
+            break
+    _report(state, shards, time() - t0)
+
+
+def _report(state, shards, elapsed):
+    """ Print the progress of all the shards.
+    """
+    values = state.values()
+    handed_out = sum(v[1] for v in values)
+    print "{0:.0f}s: {1} URLs crawled ({2:.1f}/s), {3} sent between " \
+          "shards, {4}/{5} shards busy".format(elapsed, handed_out,
+          handed_out / elapsed if elapsed else 0.0,
+          sum(v[2] for v in values), shards - sum(1 for v in values if v[0]),
+          shards)
+
+
+def _test(shards=3, hosts=5, pages=20):
+    """ Crawl without network access, replacing crawler.start() with a
+        function handing out the URLs of the pool, where each page links to
+        the next page on its own host and on the next host. URLs are sent
+        between the shards throughout, so the workers go idle and restart.
+    """
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from os.path import join
+    from Queue import Queue as LocalQueue
+
+    def links(url):
+        host, page = int(url.netloc[4:-5]), int(url.path[1:])
+        if page == pages:
+            return []
+        return [StdURL("http://host{0}.test/{1}".format(h % hosts, page + 1))
+                for h in (host, host + 1)]
+
+    starts = Value("i", 0)
+
+    def start():
+        starts.get_lock().acquire()
+        starts.value += 1
+        starts.get_lock().release()
+        pool = crawler.pool
+        while True:
+            url = pool.next_url()
+            if url is None:
+                return
+            if url.path == "/robots.txt":
+                continue
+            for target in links(url):
+                try:
+                    pool.check_url(target)
+                except DuplicateURL:
+                    continue
+                pool.add_url(target)
+
+    first = StdURL("http://host0.test/0")
+    expected = set([str(first)])
+    todo = [first]
+    while todo:
+        for target in links(todo.pop()):
+            if str(target) not in expected:
+                expected.add(str(target))
+                todo.append(target)
+
+    tmp = mkdtemp()
+    crawler_start = crawler.start
+    try:
+        crawler.start = start
+        path = join(tmp, "test.db")
+        crawl(path, [str(first)], shards, initialise=True)
+        crawled = []
+        for shard in xrange(shards):
+            sql = SQLImplementation(shard_path(path, shard))
+            urls = [str(url) for (url, ) in
+                    sql.select_iter("SELECT url FROM url WHERE time > 0")]
+            sql.close()
+            assert [url for url in urls
+                    if shard_of(StdURL(url).netloc, shards) != shard] == []
+            crawled.extend(urls)
+        # every URL crawled once, by its own shard
+        assert sorted(crawled) == sorted(expected)
+        # every worker started once, and restarted for URLs sent to it
+        assert starts.value > shards
+
+        # a crawl continued with no URLs left finishes at once
+        crawl(path, [], shards)
+    finally:
+        crawler.start = crawler_start
+        rmtree(tmp)
+
+    # redirects to other shards are handed off
+    sql = SQLImplementation(":memory:")
+    sql.initialise()
+    queues = [LocalQueue() for _ in xrange(shards)]
+    work = _Work(1)
+    pool = ShardedURLPool(sql, 0, queues, work, LocalQueue())
+    urls = [StdURL("http://host{0}.test/".format(h)) for h in xrange(10)]
+    local = [url for url in urls if shard_of(url.netloc, shards) == 0]
+    remote = [url for url in urls if shard_of(url.netloc, shards) != 0]
+    assert not pool.hand_off(local[1])
+    pool.add_url(local[0])
+    crawler_pool = crawler.pool
+    try:
+        crawler.pool = pool
+        crawler._check_headers(local[0], remote[0],
+                               {"Content-Type": "text/html"})
+    except RedirectHandedOff:
+        pass
+    else:
+        assert False
+    finally:
+        crawler.pool = crawler_pool
+    assert queues[shard_of(remote[0].netloc, shards)].get_nowait() == \
+           str(remote[0])
+    assert work._value.value == 2
+    sql.close()
+    print "TEST PASSED"
+
+
+if __name__ == "__main__":
+    from sys import argv
+    from crawler import DefaultFollowDecider
+
+    args = argv[1:]
+    shards = 4
+    if "-n" in args:
+        i = args.index("-n")
+        shards = int(args[i + 1])
+        del args[i:i + 2]
+    if "-v" in args:
+        crawler.silent = False
+    if "-q" in args:
+        crawler.default_delay = 0
+    initialise = "-i" in args
+    domain = "-d" in args
+    test = "-t" in args
+    args = [arg for arg in args if arg[0] != "-"]
+
+    if test:
+        _test()
+        exit()
+    if len(args) < 1:
+        print """Usage: [-n <shards>|-v|-q|-i|-d|-t] <db path> [<initial URL>...]
+
+Flags: -n  Number of crawler processes (default 4)
+       -v  Output debug messages
+       -q  Set default delay to 0
+       -i  Initialise databases (erases any data)
+       -d  Do not follow links out of the initial domains
+       -t  Run a self-test (without network access)
+"""
+        exit()
+
+    crawler.follow = DefaultFollowDecider("^text/html$|^image/.*", domain)
+    crawl(args[0], args[1:], shards, initialise)
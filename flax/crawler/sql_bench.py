@@ -0,0 +1,195 @@
+# Copyright (C) 2010 Lemur Consulting Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Benchmark for sql_crawler.py, replaying a crawl against a new database
+    without any network access.
+
+    The crawl is read from an existing sql_crawler database (the URLs with
+    content, and the links from them), or a synthetic crawl of a number of
+    pages is generated. The calls the crawler would make to the SQL
+    implementation are then replayed, for each commit interval given::
+
+        python sql_bench.py [-n <pages>] [-c <interval>[,<interval>...]]
+                            [-d <domains>] [<recorded db path>]
+
+    By default, 10000 synthetic pages are replayed with commit intervals of 0
+    (commit after every statement) and 1 second.
+
+    The rate of next_url() late in a broad crawl is then measured, with a
+    number of domains (by default 200000) which have no URLs left to fetch
+    and one which has.
+"""
+
+import crawler
+from crawler import CrawlerError, HTTPResource
+from sql_crawler import SQLImplementation
+from stdurl import StdURL
+from hashlib import md5
+from random import Random
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from time import time
+from sqlite3 import connect
+
+
+def load_crawl(path):
+    """ Return (start URL, dict of URL to (content, links)) from a
+        sql_crawler database.
+    """
+    db = connect(path)
+    pages = dict()
+    for url_id, url, content in db.execute("SELECT url.id, url, content " \
+            "FROM url, content WHERE content.url_id=url.id ORDER BY url.id"):
+        links = [target for (target, ) in db.execute("SELECT url FROM " \
+                 "link, url WHERE source_id=? AND url.id=target_id", (url_id, ))]
+        pages[str(url)] = (str(content), links)
+    db.close()
+    start = min(pages, key=len) if pages else None
+    return start, pages
+
+
+def synthetic_crawl(n, seed=42, hosts=20, links=20):
+    """ Return (start URL, dict of URL to (content, links)) for a synthetic
+        crawl of n pages across a number of hosts.
+    """
+    rng = Random(seed)
+    urls = ["http://host{0}.example.com/page{1}.html".format(i % hosts, i)
+            for i in xrange(n)]
+    pages = dict()
+    for i, url in enumerate(urls):
+        targets = [urls[rng.randint(0, n - 1)] for _ in xrange(links)]
+        content = "<html>{0} {1}</html>".format(url, "x" * rng.randint(0, 20000))
+        pages[url] = (content, targets)
+    return urls[0], pages
+
+
+def replay(sql, start, pages):
+    """ Replay the crawl of pages against a SQLImplementation, in the order
+        the crawler would make the calls. Returns the number of URLs handed
+        out by next_url.
+    """
+    sql.add_url(StdURL(start))
+    count = 0
+    while True:
+        url = sql.next_url()
+        if url is None:
+            break
+        count += 1
+        if url.path == "/robots.txt":
+            sql.last_time(url.netloc)
+            sql.parse_robots(url.netloc, "User-agent: *\nDisallow:\n")
+            continue
+        try:
+            sql.check_robots(url)
+            sql.last_time(url.netloc)
+            page = pages.get(str(url))
+            if page is None:
+                continue
+            content, links = page
+            headers = {"Content-Type": "text/html",
+                       "ETag": md5(str(url)).hexdigest()}
+            resource = HTTPResource(url, url, headers)
+            sql.duplicate_resource(resource)
+            resource.content = content
+            sql.duplicate_resource(resource)
+            for link in links:
+                target = StdURL(link)
+                sql.add_link(url, target)
+                try:
+                    sql.check_url(target)
+                except CrawlerError:
+                    continue
+                sql.add_url(target)
+            sql.dump_resource(resource)
+        except CrawlerError as e:
+            sql.error(url, e)
+    return count
+
+
+def crawled_out(domains, urls=1000):
+    """ Return the rate of next_url() calls (per second) with a number of
+        domains fetched already, and one domain with URLs to fetch.
+    """
+    tmp = mkdtemp()
+    try:
+        sql = SQLImplementation(join(tmp, "bench.db"), commit_interval=1.0)
+        sql.initialise()
+        t = int(time())
+        sql.cursor.executemany("INSERT INTO domain(netloc, time) " \
+            "VALUES (?, ?)", (("host{0}.example.com".format(i), t - i)
+                              for i in xrange(domains)))
+        sql.cursor.executemany("INSERT INTO url(domain_id, url, time) " \
+            "VALUES (?, ?, ?)", ((i + 1, "http://host{0}.example.com/"
+                                  .format(i), t) for i in xrange(domains)))
+        for i in xrange(urls):
+            sql.add_url(StdURL("http://live.example.com/{0}".format(i)))
+        sql.commit()
+        sql.next_url() # robots.txt
+        t = time()
+        for i in xrange(urls):
+            assert sql.next_url() is not None
+        t = time() - t
+        sql.close()
+    finally:
+        rmtree(tmp)
+    return urls / t
+
+
+def main(path, n, intervals, domains):
+    if path is not None:
+        start, pages = load_crawl(path)
+    else:
+        start, pages = synthetic_crawl(n)
+    links = sum(len(links) for _, links in pages.itervalues())
+    print "{0} pages, {1} links".format(len(pages), links)
+    crawler.default_delay = 0
+    for interval in intervals:
+        tmp = mkdtemp()
+        try:
+            sql = SQLImplementation(join(tmp, "bench.db"),
+                                    commit_interval=interval)
+            sql.initialise()
+            t = time()
+            count = replay(sql, start, pages)
+            sql.close()
+            t = time() - t
+        finally:
+            rmtree(tmp)
+        print "commit interval {0}s: {1} URLs in {2:.2f}s ({3:.0f} URLs/s, " \
+              "{4:.0f} links/s), {5} commits".format(interval, count, t,
+              count / t, links / t, sql.commits)
+    if domains:
+        print "{0} crawled out domains: {1:.0f} URLs/s".format(domains,
+              crawled_out(domains))
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    args = argv[1:]
+    n = 10000
+    intervals = [0, 1.0]
+    domains = 200000
+    while len(args) > 1 and args[0] in ("-n", "-c", "-d"):
+        if args[0] == "-n":
+            n = int(args[1])
+        elif args[0] == "-d":
+            domains = int(args[1])
+        else:
+            intervals = [float(x) for x in args[1].split(",")]
+        args = args[2:]
+    main(args[0] if args else None, n, intervals, domains)
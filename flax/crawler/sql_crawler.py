@@ -17,7 +17,8 @@
 """ Reference implementation of crawler, storing URLs in an SQL database (using
     sqlite3). Note (at least):
     
-    * It's quite inefficient - SQL operations should be batched, results cached
+    * Writes are committed in batches (see SQLImplementation), so a crash can
+      lose up to commit_interval seconds of work
     * No error handling - e.g. URLs are abandoned if they raise IncompleteRead
     * The default HTML parser doesn't understand meta redirects
 """
@@ -25,13 +26,13 @@
 import crawler
 from crawler import DefaultFollowDecider, DefaultHtmlParser, URLNotAllowed, \
                     NoRobots, DuplicateResource, DuplicateURL, URLNotFollowed,\
-                    _debug
-from robotparser import RobotFileParser
+                    AdaptiveThrottle, _debug
+from robotrules import RobotRules, RobotCache
+from neardup import NearDuplicateDetector, SQLSimHashIndex
+from metrics import StatusServer
 from time import time
-from pickle import dumps, loads
 from threading import Lock
-from hashlib import md5
-from sqlite3 import connect, Row, DatabaseError, Binary
+from sqlite3 import connect, Row, DatabaseError, Binary, sqlite_version_info
 from os import unlink
 from os.path import isfile
 
@@ -46,7 +47,8 @@ CREATE TABLE content (id INTEGER PRIMARY KEY AUTOINCREMENT,
 CREATE TABLE domain (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      netloc VARCHAR(256) NOT NULL UNIQUE,
                      robots BLOB,
-                     time INTEGER DEFAULT 0);
+                     time INTEGER DEFAULT 0,
+                     queued INTEGER NOT NULL DEFAULT 0);
 CREATE TABLE header (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      url_id INTEGER NOT NULL,
                      name VARCHAR(4096),
@@ -61,7 +63,9 @@ CREATE TABLE redirect (id INTEGER PRIMARY KEY AUTOINCREMENT,
 CREATE TABLE url (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   domain_id INTEGER NOT NULL,
                   url VARCHAR(4096) NOT NULL UNIQUE,
-                  time INTEGER);
+                  time INTEGER,
+                  etag VARCHAR(4096),
+                  modified VARCHAR(64));
 CREATE TABLE error (id INTEGER PRIMARY KEY AUTOINCREMENT,
                     url_id INTEGER NOT NULL UNIQUE,
                     type VARCHAR(64),
@@ -70,6 +74,32 @@ CREATE UNIQUE INDEX link_idx ON link (source_id, target_id);
 CREATE UNIQUE INDEX redirect_idx ON redirect (source_id, target_id);
 """
 
+indexes = """
+CREATE INDEX IF NOT EXISTS url_domain_time_idx ON url (domain_id, time);
+CREATE INDEX IF NOT EXISTS domain_time_idx ON domain (time);
+CREATE INDEX IF NOT EXISTS content_hash_idx ON content (hash);
+CREATE INDEX IF NOT EXISTS header_url_idx ON header (url_id);
+CREATE INDEX IF NOT EXISTS header_name_value_idx ON header (name, value);
+CREATE TRIGGER IF NOT EXISTS url_queued_insert AFTER INSERT ON url
+    WHEN new.time = 0 BEGIN
+    UPDATE domain SET queued=queued+1 WHERE id=new.domain_id;
+END;
+CREATE TRIGGER IF NOT EXISTS url_queued_update AFTER UPDATE OF time ON url
+    WHEN (IFNULL(old.time, -1) = 0) != (IFNULL(new.time, -1) = 0) BEGIN
+    UPDATE domain SET queued=queued + (CASE WHEN new.time = 0 THEN 1
+                                       ELSE -1 END) WHERE id=new.domain_id;
+END;
+"""
+
+# domains with URLs to fetch, in time order (so next_url does not pass over
+# the domains which have none); partial indexes need sqlite 3.8.0
+queued_index = """
+CREATE INDEX IF NOT EXISTS domain_queued_time_idx ON domain (time)
+    WHERE queued > 0;
+"""
+
+limit = None # if not None, the number of URLs left to hand out
+
 class NoRow (Exception):
     """ Exception raised when a SELECT statement yield no rows.
     """
@@ -88,12 +118,33 @@ class SQLImplementation (object):
     
     api_lock = Lock()
 
-    def __init__(self, path):
-        """ Open a connection to the MySQL database of company data.
+    def __init__(self, path, commit_interval=1.0, commit_statements=1000,
+                 robots_cache_size=1000):
+        """ Open a connection to the sqlite database at the given path.
+        
+            Writes are committed when commit_interval seconds have passed or
+            commit_statements statements have been executed since the last
+            commit, whichever is sooner (and on close). A commit_interval of
+            0 commits after every statement.
+
+            Parsed robots.txt rules are cached for up to robots_cache_size
+            domains, in robots_cache (see RobotCache.stats() for hit rates).
         """
         self.db = connect(path, check_same_thread=False)
         self.db.row_factory = Row
         self.cursor = self.db.cursor()
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.commit_interval = commit_interval
+        self.commit_statements = commit_statements
+        self.commits = 0
+        self.unchanged = 0
+        self._uncommitted = 0
+        self._last_commit = time()
+        self._upsert = sqlite_version_info >= (3, 24, 0)
+        self._domains = dict()
+        self.robots_cache = RobotCache(robots_cache_size)
+        self._upgrade()
         
     def execute(self, statement, *args):
         """ Execute the given SQL statement, substituting the remaining
@@ -102,11 +153,23 @@ class SQLImplementation (object):
         """
         try:
             self.cursor.execute(statement, args)
-            self.db.commit()
-            return self.cursor.lastrowid
+            row_id = self.cursor.lastrowid
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_statements or \
+               time() - self._last_commit >= self.commit_interval:
+                self.commit()
+            return row_id
         except DatabaseError as e:
             _debug(statement)
             raise e
+
+    def commit(self):
+        """ Commit any outstanding writes.
+        """
+        self.db.commit()
+        self.commits += 1
+        self._uncommitted = 0
+        self._last_commit = time()
         
     def select(self, statement, *args):
         """ Execute the given SELECT SQL statement, substituting the remaining
@@ -139,14 +202,41 @@ class SQLImplementation (object):
             raise e        
         
     def close(self):
-        """ Close the database connection.
+        """ Commit any outstanding writes and close the database connection.
         """
+        self.commit()
         self.db.close()
 
     def initialise(self):
         """ Create SQL tables.
         """
         self.cursor.executescript(schema)
+        self._create_indexes()
+        self._domains.clear()
+
+    def _create_indexes(self):
+        self.cursor.executescript(indexes)
+        if sqlite_version_info >= (3, 8, 0):
+            self.cursor.executescript(queued_index)
+
+    def _upgrade(self):
+        """ Add columns and indexes missing from databases created by older
+            versions.
+        """
+        columns = [row[1] for row in self.select_iter("PRAGMA table_info(url)")]
+        if len(columns) == 0:
+            return
+        if "etag" not in columns:
+            self.execute("ALTER TABLE url ADD COLUMN etag VARCHAR(4096)")
+            self.execute("ALTER TABLE url ADD COLUMN modified VARCHAR(64)")
+        columns = [row[1] for row in
+                   self.select_iter("PRAGMA table_info(domain)")]
+        if "queued" not in columns:
+            self.execute("ALTER TABLE domain ADD COLUMN queued INTEGER " \
+                         "NOT NULL DEFAULT 0")
+            self.execute("UPDATE domain SET queued=(SELECT COUNT(*) FROM " \
+                         "url WHERE domain_id=domain.id AND time=0)")
+        self._create_indexes()
 
     def _select_url(self, url, select_time=False):
         """ Select a URL id from the database. If select_time, include the
@@ -160,68 +250,94 @@ class SQLImplementation (object):
             to that value. Returns the database id of the URL.
         """
         assert url.netloc != ""
+        return self.execute("INSERT INTO url(domain_id, url, time) " \
+                            "VALUES (?, ?, ?)", self._domain_id(url.netloc),
+                            str(url), t)
+
+    def _url_id(self, url):
+        """ Return the database id of a URL, inserting it if necessary.
+        """
         try:
-            domain_id = self.select("SELECT id FROM domain WHERE netloc=?",
-                                    url.netloc)
+            return self._select_url(url)
         except NoRow:
-            domain_id = self.execute("INSERT INTO domain(netloc) VALUES (?)",
-                                     url.netloc)
-        return self.execute("INSERT INTO url(domain_id, url, time) " \
-                            "VALUES (?, ?, ?)", domain_id, str(url), t)
+            return self._insert_url(url)
+
+    def _domain_id(self, netloc):
+        """ Return the database id of a domain, inserting it if necessary.
+            Domain ids are cached.
+        """
+        domain_id = self._domains.get(netloc)
+        if domain_id is None:
+            try:
+                domain_id = self.select("SELECT id FROM domain WHERE netloc=?",
+                                        netloc)
+            except NoRow:
+                domain_id = self.execute("INSERT INTO domain(netloc) " \
+                                         "VALUES (?)", netloc)
+            self._domains[netloc] = domain_id
+        return domain_id
           
     def dump_resource(self, resource):
-        """ Dump the resource to the database. Check for redirects.
+        """ Dump the resource to the database, replacing any previous content
+            for the URL. The ETag and Last-Modified headers are stored against
+            the requested URL, for making conditional requests on a recrawl.
         """
         url_id = self._select_url(resource.url)
+        self.execute("DELETE FROM header WHERE url_id=?", url_id)
         for name, value in resource.headers.items():
             self.execute("INSERT INTO header(url_id, name, value) " \
                          "VALUES (?, ?, ?)", url_id, name, value)
-        content = Binary(resource.content)
-        self.execute("INSERT INTO content(url_id, content, hash) " \
+        resource.body.seek(0)
+        content = Binary(resource.body.read())
+        self.execute("INSERT OR REPLACE INTO content(url_id, content, hash) " \
                      "VALUES (?, ?, ?)", url_id, content, resource.hash)
+        self.execute("UPDATE url SET etag=?, modified=? WHERE url=?",
+                     resource.headers.get("ETag"),
+                     resource.headers.get("Last-Modified"),
+                     str(resource.origin_url))
 
     def add_url(self, url):
         """ Add a URL, referencing the domain (domain is created if it does not
-            already exist).
+            already exist). Raise DuplicateURL if the URL has already been
+            added (rather than just linked to).
         """
-        try:
-            url_id, t = self._select_url(url, select_time=True)
-        except NoRow:
-            self._insert_url(url, 0)
+        if self._upsert:
+            self.execute("INSERT INTO url(domain_id, url, time) " \
+                         "VALUES (?, ?, 0) ON CONFLICT(url) DO UPDATE " \
+                         "SET time=0 WHERE url.time IS NULL",
+                         self._domain_id(url.netloc), str(url))
         else:
-            if t is not None:
-                raise DuplicateURL()
-            self.execute("UPDATE url SET time=0 WHERE id=?", url_id)
+            self.execute("UPDATE url SET time=0 WHERE url=? AND time IS NULL",
+                         str(url))
+            if self.cursor.rowcount == 0:
+                self.execute("INSERT OR IGNORE INTO url(domain_id, url, " \
+                             "time) VALUES (?, ?, 0)",
+                             self._domain_id(url.netloc), str(url))
+        if self.cursor.rowcount == 0:
+            raise DuplicateURL()
     
     def add_link(self, source, target):
         """ Add a link by referencing the source and target URLs.
         """
         source_id = self._select_url(source)
-        try:
-            target_id = self._select_url(target)
-        except NoRow:
-            target_id = self._insert_url(target)
-        try:
-            link_id, count = self.select("SELECT id, count FROM link " \
-                                         "WHERE source_id=? " \
-                                         "AND target_id=?",
-                                         source_id, target_id)
-        except NoRow:
+        target_id = self._url_id(target)
+        if self._upsert:
+            self.execute("INSERT INTO link(source_id, target_id, count) " \
+                         "VALUES (?, ?, 1) ON CONFLICT(source_id, target_id) " \
+                         "DO UPDATE SET count=count+1", source_id, target_id)
+            return
+        self.execute("UPDATE link SET count=count+1 WHERE source_id=? " \
+                     "AND target_id=?", source_id, target_id)
+        if self.cursor.rowcount == 0:
             self.execute("INSERT INTO link(source_id, target_id, count) " \
                          "VALUES (?, ?, 1)", source_id, target_id)
-        else:
-            self.execute("UPDATE link SET count=? WHERE id=?",
-                         count + 1, link_id)
     
     def add_redirect(self, source, target):
         """ Add a redirect by referencing the source and target URLs.
         """
         orig_id = self._select_url(source)
-        try:
-            url_id = self._select_url(target)
-        except NoRow:
-            url_id = self._insert_url(target)
-        self.execute("INSERT INTO redirect(source_id, target_id) " \
+        url_id = self._url_id(target)
+        self.execute("INSERT OR REPLACE INTO redirect(source_id, target_id) " \
                      "VALUES (?, ?)", orig_id, url_id)
     
     def check_url(self, url):
@@ -248,16 +364,18 @@ class SQLImplementation (object):
             else:
                 limit -= 1
         try:
-            domain_id, url_id, url = self.select("SELECT domain_id, " \
-                "url.id, url FROM domain, url WHERE url.domain_id=domain.id " \
-                "AND url.time=0 ORDER BY domain.time LIMIT 1")
+            # the count of queued URLs on each domain is kept by triggers, so
+            # only domains with URLs to fetch are scanned (by
+            # domain_queued_time_idx), and a URL is found by
+            # url_domain_time_idx
+            domain_id, domain_time = self.select("SELECT id, time FROM " \
+                "domain WHERE queued > 0 ORDER BY time LIMIT 1")
+            url_id, url = self.select("SELECT id, url FROM url WHERE " \
+                "domain_id=? AND time=0 LIMIT 1", domain_id)
         except NoRow:
             return None
         url = StdURL(url)
-        try:
-            self.select("SELECT time FROM domain WHERE id=? AND time > 0",
-                        domain_id)
-        except NoRow:
+        if not domain_time:
             url = StdURL("http://{0}/robots.txt".format(url.netloc))
             self.execute("UPDATE domain SET time=? WHERE id=?",
                          int(time()), domain_id)
@@ -270,29 +388,73 @@ class SQLImplementation (object):
         """ Record the error against the URL.
         """
         url_id = self._select_url(url)
-        self.execute("INSERT INTO error(url_id, type, error) VALUES (?, ?, ?)",
-                     url_id, e.__class__.__name__, str(e))
+        self.execute("INSERT OR REPLACE INTO error(url_id, type, error) " \
+                     "VALUES (?, ?, ?)", url_id, e.__class__.__name__, str(e))
+
+    def queue_depths(self, n=20):
+        """ Return a list of (netloc, number of URLs to fetch) for the n
+            domains with the most URLs to fetch.
+        """
+        return [tuple(row) for row in self.select_iter("SELECT netloc, " \
+                "queued FROM domain WHERE queued > 0 ORDER BY queued DESC " \
+                "LIMIT ?", n)]
+
+    def validators(self, url):
+        """ Return headers for a conditional request for the URL, from the
+            ETag and Last-Modified headers stored when it was last dumped.
+        """
+        try:
+            etag, modified = self.select("SELECT etag, modified FROM url " \
+                                         "WHERE url=?", str(url))
+        except NoRow:
+            return None
+        headers = dict()
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if modified is not None:
+            headers["If-Modified-Since"] = modified
+        return headers
+
+    def not_modified(self, url):
+        """ Count a URL that has not changed since it was last dumped (the
+            stored content is kept).
+        """
+        self.unchanged += 1
+
+    def recrawl(self, before=None):
+        """ Mark URLs fetched before the given timestamp (default now) to be
+            fetched again, returning the number of URLs marked. URLs with
+            stored validators are fetched with conditional requests.
+        """
+        if before is None:
+            before = int(time()) + 1
+        self.execute("UPDATE url SET time=0 WHERE time > 0 AND time < ?",
+                     before)
+        return self.cursor.rowcount
         
     def duplicate_resource(self, resource):
-        """ Check a web resource for duplication.
+        """ Check a web resource for duplication. Rows stored for the
+            resource's own URL are ignored, so that a recrawled page is not a
+            duplicate of itself.
         """
-        if resource.content is None:
+        if resource.body is None:
             # check the ETag, if there is one
             etag = resource.headers.get("ETag")
             if etag is not None:
                 try:
                     self.select("SELECT id FROM header WHERE name=? " \
-                                "AND value=?", "ETag", etag)
+                                "AND value=? AND url_id NOT IN " \
+                                "(SELECT id FROM url WHERE url=?)",
+                                "ETag", etag, str(resource.url))
                     raise DuplicateResource()
                 except NoRow:
                     pass
             return
-        # check the hash
-        hasher = md5()
-        hasher.update(resource.content)
-        resource.hash = hasher.hexdigest()
+        # check the hash (computed as the content was read)
         try:
-            self.select("SELECT id FROM content WHERE hash=?", resource.hash)
+            self.select("SELECT id FROM content WHERE hash=? AND url_id NOT " \
+                        "IN (SELECT id FROM url WHERE url=?)", resource.hash,
+                        str(resource.url))
             raise DuplicateResource()
         except NoRow:
             pass
@@ -302,8 +464,8 @@ class SQLImplementation (object):
             and record that a request is being made now. Returns 0 if this is
             the first request.
         """
-        domain_id, t = self.select("SELECT id, time FROM domain " \
-                                   "WHERE netloc=?", netloc)
+        domain_id = self._domain_id(netloc)
+        t = self.select("SELECT time FROM domain WHERE id=?", domain_id)
         self.execute("UPDATE domain SET time=? WHERE id=?",
                      int(time()), domain_id)
         return t
@@ -312,11 +474,10 @@ class SQLImplementation (object):
         """ Parse the given robots.txt content and store against the given
             domain. If content is None, any URL will be allowed.
         """
-        robot = RobotFileParser()
-        if content is not None:
-            robot.parse(content.split("\n"))
+        rules = RobotRules.parse(content, crawler.user_agent)
         self.execute("UPDATE domain SET robots=? WHERE netloc=?",
-                     dumps(robot), netloc)
+                     rules.dumps(), netloc)
+        self.robots_cache.put(netloc, rules)
         
     def check_robots(self, url):
         """ If no attempt has yet been made to fetch robots.txt for the domain
@@ -325,14 +486,17 @@ class SQLImplementation (object):
             raise URLNotAllowed. Otherwise, return the crawl delay required by
             robots.txt, or None if not specified.
         """
-        robots = self.select("SELECT robots FROM domain WHERE netloc=?",
-                             url.netloc)
-        if robots is None:
-            raise NoRobots()
-        robot = loads(str(robots))
-        if not robot.can_fetch(crawler.user_agent, url.path):
+        rules = self.robots_cache.get(url.netloc)
+        if rules is None:
+            robots = self.select("SELECT robots FROM domain WHERE netloc=?",
+                                 url.netloc)
+            if robots is None:
+                raise NoRobots()
+            rules = RobotRules.loads(str(robots), crawler.user_agent)
+            self.robots_cache.put(url.netloc, rules)
+        if not rules.allowed(url.path):
             raise URLNotAllowed()
-        return crawler.default_delay
+        return rules.delay
 
     def stats(self):
         """ Output database stats to stdout.
@@ -381,13 +545,18 @@ if __name__ == "__main__":
     single_url = "-u" in argv[1:]
     limit = 5 if "-l" in argv[1:] else None
     stats = "-s" in argv[1:]
+    recrawl = "-r" in argv[1:]
+    near_duplicates = "-n" in argv[1:]
+    serve_metrics = "-m" in argv[1:]
+    adaptive = "-a" in argv[1:]
+    index = "-x" in argv[1:]
     
     for arg in argv[1:]:
         if arg[0] == "-":
             argv.remove(arg)
 
-    if len(argv) < (3 if not stats else 2):
-        print """Usage: [-v|-q|-i|-s|-l] <db path> <initial URL>
+    if len(argv) < (3 if not (stats or recrawl) else 2):
+        print """Usage: [-v|-q|-i|-s|-l|-r|-n|-m|-a|-x] <db path> <initial URL>
 
 Flags: -v  Output debug messages
        -q  Set default delay to 0
@@ -397,6 +566,14 @@ Flags: -v  Output debug messages
        -l  Limit the number of URLs crawled to 5
        -t  Run only one crawler thread
        -s  Don't crawl, but output database stats
+       -r  Recrawl URLs already fetched, using conditional requests where
+           possible (the initial URL is optional)
+       -n  Also reject pages which are near-duplicates of pages crawled
+       -m  Serve crawler metrics at http://localhost:8089/ while crawling,
+           and output them at the end
+       -a  Adapt the delay for each domain to its response times and errors
+       -x  Also index the content into a Xapian database (<db path>.xapian)
+           as it is crawled (needs flax.core and Xapian)
 """
         exit()
 
@@ -411,17 +588,42 @@ Flags: -v  Output debug messages
         sql.stats()
     else:
         crawler.dump = sql
+        if index:
+            from indexer import IndexingDumper
+            crawler.dump = IndexingDumper(argv[1] + ".xapian", dumper=sql)
         crawler.pool = sql
         crawler.dns = sql
         crawler.follow = DefaultFollowDecider("^text/html$|^image/.*", domain)\
                          if not single_url else SingleURLFollower(argv[2])
-        crawler.duplicate = sql
+        crawler.duplicate = sql if not near_duplicates else \
+                            NearDuplicateDetector(sql, SQLSimHashIndex(sql))
         crawler.parsers = (DefaultHtmlParser(), )
-        crawler.throttle = sql
+        crawler.throttle = sql if not adaptive else AdaptiveThrottle(sql)
         crawler.robots = sql
         crawler.error = sql
-        sql.add_url(StdURL(argv[2]))
+        if recrawl:
+            print sql.recrawl(), "URLs to recrawl"
+        if len(argv) > 2:
+            try:
+                sql.add_url(StdURL(argv[2]))
+            except DuplicateURL:
+                # e.g. already marked by recrawl()
+                pass
+        if serve_metrics:
+            server = StatusServer(crawler.metrics, 8089)
+            server.start()
         crawler.start()
+        if index:
+            crawler.dump.close()
+            print crawler.dump
+        if serve_metrics:
+            server.close()
+            print crawler.metrics
+        _debug("robots.txt cache:", sql.robots_cache.stats())
+        if recrawl:
+            print sql.unchanged, "URLs not modified"
+        if near_duplicates:
+            print crawler.duplicate
 
     sql.close()
     
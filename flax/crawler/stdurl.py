@@ -15,9 +15,146 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 """ Module including a standard URL class.
+
+    A StdURL holds only its canonical string (interned, so that equal URLs
+    share it), from which the parts of the URL are derived when first used.
+    URLs are canonicalised by the module's canonicaliser, which may be
+    replaced to change the rules, e.g.::
+
+        stdurl.canonicaliser = Canonicaliser(sort_query=False)
 """
 
-from urlparse import urljoin, urlsplit
+from urlparse import urljoin, urlsplit, urlunsplit
+from re import compile as re_compile
+
+
+_escape = re_compile("%([0-9a-fA-F]{2})")
+_unsafe = re_compile("[\x00-\x20\x7f-\xff]")
+# characters which need not be escaped (RFC 3986 "unreserved")
+_unreserved = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+                        "0123456789-._~")
+_default_ports = {"http": ":80", "https": ":443"}
+
+
+def _normalise_escape(match):
+    c = chr(int(match.group(1), 16))
+    if c in _unreserved:
+        return c
+    return "%" + match.group(1).upper()
+
+
+def _escape_unsafe(match):
+    return "%{0:02X}".format(ord(match.group(0)))
+
+
+def remove_dot_segments(path):
+    """ Return the path with "." and ".." segments removed (RFC 3986 5.2.4).
+    """
+    if "." not in path:
+        return path
+    segments = path.split("/")
+    output = list()
+    for segment in segments[1:] if path.startswith("/") else segments:
+        if segment == ".":
+            continue
+        if segment == "..":
+            if output:
+                output.pop()
+            continue
+        output.append(segment)
+    if segments[-1] in (".", ".."):
+        output.append("")
+    result = "/".join(output)
+    return "/" + result if path.startswith("/") else result
+
+
+class Canonicaliser (object):
+    """ Converts URLs to a canonical string, so that different spellings of
+        the same URL are equal.
+    """
+
+    def __init__(self, lower_case=True, remove_default_port=True,
+                 remove_fragment=True, sort_query=True,
+                 session_params=("jsessionid", "phpsessid"),
+                 session_query_params=(),
+                 remove_dot_segments=True, normalise_escapes=True):
+        """ lower_case lower-cases the scheme and host name.
+            remove_default_port removes the port if it is the default.
+            remove_fragment removes any fragment (#foo).
+            sort_query sorts the query parameters.
+            session_params are the (lower case) names of path parameters
+                (;name=value) which are removed.
+            session_query_params are the (lower case) names of query
+                parameters which are removed (none by default, as names
+                such as "sid" are often not session IDs, and removing them
+                would merge different pages).
+            remove_dot_segments resolves "." and ".." in the path.
+            normalise_escapes upper-cases escapes (%2f to %2F), unescapes
+                unreserved characters and escapes spaces, control
+                characters and non-ASCII bytes.
+
+            Escapes are normalised before the other rules are applied (as
+            in RFC 3986 6.2.2), so that the canonical string of a canonical
+            string is itself.
+        """
+        self.lower_case = lower_case
+        self.remove_default_port = remove_default_port
+        self.remove_fragment = remove_fragment
+        self.sort_query = sort_query
+        self.session_params = frozenset(session_params)
+        self.session_query_params = frozenset(session_query_params)
+        self.remove_dot_segments = remove_dot_segments
+        self.normalise_escapes = normalise_escapes
+
+    def __call__(self, url):
+        """ Return the canonical string for a URL string.
+        """
+        if isinstance(url, unicode):
+            url = url.encode("utf-8")
+        url = url.strip()
+        if self.normalise_escapes:
+            # unescaping unreserved characters never adds a delimiter, so
+            # this can be done before splitting (and must be done before
+            # removing dot segments, e.g. "%2E%2E")
+            url = _unsafe.sub(_escape_unsafe, _escape.sub(_normalise_escape,
+                                                          url))
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        if self.lower_case:
+            scheme = scheme.lower()
+            netloc = self._lower_host(netloc)
+        if self.remove_default_port:
+            port = _default_ports.get(scheme)
+            if port is not None and netloc.endswith(port):
+                netloc = netloc[:-len(port)]
+        if netloc:
+            if self.session_params and ";" in path:
+                path = ";".join(p for p in path.split(";")
+                                if p.split("=")[0].lower() not in
+                                   self.session_params)
+            if self.remove_dot_segments:
+                path = remove_dot_segments(path)
+            if path == "":
+                path = "/"
+        if query and (self.sort_query or self.session_query_params):
+            params = [p for p in query.split("&") if p and
+                      p.split("=")[0].lower() not in
+                      self.session_query_params]
+            if self.sort_query:
+                params.sort()
+            query = "&".join(params)
+        if self.remove_fragment:
+            fragment = ""
+        return urlunsplit((scheme, netloc, path, query, fragment))
+
+    @staticmethod
+    def _lower_host(netloc):
+        """ Lower-case the host of a netloc, leaving any user info alone.
+        """
+        i = netloc.rfind("@") + 1
+        return netloc[:i] + netloc[i:].lower()
+
+
+canonicaliser = Canonicaliser()
 
 
 def stdurl(raw_url):
@@ -32,68 +169,101 @@ class StdURL (object):
     """Class representing a URL, the scheme of which is assumed to be HTTP.
     """
 
+    __slots__ = ("_url", "_parts")
+
     def __init__(self, url, parent=None):
         """ Create a StdURL instance for the given URL.
         
             If parent is specified, then the URL is resolved relative to it.
         """
+        self._parts = None
         if parent is not None:
-            # resolve the url relative to the parent
-            if isinstance(parent, StdURL):
-                parent = str(parent)
-            if isinstance(url, StdURL):
-                url = str(url)
-            url = urljoin(parent, url)
-        # in case a StdURL is passed as the url argument (copy)
-        if isinstance(url, StdURL):
-            parts = url
-        else:
-            parts = urlsplit(url.strip())
-        # pull out most parts from urlsplit
-        self.scheme = parts.scheme
-        self.hostname = parts.hostname
-        self.port = parts.port
-        self.netloc = parts.netloc
-        self.path = parts.path
-        self.query = parts.query
-        # compute some extra properties based on above
-        if self.path.find(".") == -1:
-            self.extension = ""
-        else:
-            self.extension = self.path.split(".")[-1]
-        query_str = "?{0}".format(self.query) if self.query else ""
-        self.selector = "{0}{1}".format(self.path, query_str)
+            # resolve the url relative to the parent (as UTF-8, which str()
+            # can't encode unicode to)
+            if isinstance(url, unicode):
+                url = url.encode("utf-8")
+            if isinstance(parent, unicode):
+                parent = parent.encode("utf-8")
+            url = urljoin(str(parent), str(url))
+        elif isinstance(url, StdURL):
+            # copy
+            self._url = url._url
+            return
+        self._url = intern(canonicaliser(url))
+
+    def _split(self):
+        parts = self._parts
+        if parts is None:
+            parts = self._parts = urlsplit(self._url)
+        return parts
+
+    scheme = property(lambda self: self._split().scheme)
+    hostname = property(lambda self: self._split().hostname)
+    port = property(lambda self: self._split().port)
+    netloc = property(lambda self: self._split().netloc)
+    path = property(lambda self: self._split().path)
+    query = property(lambda self: self._split().query)
+
+    @property
+    def extension(self):
+        path = self.path
+        if path.find(".") == -1:
+            return ""
+        return path.split(".")[-1]
+
+    @property
+    def selector(self):
+        parts = self._split()
+        if parts.query:
+            return "{0}?{1}".format(parts.path, parts.query)
+        return parts.path
 
     def __eq__(self, other):
-        """ Two StdURL instances are equal if they have the same scheme, host,
-            port, path and query.
+        """ Two StdURL instances are equal if they have the same canonical
+            string.
         """
-        if other is None:
+        if not isinstance(other, StdURL):
             return False
-        return self.scheme == other.scheme and self.netloc == other.netloc \
-               and self.selector == other.selector
+        return self._url == other._url
 
     def __ne__(self, other):
-        """ Two StdURL instances are unequal if they differ in scheme, host,
-            port, path or query.
+        """ Two StdURL instances are unequal if their canonical strings
+            differ.
         """
-        if other is None:
+        if not isinstance(other, StdURL):
             return True
-        return self.scheme != other.scheme or self.netloc != other.netloc \
-               or self.selector != other.selector
+        return self._url != other._url
 
     def __hash__(self):
         """ Returns a suitable hash value for the StdURL.
         """
-        return hash(str(self))
+        return hash(self._url)
 
     def __str__(self):
-        """ Ignore any URL fragment (#foo) for the string representation.
+        """ Return the canonical string (without any URL fragment, by
+            default).
         """
-        return "{0}://{1}{2}".format(self.scheme, self.netloc, self.selector)
+        return self._url
+
+    def __reduce__(self):
+        # the string is canonical already, and is kept as it is (even if the
+        # canonicaliser has changed)
+        return _canonical_url, (self._url, )
+
+
+def _canonical_url(url):
+    """ Return a StdURL for a canonical string, without canonicalising it.
+    """
+    result = StdURL.__new__(StdURL)
+    result._url = intern(url)
+    result._parts = None
+    return result
 
 
 if __name__ == "__main__":
+    from sys import getsizeof
+    from pickle import dumps, loads
+
     url1 = StdURL("http://www.google.com")
     url2 = StdURL("http://www.google.com")
     url3 = StdURL("http://www.google.co.uk")
@@ -109,5 +279,40 @@ if __name__ == "__main__":
     assert StdURL("mailto:abc@foo.com", url4).scheme == "mailto"
     assert StdURL("foo.html", url4) == StdURL("http://www.abc.com/foo.html")
     assert StdURL("http://foo", url4) == StdURL("http://foo")
+    # canonical forms
+    spellings = ("http://WWW.Example.com:80/a/./b/../c.html?y=2&x=1#top",
+                 "HTTP://www.example.com/a/c.html?x=1&y=2",
+                 "http://www.example.com/a/c.html;jsessionid=123?y=2&x=1",
+                 "http://www.example.com/a/%63.html?x=1&y=2")
+    urls = set(StdURL(u) for u in spellings)
+    assert len(urls) == 1, urls
+    url = urls.pop()
+    assert str(url) == "http://www.example.com/a/c.html?x=1&y=2"
+    assert url.netloc == "www.example.com" and url.port is None
+    assert url.selector == "/a/c.html?x=1&y=2" and url.extension == "html"
+    assert str(StdURL("http://a/b c/%2f")) == "http://a/b%20c/%2F"
+    assert str(StdURL("https://a:443")) == "https://a/"
+    assert StdURL("http://a:8080/").port == 8080
+    assert str(StdURL(u"http://a/\xe9")) == "http://a/%C3%A9"
+    assert str(StdURL(u"/\xe9", "http://x/")) == "http://x/%C3%A9"
+    assert str(StdURL("b", u"http://x/\xe9/")) == "http://x/%C3%A9/b"
+    assert str(StdURL(StdURL("http://a/b"))) == "http://a/b"
+    assert str(StdURL("http://a/b/%2E%2E/c")) == "http://a/c"
+    assert str(StdURL("http://a/?sid=5&page=2")) == "http://a/?page=2&sid=5"
+    # canonicalising is idempotent
+    for u in spellings + ("http://a/b/%2E%2E/c", "http://a/%7e%2e/%2E./x",
+                          "http://a/%25%32%45/b c?%73id=1&a", "HTTP://A:80",
+                          "http://a/b;JSESSIONID=1/./c"):
+        once = canonicaliser(u)
+        assert canonicaliser(once) == once, (u, once)
+    assert str(loads(dumps(StdURL("http://a/b/%2E%2E/c")))) == "http://a/c"
+    assert loads(dumps(url)) == url
+    assert loads(dumps(url, 2)) == url
+    canonicaliser = Canonicaliser(sort_query=False)
+    assert str(StdURL("http://a/?b&a")) == "http://a/?b&a"
+    canonicaliser = Canonicaliser(session_query_params=("phpsessid", "x"))
+    assert str(StdURL("http://a/c?x=1&PHPSESSID=abc&y=2")) == "http://a/c?y=2"
+    # pickles keep the canonical string, whatever the canonicaliser
+    assert str(loads(dumps(url))) == "http://www.example.com/a/c.html?x=1&y=2"
+    print "StdURL size:", getsizeof(url), "bytes (plus the shared string)"
     print "TEST PASSED"
-